@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark writing combined.xml with the streaming writer against the previous
+ElementTree -> minidom round-trip, run from the original xml_combiner.py as committed at BASELINE_REVISION
+(read with git show, so no second copy of it is kept in scripts/; it needs networkx).
+
+A synthetic training set is built in a temporary directory by copying a template molecule xml
+into many QUBEKit run folders, alongside fake Chargemol outputs.
+Each path then runs in a fresh process so the peak RSS figures are independent.
+
+    python benchmark_xml_writer.py -n 2000
+"""
+
+import argparse
+import contextlib
+import functools
+import io
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import xml.etree.ElementTree as ET
+
+from manifest import build_manifest
+from xml_combiner import ParseXML
+from xml_writer import StreamingXMLWriter
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE = os.path.join(SCRIPTS_DIR, '..', 'runs', 'training', 'model0', 'mol01', 'mol01.xml')
+# Commit holding the minidom combiner the streaming writer replaced.
+BASELINE_REVISION = 'f6570ba'
+
+
+@functools.lru_cache(maxsize=None)
+def load_baseline_combiner(revision=BASELINE_REVISION):
+    """Import scripts/xml_combiner.py as it was at revision, straight from git, as a module."""
+
+    file_name = f'{revision}:scripts/xml_combiner.py'
+    source = subprocess.run(
+        ['git', 'show', file_name], cwd=SCRIPTS_DIR, capture_output=True, text=True, check=True,
+    ).stdout
+    module = types.ModuleType('baseline_xml_combiner')
+    exec(compile(source, file_name, 'exec'), module.__dict__)
+    return module
+
+
+def combine_minidom(root):
+    """
+    The previous path, run from the baseline combiner: load every molecule, build the full ElementTree,
+    serialise it with ET.tostring, re-parse the string with minidom and pretty-print it.
+    """
+
+    class SortedParseXML(load_baseline_combiner().ParseXML):
+        """The baseline, with the molecules in name order (as xml_combiner writes them) so the outputs compare."""
+
+        def find_xmls_and_ddec_data(self):
+            super().find_xmls_and_ddec_data()
+            self.xmls = dict(sorted(self.xmls.items()))
+
+    # The baseline finds the QUBEKit folders under, and writes combined.xml to, the cwd;
+    # it is moved aside because the streaming path starts by removing combined.xml.
+    SortedParseXML()
+    os.replace('combined.xml', 'minidom.xml')
+
+
+def combine_streaming(root):
+    """The current path: render each molecule to compact text fragments, then stream them to file."""
+
+    parser = ParseXML(cache_dir=None, manifest=build_manifest(root), combine=False)
+    parser.load_fragments()
+    parser.combine_molecules(StreamingXMLWriter('streaming.xml', 'ForceField', parser.sections))
+
+
+PATHS = {
+    'minidom': combine_minidom,
+    'streaming': combine_streaming,
+}
+
+
+def write_synthetic_runs(root, n_molecules, template):
+    """Populate root with n_molecules QUBEKit run folders, each a copy of the template xml."""
+
+    with open(template) as xml_file:
+        xml_text = xml_file.read()
+    elements = [
+        atom.get('element') for atom in ET.fromstring(xml_text).find('AtomTypes') if atom.get('element') is not None
+    ]
+    n_atoms = len(elements)
+
+    for i in range(1, n_molecules + 1):
+        mol_name = f'mol{str(i).zfill(2)}'
+        run_dir = os.path.join(root, f'QUBEKit_{mol_name}_benchmark_log')
+        os.makedirs(os.path.join(run_dir, 'final_parameters'))
+        os.makedirs(os.path.join(run_dir, 'charges', 'ChargeMol'))
+
+        with open(os.path.join(run_dir, 'final_parameters', f'{mol_name}.xml'), 'w') as xml_file:
+            xml_file.write(xml_text)
+
+        charge_lines = [f'{n_atoms}\n', 'synthetic\n', 'The following XYZ coordinates are in angstroms\n', 'header\n']
+        vol_lines = [f'{n_atoms}\n', 'synthetic\n']
+        for index, element in enumerate(elements, start=1):
+            values = ' '.join(f'{random.uniform(-1, 1):.6f}' for _ in range(13))
+            charge_lines.append(f'{index} {element} 0.0 0.0 0.0 {values}\n')
+            vol_lines.append(f'{element} 0.0 0.0 0.0 {random.uniform(5, 60):.6f}\n')
+
+        charge_dir = os.path.join(run_dir, 'charges', 'ChargeMol')
+        with open(os.path.join(charge_dir, 'DDEC6_even_tempered_net_atomic_charges.xyz'), 'w') as charge_file:
+            charge_file.writelines(charge_lines)
+        with open(os.path.join(charge_dir, 'DDEC_atomic_Rcubed_moments.xyz'), 'w') as vol_file:
+            vol_file.writelines(vol_lines)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process; ru_maxrss is in bytes on macOS and kB elsewhere."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_path(root, path_name, results):
+    os.chdir(root)
+    if path_name == 'minidom':
+        # Loaded up front, like the streaming path's imports, so git show is not timed.
+        load_baseline_combiner()
+    rss_start = peak_rss_mb()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        PATHS[path_name](root)
+    elapsed = time.perf_counter() - start
+
+    results.put((path_name, elapsed, rss_start, peak_rss_mb()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--molecules', type=int, default=2000, help='Number of synthetic molecules.')
+    parser.add_argument('--template', default=TEMPLATE, help='Molecule xml copied for every synthetic molecule.')
+    args = parser.parse_args()
+
+    # Spawn so every path starts from a clean interpreter and its own RSS high-water mark.
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+
+    with tempfile.TemporaryDirectory() as root:
+        write_synthetic_runs(root, args.molecules, args.template)
+
+        print(f'{args.molecules} molecules (load, render and write combined.xml)')
+        print(f'{"path":<10} {"time (s)":>10} {"RSS start (MB)":>15} {"RSS peak (MB)":>14} {"RSS growth (MB)":>16}')
+        for path_name in PATHS:
+            process = context.Process(target=run_path, args=(root, path_name, results))
+            process.start()
+            name, elapsed, rss_start, rss_peak = results.get()
+            process.join()
+            print(f'{name:<10} {elapsed:>10.3f} {rss_start:>15.1f} {rss_peak:>14.1f} {rss_peak - rss_start:>16.1f}')
+
+        with open(os.path.join(root, 'minidom.xml')) as old, open(os.path.join(root, 'streaming.xml')) as new:
+            print('Outputs identical' if old.read() == new.read() else 'WARNING: outputs differ')
+
+
+if __name__ == '__main__':
+    main()
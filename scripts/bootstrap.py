@@ -0,0 +1,95 @@
+"""
+Bootstrap uncertainties of MUEs, and paired tests between models.
+
+Molecules are resampled with replacement; each resample is held as a row of multinomial counts,
+so the MUE of every model for a whole chunk of resamples is one weighted sum over an (models, resamples, molecules) array.
+Where the simulated values have a statistical uncertainty (the +- Stdev of ForceBalance's property tables),
+each resample also perturbs every calculated value by Gaussian noise of that size,
+so the intervals include the sampling error of the MD.
+
+All models are resampled with the same molecules (and each keeps its own noise), so the difference between two models
+can be bootstrapped pairwise:
+    replicates, differences = bootstrap_mues(errors, stdevs, pairs=[(0, 1)])
+    low, high = confidence_interval(replicates)
+    p = p_value(differences)
+A pair is compared on the molecules both models have results for.
+"""
+
+import numpy as np
+
+
+DEFAULT_RESAMPLES = 10000
+DEFAULT_CONFIDENCE = 0.95
+# Resamples held in memory at once; each chunk is an (models, chunk, molecules) float array.
+CHUNK_SIZE = 2000
+
+
+def bootstrap_mues(errors, stdevs=None, pairs=(), resamples=DEFAULT_RESAMPLES, seed=None, chunk_size=CHUNK_SIZE):
+    """
+    Bootstrap replicates of the MUE of each model and of the MUE difference of each pair of models.
+    :param errors: (models, molecules) array of calculated - experimental values, NaN where a model has no result
+    :param stdevs: array of the same shape giving the standard error of each calculated value; NaN or 0 where unknown.
+        None to resample the molecules only.
+    :param pairs: (i, j) row indices of errors; the differences are MUE(i) - MUE(j)
+    :param seed: seed of the random generator, for reproducible intervals
+    :return: (models, resamples) array of MUEs, (len(pairs), resamples) array of differences
+    """
+
+    errors = np.atleast_2d(np.asarray(errors, dtype=float))
+    valid = ~np.isnan(errors)
+    errors = np.where(valid, errors, 0.0)
+    if stdevs is not None:
+        stdevs = np.nan_to_num(np.asarray(stdevs, dtype=float).reshape(errors.shape))
+
+    pairs = np.array(pairs, dtype=int).reshape(-1, 2)
+    first, second = pairs[:, 0], pairs[:, 1]
+    common = valid[first] & valid[second]
+
+    models, molecules = errors.shape
+    rng = np.random.default_rng(seed)
+    replicates = np.empty((models, resamples))
+    differences = np.empty((len(first), resamples))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for start in range(0, resamples, chunk_size):
+            stop = min(start + chunk_size, resamples)
+            # How many times each molecule is drawn in each resample.
+            weights = rng.multinomial(molecules, np.full(molecules, 1 / molecules), size=stop - start).astype(float)
+
+            if stdevs is None:
+                absolute = np.abs(errors)[:, None, :]
+            else:
+                noise = stdevs[:, None, :] * rng.standard_normal((models, stop - start, molecules))
+                absolute = np.abs(errors[:, None, :] + noise)
+            absolute = absolute * valid[:, None, :]
+
+            replicates[:, start:stop] = np.sum(absolute * weights, axis=-1) / (valid @ weights.T)
+            if len(first):
+                gap = (absolute[first] - absolute[second]) * common[:, None, :]
+                differences[:, start:stop] = np.sum(gap * weights, axis=-1) / (common @ weights.T)
+
+    return replicates, differences
+
+
+def confidence_interval(replicates, confidence=DEFAULT_CONFIDENCE):
+    """
+    Percentile interval of bootstrap replicates.
+    :param replicates: array of shape (..., resamples)
+    :return: low, high arrays of shape (...)
+    """
+
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.nanpercentile(replicates, [tail, 100 - tail], axis=-1)
+    return low, high
+
+
+def p_value(differences):
+    """
+    Two-sided bootstrap p-value that a paired difference is zero: twice the fraction of replicates on the smaller side.
+    :param differences: array of shape (..., resamples)
+    """
+
+    resamples = np.sum(~np.isnan(differences), axis=-1)
+    below = np.sum(differences <= 0, axis=-1) / resamples
+    above = np.sum(differences >= 0, axis=-1) / resamples
+    return np.minimum(1.0, 2 * np.minimum(below, above))
@@ -0,0 +1,98 @@
+"""
+Columnar reader for Chargemol (DDEC) outputs.
+
+A whole molecule is parsed into one NumPy structured array, one record per atom, rather than a Python object per atom.
+Fields:
+    symbol: atomic symbol e.g. 'C', 'Cl'
+    charge: net atomic charge (e)
+    dipole: atomic dipole x, y, z (atomic units)
+    quadrupole: Qxy, Qxz, Qyz, Q(x^2-y^2), Q(3z^2-R^2) (atomic units)
+    volume: <r^3> atomic volume (bohr^3) from the R-cubed moments file
+"""
+
+import os
+
+import numpy as np
+
+
+CHARGE_FILE_NAMES = {
+    3: 'DDEC3_net_atomic_charges.xyz',
+    6: 'DDEC6_even_tempered_net_atomic_charges.xyz',
+}
+VOLUME_FILE_NAME = 'DDEC_atomic_Rcubed_moments.xyz'
+
+DDEC_DTYPE = np.dtype([
+    ('symbol', 'U2'),
+    ('charge', 'f8'),
+    ('dipole', 'f8', (3,)),
+    ('quadrupole', 'f8', (5,)),
+    ('volume', 'f8'),
+])
+
+# Columns of the charges file's atom table holding the charge, dipole x y z and the five quadrupole components.
+CHARGE_COLUMNS = (5, 6, 7, 8, 10, 11, 12, 13, 14)
+
+# Line marking the start of the per-atom table in the charges file; the column header line follows it.
+DATA_MARKER = 'The following XYZ'
+
+
+def charge_file_name(ddec_version=6):
+    try:
+        return CHARGE_FILE_NAMES[ddec_version]
+    except KeyError:
+        raise ValueError('Unsupported DDEC version; please use version 3 or 6.') from None
+
+
+def read_ddec(charge_dir='.', ddec_version=6):
+    """
+    Read the net charges, atomic multipoles and R-cubed volumes for a molecule.
+    :param charge_dir: directory containing the Chargemol outputs (usually <run>/charges/ChargeMol)
+    :param ddec_version: 3 or 6, selects the charges file
+    :return: structured array of DDEC_DTYPE, indexed by atom (from zero)
+    """
+
+    net_charge_file_name = os.path.join(charge_dir, charge_file_name(ddec_version))
+
+    if not os.path.exists(net_charge_file_name):
+        raise FileNotFoundError(
+            'Cannot find the DDEC output file.\nThis could be indicative of several issues.\n'
+            'Please check Chargemol is installed in the correct location and that the configs'
+            ' point to that location.'
+        )
+
+    with open(net_charge_file_name) as charge_file:
+        text = charge_file.read()
+
+    atom_total = int(text.split(maxsplit=1)[0])
+
+    marker = text.find(DATA_MARKER)
+    if marker == -1:
+        raise EOFError(f'Cannot find charge data in {net_charge_file_name}.')
+    # Skip the marker and column header lines.
+    start_pos = text.count('\n', 0, marker) + 2
+    lines = text.splitlines()[start_pos: start_pos + atom_total]
+    if len(lines) != atom_total:
+        raise EOFError(f'Expected {atom_total} atoms in {net_charge_file_name}, found {len(lines)}.')
+
+    # atom number, symbol, x, y, z, charge, dipole x y z, |dipole|, Qxy, Qxz, Qyz, Q(x^2-y^2), Q(3z^2-R^2), ...
+    # loadtxt tokenises and converts in C; only the columns which are kept are converted.
+    values = np.loadtxt(lines, usecols=CHARGE_COLUMNS, ndmin=2)
+
+    # Chargemol writes the atoms in order, numbered from 1; the array is indexed from 0.
+    ddec_data = np.empty(atom_total, dtype=DDEC_DTYPE)
+    ddec_data['symbol'] = [line.split(None, 2)[1] for line in lines]
+    ddec_data['charge'] = values[:, 0]
+    ddec_data['dipole'] = values[:, 1:4]
+    ddec_data['quadrupole'] = values[:, 4:9]
+
+    r_cubed_file_name = os.path.join(charge_dir, VOLUME_FILE_NAME)
+
+    with open(r_cubed_file_name) as vol_file:
+        lines = vol_file.read().splitlines()[2: atom_total + 2]
+    if len(lines) != atom_total:
+        raise EOFError(f'Expected {atom_total} atoms in {r_cubed_file_name}, found {len(lines)}.')
+
+    # symbol, x, y, z, volume
+    ddec_data['volume'] = np.loadtxt(lines, usecols=-1, ndmin=1)
+
+    return ddec_data
@@ -0,0 +1,116 @@
+"""
+On-disk cache of parsed Chargemol outputs.
+
+Each ChargeMol directory's read_ddec array is stored in a central cache directory as one small binary file:
+a fixed header (the size and mtime of both source files plus a hash of their contents) followed by the raw records.
+Loading an entry is a single read and np.frombuffer, with no text parsing.
+
+An entry is reused while the size and mtime of both source files are unchanged.
+If they have changed but the contents still hash the same (e.g. the run was copied), the entry is refreshed and reused;
+otherwise the files are parsed again.
+Once the cache grows beyond its size cap, the least recently used entries are evicted.
+"""
+
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+from ddec import DDEC_DTYPE, VOLUME_FILE_NAME, charge_file_name, read_ddec
+from fragment_cache import hash_files
+
+
+# Bump whenever DDEC_DTYPE or the header changes so old entries are parsed again.
+CACHE_VERSION = 1
+# magic, cache version, atom count, (size, mtime) of the charges and volume files, sha256 hex digest of both.
+HEADER = struct.Struct('<4sII4q64s')
+MAGIC = b'DDEC'
+
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+
+
+class DDECCache:
+    """One <hash of the ChargeMol path>.ddec file per molecule in cache_dir."""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param cache_dir: directory the entries are stored in; created if needed.
+        :param max_bytes: size cap enforced by evict().
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, charge_dir, ddec_version):
+        name = hashlib.sha1(f'{os.path.abspath(charge_dir)}:{ddec_version}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{name}.ddec')
+
+    def read(self, charge_dir='.', ddec_version=6):
+        """Drop-in replacement for read_ddec which goes through the cache."""
+
+        sources = [os.path.join(charge_dir, charge_file_name(ddec_version)), os.path.join(charge_dir, VOLUME_FILE_NAME)]
+        try:
+            stats = tuple(value for source in map(os.stat, sources) for value in (source.st_size, source.st_mtime_ns))
+        except FileNotFoundError:
+            # Let read_ddec raise its usual (more helpful) error.
+            return read_ddec(charge_dir, ddec_version)
+
+        cache_path = self.path(charge_dir, ddec_version)
+        entry = self.get(cache_path)
+        digest = None
+        if entry is not None:
+            ddec_data, cached_stats, cached_digest = entry
+            if stats == cached_stats:
+                # Touch so eviction sees this entry as recently used.
+                os.utime(cache_path)
+                return ddec_data
+            digest = hash_files(sources)
+            if digest == cached_digest:
+                self.put(cache_path, ddec_data, stats, digest)
+                return ddec_data
+
+        ddec_data = read_ddec(charge_dir, ddec_version)
+        self.put(cache_path, ddec_data, stats, digest or hash_files(sources))
+        return ddec_data
+
+    @staticmethod
+    def get(cache_path):
+        """Load an entry; returns (ddec_data, stats, digest) or None if it is missing, stale or corrupt."""
+
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                blob = cache_file.read()
+            magic, version, atom_total, *stats, digest = HEADER.unpack_from(blob)
+        except (FileNotFoundError, struct.error):
+            return None
+        if magic != MAGIC or version != CACHE_VERSION or len(blob) != HEADER.size + atom_total * DDEC_DTYPE.itemsize:
+            return None
+        ddec_data = np.frombuffer(blob, dtype=DDEC_DTYPE, offset=HEADER.size).copy()
+        return ddec_data, tuple(stats), digest.decode()
+
+    @staticmethod
+    def put(cache_path, ddec_data, stats, digest):
+        # Write then rename so an interrupted run (or a parallel worker) never sees a partial entry.
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(HEADER.pack(MAGIC, CACHE_VERSION, len(ddec_data), *stats, digest.encode()))
+            cache_file.write(np.ascontiguousarray(ddec_data, dtype=DDEC_DTYPE).tobytes())
+        os.replace(tmp_path, cache_path)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+
+        entries = []
+        with os.scandir(self.cache_dir) as scan:
+            for entry in scan:
+                if entry.name.endswith('.ddec'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
@@ -0,0 +1,228 @@
+"""
+Streaming parser for ForceBalance's optimise.out.
+
+The log is read one line at a time and turned into typed records, so memory use does not grow with its length:
+    Iteration: start of an objective function evaluation (reevaluation=True when a rejected step is re-evaluated)
+    Simulation: MD launched for a target, with its equilibration and production step counts
+    PropertyResult: one row of a target's Density / Enthalpy of Vaporization table
+    ObjectiveTerm: one row of the Objective Function Breakdown (each target, Regularization and Total)
+    Step: the row of the step table (|k|, |dk|, |grad|, objective, change and step quality)
+    ParameterValue: one parameter of the Total Gradient, the Mathematical or Physical (Current + Step = Next) blocks,
+        or the final optimisation / physical parameters
+    FinalObjective: the converged full and un-penalised objective function
+Every record (bar FinalObjective) carries the iteration it belongs to; a re-evaluation counts as a new iteration,
+matching the numbering of the step table.
+
+    for record in read_optimise_out('runs/training/model0/optimise.out'):
+        if isinstance(record, PropertyResult):
+            ...
+
+OptimiseOutFollower does the same for a run which is still going, reading only what has been appended since it last looked.
+"""
+
+from collections import namedtuple
+import os
+import re
+
+
+Iteration = namedtuple('Iteration', 'iteration reevaluation')
+Simulation = namedtuple('Simulation', 'iteration target eq_steps md_steps')
+PropertyResult = namedtuple(
+    'PropertyResult',
+    'iteration target quantity units temperature pressure reference calculated stdev delta weight term',
+)
+ObjectiveTerm = namedtuple('ObjectiveTerm', 'iteration name residual weight contribution change')
+Step = namedtuple('Step', 'iteration step k dk grad objective delta quality')
+ParameterValue = namedtuple('ParameterValue', 'iteration block index name value step next')
+FinalObjective = namedtuple('FinalObjective', 'objective unpenalized')
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
+ITERATION = re.compile(r'Iteration (\d+):')
+TARGET = re.compile(r'Target: (\S+) - launching MD simulations')
+TIME_STEPS = re.compile(r'Time steps: (\d+) \(eq\) \+ (\d+) \(md\)')
+PROPERTY_TITLE = re.compile(r'(\S+) (.+?) \((.+)\)')
+FINAL_OBJECTIVE = re.compile(r'Full:\s+(\S+)\s+Un-penalized:\s+(\S+)')
+
+# 298.15      1.0 atm   787.000      837.203 +- 0.507    50.203   1.00000   2.80039
+PROPERTY_ROW = re.compile(r'(\S+)\s+(\S+)\s+\S+\s+(\S+)\s+(\S+)\s+\+-\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)')
+# mol01_liquid   11.08575   0.067   7.39050e-01 ( +1.722e-01 ), or Total   3.46471e+00 ( -1.466e+00 )
+OBJECTIVE_ROW = re.compile(r'(\S+)\s+(?:(\S+)\s+(\S+)\s+)?(\S+)(?:\s+\(\s*(\S+)\s*\))?')
+# 1   1.255e-01   1.255e-01   1.398e+01   3.46471e+00  -1.466e+00      0.772
+STEP_ROW = re.compile(r'(\d+)' + r'\s+(\S+)' * 6)
+# 0 [ -2.1698e-02 - 1.0421e-02 = -3.2118e-02 ] : CElement/cfree, or 0 [  1.0375e+01 ] : CElement/cfree
+PARAMETER_ROW = re.compile(r'(\d+) \[\s*(\S+)(?:\s+([-+])\s+(\S+)\s+=\s+(\S+))?\s*\] : (\S+)')
+
+# Boxed headers which start a block of ParameterValue rows, and the block name given to those rows.
+PARAMETER_BLOCKS = {
+    'Total Gradient': 'gradient',
+    'Mathematical Parameters': 'mathematical',
+    'Physical Parameters': 'physical',
+    'Final optimization parameters': 'final mathematical',
+    'Final physical parameters': 'final physical',
+}
+
+
+class OptimiseOutParser:
+    """
+    Line-at-a-time state machine; feed it the lines of optimise.out in order (possibly across several reads
+    of a growing file) and it yields each record as soon as its line has been seen.
+    """
+
+    def __init__(self):
+        self.iteration = None
+        self.target = None
+        # Which table the following rows belong to: 'property', 'objective', 'step', a parameter block or None.
+        self.table = None
+        self.block = None
+        self.last_box = ''
+        self.property = None
+
+    def feed(self, line):
+        """
+        Parse one line of the log.
+        :return: generator of the records completed by this line (usually none)
+        """
+
+        line = ANSI_ESCAPE.sub('', line).strip()
+        if line.startswith('#|'):
+            yield from self.box(line.strip('#| '))
+        elif line.startswith('---'):
+            self.table = None
+        elif line.startswith('Step') and '|k|' in line:
+            self.table = 'step'
+        elif self.table is not None and line and not line.startswith('#='):
+            yield from self.row(line)
+
+    def box(self, text):
+        """Handle the text of a #| ... |# header line."""
+
+        match = ITERATION.match(text)
+        if match is not None:
+            self.iteration, self.table = int(match.group(1)), None
+            yield Iteration(self.iteration, False)
+        elif text.startswith('Re-evaluating at the previous point'):
+            # None if following started part way through the log.
+            self.iteration, self.table = None if self.iteration is None else self.iteration + 1, None
+            yield Iteration(self.iteration, True)
+        elif text.startswith('Target:'):
+            match = TARGET.match(text)
+            self.target = match and match.group(1)
+        elif text.startswith('Time steps:'):
+            match = TIME_STEPS.match(text)
+            if match is not None:
+                yield Simulation(self.iteration, self.target, int(match.group(1)), int(match.group(2)))
+        elif text.startswith('Temperature') and 'Reference' in text:
+            # Column headers of a property table; its title (e.g. mol01_liquid Density (kg m^-3)) was the previous box.
+            match = PROPERTY_TITLE.fullmatch(self.last_box)
+            if match is not None:
+                self.property, self.table = match.groups(), 'property'
+        elif text.startswith('Target Name'):
+            # Column headers of the Objective Function Breakdown.
+            pass
+        elif text.startswith('Objective Function Breakdown'):
+            self.table = 'objective'
+        elif text.startswith('Full:'):
+            match = FINAL_OBJECTIVE.match(text)
+            if match is not None:
+                yield FinalObjective(float(match.group(1)), float(match.group(2)))
+        else:
+            for header, block in PARAMETER_BLOCKS.items():
+                if text.startswith(header):
+                    self.table, self.block = 'parameters', block
+                    break
+            else:
+                self.table = None
+        self.last_box = text
+
+    def row(self, line):
+        """Handle a data line of the current table."""
+
+        if self.table == 'property':
+            match = PROPERTY_ROW.fullmatch(line)
+            if match is not None:
+                yield PropertyResult(self.iteration, *self.property, *map(float, match.groups()))
+
+        elif self.table == 'objective':
+            match = OBJECTIVE_ROW.fullmatch(line)
+            if match is not None:
+                name, *values = match.groups()
+                yield ObjectiveTerm(self.iteration, name, *(None if value is None else float(value) for value in values))
+
+        elif self.table == 'step':
+            match = STEP_ROW.fullmatch(line)
+            if match is not None:
+                step, *values = match.groups()
+                self.table = None
+                yield Step(self.iteration, int(step), *map(float, values))
+
+        elif self.table == 'parameters':
+            match = PARAMETER_ROW.fullmatch(line)
+            if match is not None:
+                index, value, sign, step, next_value, name = match.groups()
+                if step is None:
+                    yield ParameterValue(self.iteration, self.block, int(index), name, float(value), None, None)
+                else:
+                    step = -float(step) if sign == '-' else float(step)
+                    yield ParameterValue(
+                        self.iteration, self.block, int(index), name, float(value), step, float(next_value),
+                    )
+
+
+def parse_optimise_out(lines):
+    """
+    Parse an iterable of optimise.out lines, e.g. an open file.
+    :return: generator of records, in the order they appear in the log
+    """
+
+    parser = OptimiseOutParser()
+    for line in lines:
+        yield from parser.feed(line)
+
+
+def read_optimise_out(file_path='optimise.out'):
+    """Stream the records of an optimise.out file; the file is read a line at a time."""
+
+    with open(file_path) as opt_file:
+        yield from parse_optimise_out(opt_file)
+
+
+class OptimiseOutFollower:
+    """
+    Poll-based tail of a (possibly still growing) optimise.out.
+    Only bytes appended since the last poll are read; an unfinished last line is kept until it is completed.
+    """
+
+    def __init__(self, file_path='optimise.out', offset=0):
+        """
+        :param file_path: log to follow; it does not need to exist yet.
+        :param offset: byte offset to start reading from, e.g. 0 to parse the whole log first.
+        """
+        self.file_path = file_path
+        self.offset = offset
+        self.partial = b''
+        self.parser = OptimiseOutParser()
+
+    def poll(self):
+        """
+        Parse whatever has been appended since the last call.
+        :return: list of the new records; empty (without opening the file) when its size has not changed
+        """
+
+        try:
+            size = os.stat(self.file_path).st_size
+        except FileNotFoundError:
+            return []
+        if size < self.offset:
+            # Truncated or replaced (e.g. the run was restarted); start again from the top.
+            self.offset, self.partial, self.parser = 0, b'', OptimiseOutParser()
+        if size == self.offset:
+            return []
+
+        with open(self.file_path, 'rb') as opt_file:
+            opt_file.seek(self.offset)
+            data = opt_file.read(size - self.offset)
+        self.offset += len(data)
+
+        *lines, self.partial = (self.partial + data).split(b'\n')
+        return [record for line in lines for record in self.parser.feed(line.decode(errors='replace'))]
@@ -0,0 +1,466 @@
+"""
+Consistency checks of a combined.xml against the ForceBalance targets and the per-molecule QUBEKit xmls.
+
+Renumbering or v-site mistakes in combining only show up when OpenMM fails to match a residue, hours into a run;
+this finds them first. combined.xml is streamed one element at a time into dicts keyed by type, class and residue,
+and every check is then a lookup, so the whole run is linear in the number of atoms. Every mismatch is reported:
+    forcefield  types and classes defined once, residue atoms of known types with unique names,
+                bonds and VirtualSites pointing at atoms of their residue, each molecule's ids inside its own block,
+                force classes defined, exactly one NonbondedForce Atom per type
+    targets     gas.pdb holds the real (non v-site) atoms of its residue, element for element,
+                and liquid.pdb a whole number of copies of them
+    sources     each residue has the atoms, elements, v-sites and bonds of <source_dir>/<name>/<name>.xml,
+                with its ids offset by the atoms written before it
+
+Forcefields hard-wrapped to a fixed width (as example_fb_run/forcefield/combined.xml is) are unwrapped to be read,
+and reported, since OpenMM cannot read them.
+
+    issues = check_consistency('example_fb_run/forcefield/combined.xml', 'example_fb_run/targets',
+                               'runs/training/model5a')
+    print(format_issues(issues))
+"""
+
+from collections import Counter, namedtuple
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from liquid_box import element_of
+from pdb_reader import read_targets
+from renumber import parse_id
+from target_tree import TARGET_SUFFIX
+
+
+# location: file (and element) the mismatch is in; kind: short name of the check, e.g. 'bond'.
+Issue = namedtuple('Issue', 'location kind message')
+# atoms: [(name, type)] in order; bonds: [(from, to)] as written; virtual_sites: [attrib dict]
+ResidueTemplate = namedtuple('ResidueTemplate', 'atoms bonds virtual_sites')
+# types: name: (class, element), element None for v-sites; force_classes: [(section, tag, [class, ...])];
+# nonbonded: Counter of NonbondedForce Atom types; wrapped: number of lines joined back onto the one before.
+ForcefieldIndex = namedtuple('ForcefieldIndex', 'path types residues force_classes nonbonded wrapped issues')
+
+FORCE_SECTIONS = ('HarmonicBondForce', 'HarmonicAngleForce', 'PeriodicTorsionForce')
+VIRTUAL_SITE_ATOMS = ('atom1', 'atom2', 'atom3', 'atom4')
+PDB_KINDS = ('gas', 'liquid')
+READ_SIZE = 1 << 16
+
+
+def wrap_width(xml_path):
+    """Longest line of a file, without its line ending."""
+
+    with open(xml_path) as xml_file:
+        return max((len(line.rstrip('\r\n')) for line in xml_file), default=0)
+
+
+def unwrapped_lines(xml_file, width):
+    """
+    Lines of an xml with each line that does not start a tag joined back onto the one before.
+    Lines cut exactly at width are joined as they are; shorter ones lost a trailing space at the cut, which is restored.
+    :return: generator of (line, number of lines joined into it)
+    """
+
+    line, joined = None, 0
+    for physical in xml_file:
+        physical = physical.rstrip('\r\n')
+        if line is not None and physical and not physical.lstrip().startswith('<'):
+            line += physical if len(line) % width == 0 else f' {physical}'
+            joined += 1
+            continue
+        if line is not None:
+            yield line, joined
+        line, joined = physical, 0
+    if line is not None:
+        yield line, joined
+
+
+def iter_forcefield(xml_path, counter=None):
+    """
+    Stream the children of each top-level section of a forcefield xml, e.g. ('Residues', <Residue>).
+    Each element is dropped from the tree once the caller moves on, so memory does not grow with the file.
+    :param counter: list whose first item is increased by the number of wrapped lines joined back together
+    :return: generator of (section tag, element)
+    """
+
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    width = wrap_width(xml_path)
+    depth, sections = 0, []
+    with open(xml_path) as xml_file:
+        lines = unwrapped_lines(xml_file, width)
+        while True:
+            chunk, size = [], 0
+            for line, joined in lines:
+                chunk.append(f'{line}\n')
+                size += len(line)
+                if counter is not None:
+                    counter[0] += joined
+                if size >= READ_SIZE:
+                    break
+            if not chunk:
+                break
+            parser.feed(''.join(chunk))
+            for event, element in parser.read_events():
+                if event == 'start':
+                    depth += 1
+                    if depth == 2:
+                        sections.append(element)
+                    continue
+                depth -= 1
+                if depth == 2:
+                    yield sections[-1].tag, element
+                    sections[-1].remove(element)
+        parser.close()
+
+
+def _residue_template(residue):
+    atoms, bonds, virtual_sites = [], [], []
+    for child in residue:
+        if child.tag == 'Atom':
+            atoms.append((child.get('name'), child.get('type')))
+        elif child.tag == 'Bond':
+            bonds.append((child.get('from'), child.get('to')))
+        elif child.tag == 'VirtualSite':
+            virtual_sites.append(dict(child.attrib))
+    return ResidueTemplate(atoms, bonds, virtual_sites)
+
+
+def index_forcefield(xml_path):
+    """
+    Read a combined.xml, in one streamed pass, into a ForcefieldIndex.
+    Duplicate types, classes and residues are recorded in its issues; the first definition is the one kept.
+    """
+
+    types, classes, residues, nonbonded = {}, {}, {}, Counter()
+    force_classes, issues, counter = [], [], [0]
+    for section, element in iter_forcefield(xml_path, counter):
+        if section == 'AtomTypes':
+            name, atom_class = element.get('name'), element.get('class')
+            if name in types:
+                issues.append(Issue(f'{xml_path}:AtomTypes', 'duplicate-type', f'Type {name} is defined twice.'))
+                continue
+            if atom_class in classes:
+                issues.append(Issue(
+                    f'{xml_path}:AtomTypes', 'duplicate-class',
+                    f'Types {classes[atom_class]} and {name} share class {atom_class}.',
+                ))
+            else:
+                classes[atom_class] = name
+            types[name] = (atom_class, element.get('element'))
+        elif section == 'Residues':
+            name = element.get('name')
+            if name in residues:
+                issues.append(Issue(f'{xml_path}:Residues', 'duplicate-residue', f'Residue {name} is defined twice.'))
+                continue
+            residues[name] = _residue_template(element)
+        elif section in FORCE_SECTIONS:
+            atom_classes = [element.get(f'class{number}') for number in range(1, 5)]
+            force_classes.append((section, element.tag, [atom_class for atom_class in atom_classes if atom_class]))
+        elif section == 'NonbondedForce' and element.tag == 'Atom':
+            nonbonded[element.get('type')] += 1
+
+    if counter[0]:
+        issues.append(Issue(
+            xml_path, 'wrapped',
+            f'{counter[0]} lines are wrapped onto the next line, so OpenMM and ForceBalance cannot read this file.',
+        ))
+    return ForcefieldIndex(xml_path, types, residues, force_classes, nonbonded, counter[0], issues)
+
+
+def _parse_index(value, atoms):
+    """Atom index written as value, if it is an integer within range(atoms); else None."""
+
+    try:
+        index = int(value)
+    except (TypeError, ValueError):
+        return None
+    return index if 0 <= index < atoms else None
+
+
+def _id_numbers(ids):
+    numbers = []
+    for atom_id in ids:
+        try:
+            numbers.append(parse_id(atom_id).number)
+        except (TypeError, ValueError):
+            pass
+    return numbers
+
+
+def check_residue(index, name, template, offset):
+    """
+    Check one residue of a ForcefieldIndex on its own.
+    :param offset: atoms written before this residue; its ids should all lie in [offset, offset + atoms)
+    :return: list of Issue
+    """
+
+    location = f'{index.path}:Residue {name}'
+    issues = []
+    atoms = len(template.atoms)
+    virtual_atoms = _virtual_atoms(index, template)
+    for atom_name, atom_type in template.atoms:
+        if atom_type not in index.types:
+            issues.append(Issue(location, 'unknown-type', f'Atom {atom_name} has type {atom_type}, not in AtomTypes.'))
+    for atom_name, count in Counter(atom_name for atom_name, _ in template.atoms).items():
+        if count > 1:
+            issues.append(Issue(location, 'duplicate-atom', f'{count} atoms are named {atom_name}.'))
+
+    outside = [
+        number for number in _id_numbers([atom_id for atom in template.atoms for atom_id in atom])
+        if not offset <= number < offset + atoms
+    ]
+    if outside:
+        issues.append(Issue(
+            location, 'renumbering',
+            f'Ids numbered {sorted(set(outside))} lie outside this residue\'s block {offset}-{offset + atoms - 1}.',
+        ))
+
+    seen = set()
+    for first, second in template.bonds:
+        bond = (_parse_index(first, atoms), _parse_index(second, atoms))
+        if None in bond:
+            issues.append(Issue(location, 'bond', f'Bond {first}-{second} is not between atoms 0-{atoms - 1}.'))
+        elif bond[0] == bond[1]:
+            issues.append(Issue(location, 'bond', f'Bond {first}-{second} joins an atom to itself.'))
+        elif bond[0] in virtual_atoms or bond[1] in virtual_atoms:
+            issues.append(Issue(location, 'bond', f'Bond {first}-{second} is to a virtual site.'))
+        elif frozenset(bond) in seen:
+            issues.append(Issue(location, 'bond', f'Bond {first}-{second} is written twice.'))
+        seen.add(frozenset(bond))
+
+    placed = Counter()
+    for site in template.virtual_sites:
+        site_index = _parse_index(site.get('index'), atoms)
+        if site_index is None or site_index not in virtual_atoms:
+            issues.append(Issue(
+                location, 'virtual-site', f'VirtualSite index {site.get("index")} is not one of the v-site atoms.',
+            ))
+        else:
+            placed[site_index] += 1
+        for key in VIRTUAL_SITE_ATOMS:
+            if key not in site:
+                continue
+            parent = _parse_index(site[key], atoms)
+            if parent is None or parent in virtual_atoms:
+                issues.append(Issue(
+                    location, 'virtual-site',
+                    f'VirtualSite {site.get("index")} has {key}={site[key]}, not a real atom of this residue.',
+                ))
+    for site_index in sorted(virtual_atoms):
+        if placed[site_index] != 1:
+            issues.append(Issue(
+                location, 'virtual-site',
+                f'Atom {template.atoms[site_index][0]} is a v-site placed by {placed[site_index]} VirtualSites.',
+            ))
+    return issues
+
+
+def _virtual_atoms(index, template):
+    """Positions in a residue of the atoms whose type has no element."""
+
+    return {
+        position for position, (_, atom_type) in enumerate(template.atoms)
+        if atom_type in index.types and index.types[atom_type][1] is None
+    }
+
+
+def check_forcefield(index):
+    """Check a ForcefieldIndex on its own: residues, force classes and NonbondedForce coverage."""
+
+    issues = list(index.issues)
+    offset, used = 0, set()
+    for name, template in index.residues.items():
+        issues.extend(check_residue(index, name, template, offset))
+        offset += len(template.atoms)
+        used.update(atom_type for _, atom_type in template.atoms)
+
+    for atom_type in index.types:
+        if atom_type not in used:
+            issues.append(Issue(f'{index.path}:AtomTypes', 'unused-type', f'Type {atom_type} is in no residue.'))
+
+    defined = {atom_class for atom_class, _ in index.types.values()}
+    for section, tag, atom_classes in index.force_classes:
+        unknown = [atom_class for atom_class in atom_classes if atom_class not in defined]
+        if unknown:
+            issues.append(Issue(
+                f'{index.path}:{section}', 'unknown-class',
+                f'{tag} {"-".join(atom_classes)} uses undefined classes {", ".join(unknown)}.',
+            ))
+
+    for atom_type in index.types:
+        count = index.nonbonded[atom_type]
+        if count != 1:
+            issues.append(Issue(
+                f'{index.path}:NonbondedForce', 'nonbonded', f'Type {atom_type} has {count} NonbondedForce Atoms.',
+            ))
+    for atom_type in index.nonbonded:
+        if atom_type not in index.types:
+            issues.append(Issue(
+                f'{index.path}:NonbondedForce', 'nonbonded', f'Atom for type {atom_type}, which is not in AtomTypes.',
+            ))
+    return issues
+
+
+def residue_elements(index, template):
+    """Elements of a residue's real atoms, in order, as the pdbs should hold them."""
+
+    elements = [index.types[atom_type][1] if atom_type in index.types else '?' for _, atom_type in template.atoms]
+    return [element for element in elements if element is not None]
+
+
+def _first_difference(expected, found):
+    for position, (first, second) in enumerate(zip(expected, found)):
+        if first != second:
+            return position, first, second
+    return None
+
+
+def check_targets(index, targets_dir):
+    """
+    Check the gas.pdb and liquid.pdb of every target in targets_dir (all read in one batch) against the residue
+    named after the target, e.g. mol13_liquid against mol13.
+    """
+
+    issues = []
+    for target, structures in read_targets(targets_dir).items():
+        name = target[:-len(TARGET_SUFFIX)] if target.endswith(TARGET_SUFFIX) else target
+        if name not in index.residues:
+            issues.append(Issue(
+                os.path.join(targets_dir, target), 'missing-residue', f'No residue {name} in {index.path}.',
+            ))
+            continue
+        expected = np.array(residue_elements(index, index.residues[name]))
+        for kind in PDB_KINDS:
+            if kind not in structures:
+                continue
+            location = os.path.join(targets_dir, target, f'{kind}.pdb')
+            structure = structures[kind]
+            found = np.array([
+                element_of(atom_name, element) for atom_name, element in zip(structure.names, structure.elements)
+            ])
+            if not len(expected) or len(found) % len(expected) or (kind == 'gas' and len(found) != len(expected)):
+                issues.append(Issue(
+                    location, 'atoms', f'{len(found)} atoms, for residue {name} of {len(expected)} real atoms.',
+                ))
+                continue
+            molecules = found.reshape(-1, len(expected))
+            wrong = np.flatnonzero(np.any(molecules != expected, axis=1))
+            if len(wrong):
+                position, first, second = _first_difference(expected, molecules[wrong[0]])
+                issues.append(Issue(
+                    location, 'elements',
+                    f'{len(wrong)} of {len(molecules)} molecules differ from residue {name}; the first, molecule '
+                    f'{wrong[0] + 1}, has {second} for {first} at atom {position + 1}.',
+                ))
+    return issues
+
+
+def source_xml(source_dir, name):
+    """A molecule's QUBEKit xml in a model (or collect) directory: <name>/<name>.xml or <name>.xml; else None."""
+
+    for file_path in (os.path.join(source_dir, name, f'{name}.xml'), os.path.join(source_dir, f'{name}.xml')):
+        if os.path.isfile(file_path):
+            return file_path
+    return None
+
+
+def check_sources(index, source_dir):
+    """
+    Check every residue against the QUBEKit xml it was combined from: the same atoms, elements, v-sites and bonds,
+    with each id offset by the atoms of the residues before it.
+    """
+
+    issues, offset = [], 0
+    for name, template in index.residues.items():
+        atoms = len(template.atoms)
+        xml_path = source_xml(source_dir, name)
+        location = f'{index.path}:Residue {name}'
+        if xml_path is None:
+            issues.append(Issue(location, 'missing-source', f'No {name}.xml in {source_dir}.'))
+            offset += atoms
+            continue
+
+        root = ET.parse(xml_path).getroot()
+        source_types = [(atom.get('name'), atom.get('element')) for atom in root.iterfind('AtomTypes/Type')]
+        source_bonds = {
+            frozenset((bond.get('from'), bond.get('to'))) for bond in root.iterfind('Residues/Residue/Bond')
+        }
+        source_sites = len(root.findall('Residues/Residue/VirtualSite'))
+        if len(source_types) != atoms:
+            issues.append(Issue(
+                location, 'source-atoms', f'{atoms} atoms, but {len(source_types)} (with v-sites) in {xml_path}.',
+            ))
+        else:
+            elements = [index.types.get(atom_type, (None, '?'))[1] for _, atom_type in template.atoms]
+            difference = _first_difference([element for _, element in source_types], elements)
+            if difference is not None:
+                position, first, second = difference
+                issues.append(Issue(
+                    location, 'source-elements', f'Atom {position} is {second}, but {first} in {xml_path}.',
+                ))
+            shifted = [
+                (atom_type, source_type) for (_, atom_type), (source_type, _) in zip(template.atoms, source_types)
+                if not _offset_by(atom_type, source_type, offset)
+            ]
+            if shifted:
+                atom_type, source_type = shifted[0]
+                issues.append(Issue(
+                    location, 'renumbering',
+                    f'{len(shifted)} types are not offset by {offset} from {xml_path}, e.g. {atom_type} for '
+                    f'{source_type}.',
+                ))
+        if len(template.virtual_sites) != source_sites:
+            issues.append(Issue(
+                location, 'source-virtual-sites',
+                f'{len(template.virtual_sites)} VirtualSites, but {source_sites} in {xml_path}.',
+            ))
+        bonds = {frozenset(bond) for bond in template.bonds}
+        if bonds != source_bonds:
+            issues.append(Issue(
+                location, 'source-bonds',
+                f'{len(bonds - source_bonds)} bonds not in {xml_path}, and {len(source_bonds - bonds)} missing.',
+            ))
+        offset += atoms
+    return issues
+
+
+def _offset_by(combined_id, source_id, offset):
+    try:
+        combined, source = parse_id(combined_id), parse_id(source_id)
+    except (TypeError, ValueError):
+        return False
+    return combined.prefix == source.prefix and combined.number == source.number + offset
+
+
+def check_consistency(xml_path, targets_dir=None, source_dir=None):
+    """
+    Run every check of a combined.xml, and of its targets and source xmls where given.
+    :param targets_dir: ForceBalance targets directory, e.g. example_fb_run/targets
+    :param source_dir: QUBEKit model directory the forcefield was combined from, e.g. runs/training/model5a
+    :return: list of Issue, forcefield first, then targets, then sources; a missing file or directory is one Issue
+    """
+
+    if not os.path.isfile(xml_path):
+        return [Issue(xml_path, 'missing-forcefield', f'No forcefield at {xml_path}.')]
+    index = index_forcefield(xml_path)
+    issues = check_forcefield(index)
+    if targets_dir is not None:
+        if os.path.isdir(targets_dir):
+            issues.extend(check_targets(index, targets_dir))
+        else:
+            issues.append(Issue(targets_dir, 'missing-targets', f'No targets directory at {targets_dir}.'))
+    if source_dir is not None:
+        if os.path.isdir(source_dir):
+            issues.extend(check_sources(index, source_dir))
+        else:
+            issues.append(Issue(source_dir, 'missing-sources', f'No source directory at {source_dir}.'))
+    return issues
+
+
+def format_issues(issues):
+    """One line per Issue, then a count of each kind."""
+
+    lines = [f'{issue.location}: [{issue.kind}] {issue.message}' for issue in issues]
+    counts = Counter(issue.kind for issue in issues)
+    summary = ', '.join(f'{count} {kind}' for kind, count in sorted(counts.items()))
+    lines.append(f'{len(issues)} issues' + (f' ({summary})' if summary else ''))
+    return '\n'.join(lines)
@@ -0,0 +1,77 @@
+"""
+On-disk cache of rendered combined.xml fragments.
+
+Each molecule's fragment (its AtomTypes, Residue, force and NonbondedForce entries, numbered from zero)
+is stored as json, keyed by a hash of the files it was rendered from.
+Rebuilding combined.xml then only has to re-render molecules whose QUBEKit or Chargemol outputs changed.
+"""
+
+import hashlib
+import json
+import os
+
+
+def hash_files(file_paths, salt=''):
+    """
+    Hash the contents of several files (in the given order) into one hex digest.
+    :param file_paths: iterable of paths; None entries are skipped
+    :param salt: extra text mixed into the hash e.g. a format version
+    """
+
+    digest = hashlib.sha256(salt.encode())
+    for file_path in file_paths:
+        if file_path is None:
+            continue
+        digest.update(os.path.basename(file_path).encode())
+        with open(file_path, 'rb') as source:
+            for block in iter(lambda: source.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def model_cache_dir(model_dir, cache_dir):
+    """
+    Where the fragments of the molecules in model_dir are cached.
+    A relative cache_dir is inside model_dir; an absolute one may be shared by several models,
+    so each model gets its own subdirectory, named by a hash of its path, and one model's prune never
+    removes another's entries.
+    """
+
+    if not os.path.isabs(cache_dir):
+        return os.path.join(model_dir, cache_dir)
+    model_key = hashlib.sha256(os.path.abspath(model_dir).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, 'fragments', model_key)
+
+
+class FragmentCache:
+    """One json file per molecule, <cache_dir>/<mol_name>.json, containing the source hash and the fragment."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, mol_name):
+        return os.path.join(self.cache_dir, f'{mol_name}.json')
+
+    def get(self, mol_name, key):
+        """Return the cached fragment for mol_name if it was rendered from sources hashing to key, else None."""
+        try:
+            with open(self.path(mol_name)) as cache_file:
+                entry = json.load(cache_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return entry['fragment'] if entry.get('key') == key else None
+
+    def put(self, mol_name, key, fragment):
+        # Write then rename so an interrupted run never leaves a truncated entry behind.
+        tmp_path = f'{self.path(mol_name)}.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump({'key': key, 'fragment': fragment}, cache_file, separators=(',', ':'))
+        os.replace(tmp_path, self.path(mol_name))
+
+    def prune(self, mol_names):
+        """Remove entries for molecules which are no longer present."""
+        keep = {f'{mol_name}.json' for mol_name in mol_names}
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.json') and file not in keep:
+                os.remove(os.path.join(self.cache_dir, file))
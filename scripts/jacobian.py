@@ -0,0 +1,118 @@
+"""
+Exact derivatives of every atom's sigma and epsilon with respect to the Rfree, xalpha and xbeta parameters.
+
+With the terms of rfree.py,
+    epsilon = prefactor * alpha * bfree * ratio ** exponent / (128 * rfree ** 6) * epsilon_scale
+    sigma = 2 ** (5 / 6) * ratio ** (1 / 3) * rfree * sigma_scale
+so
+    d epsilon / d rfree = -6 * epsilon / rfree
+    d epsilon / d alpha = epsilon / alpha
+    d epsilon / d beta = epsilon * ln(ratio)
+    d sigma / d rfree = sigma / rfree
+Each atom depends on at most three parameters, so the (atoms, parameters) matrices are stored sparsely
+as SparseJacobian (COO) triplets; to_dense expands them.
+Derivatives are computed from the parameter-free factors rather than by dividing, so they stay exact at alpha = 0.
+"""
+
+from collections import namedtuple
+import os
+
+import numpy as np
+
+from rfree import evaluate
+
+
+SparseJacobian = namedtuple('SparseJacobian', 'rows cols values shape')
+
+JACOBIAN_FILE_NAME = 'combined_jacobian.npz'
+
+
+def jacobian(terms, parameters=None):
+    """
+    d sigma / d parameters and d epsilon / d parameters of every atom.
+    :param terms: RfreeTerms from rfree.compile_forcefield
+    :param parameters: parameter vector to differentiate at; the initial values by default.
+    :return: sigma, epsilon SparseJacobians of shape (number of atoms, number of parameters)
+    """
+
+    parameters = terms.initial if parameters is None else np.asarray(parameters, dtype=float)
+    sigma, epsilon = evaluate(terms, parameters)
+
+    atoms = np.arange(len(terms.types))
+    rfree = parameters[terms.free_index]
+    uses_alpha = terms.alpha_index >= 0
+    uses_beta = terms.beta_index >= 0
+    alpha = np.where(uses_alpha, parameters[terms.alpha_index], 1.0)
+    exponent = np.where(uses_beta, parameters[terms.beta_index], terms.exponent)
+    ratio = terms.volume / terms.vfree
+
+    # epsilon without its alpha factor, and sigma without its rfree factor.
+    epsilon_per_alpha = (terms.prefactor * terms.bfree * ratio ** exponent) / (128 * rfree ** 6) * terms.epsilon_scale
+    sigma_per_rfree = 2 ** (5 / 6) * ratio ** (1 / 3) * terms.sigma_scale
+
+    shape = (len(atoms), len(terms.parameter_names))
+    sigma_jacobian = SparseJacobian(atoms, terms.free_index.copy(), sigma_per_rfree, shape)
+    epsilon_jacobian = SparseJacobian(
+        np.concatenate((atoms, atoms[uses_alpha], atoms[uses_beta])),
+        np.concatenate((terms.free_index, terms.alpha_index[uses_alpha], terms.beta_index[uses_beta])),
+        np.concatenate((-6 * epsilon / rfree, epsilon_per_alpha[uses_alpha], (epsilon * np.log(ratio))[uses_beta])),
+        shape,
+    )
+    return sigma_jacobian, epsilon_jacobian
+
+
+def to_dense(sparse):
+    """Expand a SparseJacobian into an (atoms, parameters) array."""
+
+    dense = np.zeros(sparse.shape)
+    np.add.at(dense, (sparse.rows, sparse.cols), sparse.values)
+    return dense
+
+
+def save_jacobian(path, terms, parameters=None, dense=False):
+    """
+    Save the Jacobians of a forcefield to an npz, with the atom types and parameter names needed to read them.
+    Sparse files hold <sigma|epsilon>_rows, _cols, _values and _shape; dense ones hold sigma and epsilon arrays.
+    :param path: where to write, e.g. next to combined.xml as combined_jacobian.npz
+    :param dense: store dense (atoms, parameters) arrays rather than the COO triplets.
+    """
+
+    parameters = terms.initial if parameters is None else np.asarray(parameters, dtype=float)
+    arrays = dict(types=np.array(terms.types), parameter_names=np.array(terms.parameter_names), parameters=parameters)
+    for name, sparse in zip(('sigma', 'epsilon'), jacobian(terms, parameters)):
+        if dense:
+            arrays[name] = to_dense(sparse)
+        else:
+            arrays.update({
+                f'{name}_rows': sparse.rows, f'{name}_cols': sparse.cols,
+                f'{name}_values': sparse.values, f'{name}_shape': np.array(sparse.shape),
+            })
+    np.savez_compressed(path, **arrays)
+
+
+def load_jacobian(path):
+    """
+    Read a file written by save_jacobian.
+    :return: dict of types, parameter_names, parameters and the sigma and epsilon Jacobians,
+        as arrays or SparseJacobians depending on how they were saved
+    """
+
+    with np.load(path) as data:
+        loaded = dict(
+            types=data['types'].tolist(), parameter_names=data['parameter_names'].tolist(),
+            parameters=data['parameters'],
+        )
+        for name in ('sigma', 'epsilon'):
+            if name in data:
+                loaded[name] = data[name]
+            else:
+                loaded[name] = SparseJacobian(
+                    data[f'{name}_rows'], data[f'{name}_cols'], data[f'{name}_values'],
+                    tuple(data[f'{name}_shape'].tolist()),
+                )
+    return loaded
+
+
+def default_path(xml_path):
+    """combined_jacobian.npz in the same directory as xml_path."""
+    return os.path.join(os.path.dirname(xml_path), JACOBIAN_FILE_NAME)
@@ -0,0 +1,341 @@
+"""
+Density and Hvap errors of every model under runs/, side by side.
+
+Experimental values are read from the reference tables in input_files (molecule,density,hvap,temp in kg/m^3 and kJ/mol)
+and joined to each model's results on the molecule name,
+so neither the order of the outputs nor missing molecules matter.
+Every model of a group (runs/training, runs/test) is scored against that group's table in one set of array operations:
+    n: number of reference molecules with results
+    <density|hvap>_mue: mean unsigned error
+    <density|hvap>_rmse: root mean square error
+    <density|hvap>_mse: mean signed error (calculated - experimental)
+Densities are compared in g/cm^3 and Hvaps in kcal/mol, as in mue.py.
+"""
+
+from collections import namedtuple
+import csv
+import os
+
+import numpy as np
+
+from bootstrap import DEFAULT_CONFIDENCE, DEFAULT_RESAMPLES, bootstrap_mues, confidence_interval, p_value
+from fb_output import PropertyResult, read_optimise_out
+from qb_output import qb_out_paths, read_run_dirs
+from reference_data import REFERENCE_FILES, read_reference_rows, reference_file
+
+
+# Where a model's results are read from, in order of preference when it has several.
+SOURCES = ('qb', 'csv', 'fb')
+
+Reference = namedtuple('Reference', 'names density hvap temperature')
+# Calculated values of several models, each a (models, reference molecules) array.
+ModelResults = namedtuple('ModelResults', 'sources density hvap density_stdev hvap_stdev')
+GroupResults = namedtuple('GroupResults', 'group models reference results')
+LeaderboardRow = namedtuple(
+    'LeaderboardRow',
+    'group model source n density_mue density_rmse density_mse hvap_mue hvap_rmse hvap_mse',
+)
+STAT_NAMES = LeaderboardRow._fields[3:]
+# Bootstrap interval of one MUE, and its paired difference from the group's baseline model (NaN for the baseline).
+MueUncertainty = namedtuple(
+    'MueUncertainty',
+    'group model quantity mue low high baseline difference difference_low difference_high p_value',
+)
+
+
+def read_reference(file_path):
+    """
+    Read a molecule,density,hvap,temp table (kg/m^3, kJ/mol, K).
+    :return: Reference of arrays, with density in g/cm^3 and hvap in kcal/mol
+    """
+
+    rows = read_reference_rows(file_path)
+    return Reference(
+        names=[name for name, _, _, _ in rows],
+        density=np.array([density for _, density, _, _ in rows]),
+        hvap=np.array([hvap for _, _, hvap, _ in rows]),
+        temperature=np.array([temperature for _, _, _, temperature in rows]),
+    )
+
+
+def available_sources(run_dir):
+    """The SOURCES with an output in run_dir, in order of preference."""
+
+    present = {
+        'qb': bool(qb_out_paths(run_dir)),
+        'csv': os.path.isfile(os.path.join(run_dir, 'results.csv')),
+        'fb': os.path.isfile(os.path.join(run_dir, 'optimise.out')),
+    }
+    return [source for source in SOURCES if present[source]]
+
+
+def read_results(run_dir, source):
+    """
+    Calculated densities (g/cm^3) and Hvaps (kcal/mol) of a model, keyed by molecule name.
+    :param source: 'qb' (QUBEBench *_qb_out.txt), 'csv' (results.csv) or 'fb' (the last iteration of optimise.out)
+    :return: dict of name: (density, hvap, density_stdev, hvap_stdev);
+        the standard errors are only reported by ForceBalance and are NaN for the other sources.
+    """
+
+    results = {}
+    if source == 'qb':
+        results = qb_values(read_run_dirs([run_dir])[run_dir])
+
+    elif source == 'csv':
+        with open(os.path.join(run_dir, 'results.csv')) as csv_file:
+            for row in csv.DictReader(csv_file):
+                results[row['name']] = (float(row['density']), float(row['heat_of_vap']), np.nan, np.nan)
+
+    elif source == 'fb':
+        densities, enthalpies = {}, {}
+        for record in read_optimise_out(os.path.join(run_dir, 'optimise.out')):
+            if isinstance(record, PropertyResult):
+                name = record.target.split('_')[0]
+                if record.quantity == 'Density':
+                    densities[name] = (record.calculated / 1000, record.stdev / 1000)
+                elif record.quantity == 'Enthalpy of Vaporization':
+                    enthalpies[name] = (record.calculated / 4.184, record.stdev / 4.184)
+        for name, (density, density_stdev) in densities.items():
+            hvap, hvap_stdev = enthalpies.get(name, (np.nan, np.nan))
+            results[name] = (density, hvap, density_stdev, hvap_stdev)
+
+    else:
+        raise ValueError(f'Unknown source {source!r}; expected one of {SOURCES}.')
+
+    return results
+
+
+def qb_values(qb_results):
+    """read_results values of the {name: QbResult} dicts from qb_output.read_run_dirs."""
+    return {
+        name: (
+            np.nan if result.density is None else result.density, np.nan if result.hvap is None else result.hvap,
+            np.nan, np.nan,
+        )
+        for name, result in qb_results.items()
+    }
+
+
+def error_stats(calculated, experimental):
+    """
+    :param calculated: (models, molecules) array, NaN where a model has no result for a molecule
+    :param experimental: (molecules,) array
+    :return: count, mue, rmse and mse arrays, one value per model
+    """
+
+    errors = calculated - experimental
+    count = np.sum(~np.isnan(errors), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mue = np.nansum(np.abs(errors), axis=-1) / count
+        rmse = np.sqrt(np.nansum(errors ** 2, axis=-1) / count)
+        mse = np.nansum(errors, axis=-1) / count
+    return count, mue, rmse, mse
+
+
+def load_results(run_dirs, reference, source=None, jobs=1):
+    """
+    Line the results of several models up against one reference table.
+    :param run_dirs: model directories
+    :param reference: Reference from read_reference
+    :param source: one of SOURCES for every model, or None to use the first available for each
+    :param jobs: number of processes used to parse the *_qb_out.txt files of all the models at once.
+    :return: ModelResults, with NaN wherever a model has no value for a reference molecule
+    """
+
+    column = {name: index for index, name in enumerate(reference.names)}
+    values = np.full((4, len(run_dirs), len(column)), np.nan)
+
+    sources = [source or available_sources(run_dir)[0] for run_dir in run_dirs]
+    qb_dirs = [run_dir for run_dir, model_source in zip(run_dirs, sources) if model_source == 'qb']
+    qb_results = read_run_dirs(qb_dirs, jobs)
+
+    for row, (run_dir, model_source) in enumerate(zip(run_dirs, sources)):
+        if model_source == 'qb':
+            model_results = qb_values(qb_results[run_dir])
+        else:
+            model_results = read_results(run_dir, model_source)
+        for name, result in model_results.items():
+            if name in column:
+                values[:, row, column[name]] = result
+
+    return ModelResults(sources, *values)
+
+
+def score_models(run_dirs, reference, source=None):
+    """
+    Score several models against one reference table.
+    :param run_dirs: model directories
+    :param reference: Reference from read_reference
+    :param source: one of SOURCES for every model, or None to use the first available for each
+    :return: list of (source, n, density_mue, density_rmse, density_mse, hvap_mue, hvap_rmse, hvap_mse) per model
+    """
+
+    return score_results(load_results(run_dirs, reference, source), reference)
+
+
+def score_results(results, reference):
+    """score_models for ModelResults which have already been loaded."""
+
+    count, *density_stats = error_stats(results.density, reference.density)
+    _, *hvap_stats = error_stats(results.hvap, reference.hvap)
+    return [
+        (results.sources[row], int(count[row]), *(float(stat[row]) for stat in (*density_stats, *hvap_stats)))
+        for row in range(len(results.sources))
+    ]
+
+
+def load_groups(runs_root='runs', source=None, reference_path=None, jobs=1):
+    """
+    Load every model directory under runs_root/<group>/ against its group's reference table.
+    :param source: read every model from this source (skipping models without it) rather than the first available one
+    :param reference_path: use this table for every group instead of REFERENCE_FILES
+    :param jobs: number of processes used to parse the *_qb_out.txt files
+    :return: list of GroupResults
+    """
+
+    groups = []
+    for group in sorted(os.listdir(runs_root)):
+        group_dir = os.path.join(runs_root, group)
+        if not os.path.isdir(group_dir) or (reference_path is None and group not in REFERENCE_FILES):
+            continue
+
+        models = []
+        for name in sorted(os.listdir(group_dir)):
+            run_dir = os.path.join(group_dir, name)
+            if os.path.isdir(run_dir):
+                sources = available_sources(run_dir)
+                if sources and (source is None or source in sources):
+                    models.append(name)
+
+        reference = read_reference(reference_path or reference_file(group))
+        results = load_results([os.path.join(group_dir, model) for model in models], reference, source, jobs)
+        groups.append(GroupResults(group, models, reference, results))
+
+    return groups
+
+
+def build_leaderboard(runs_root='runs', source=None, reference_path=None, groups=None):
+    """
+    Score every model directory under runs_root/<group>/ against its group's reference table.
+    :param source: read every model from this source rather than the first available one
+    :param reference_path: use this table for every group instead of REFERENCE_FILES
+    :param groups: GroupResults from load_groups to score instead of loading runs_root
+    :return: list of LeaderboardRow
+    """
+
+    if groups is None:
+        groups = load_groups(runs_root, source, reference_path)
+
+    rows = []
+    for group in groups:
+        scores = score_results(group.results, group.reference)
+        rows.extend(LeaderboardRow(group.group, model, *score) for model, score in zip(group.models, scores))
+    return rows
+
+
+def bootstrap_leaderboard(groups, rows, resamples=DEFAULT_RESAMPLES, confidence=DEFAULT_CONFIDENCE, seed=None,
+                          baseline=None):
+    """
+    Bootstrap confidence intervals of every model's density and Hvap MUE, and paired tests of each model against
+    a baseline model of its group. ForceBalance's standard errors are included where the results came from optimise.out.
+    :param groups: GroupResults from load_groups
+    :param rows: LeaderboardRows of those groups in ranked order; the first of each group is its baseline
+    :param baseline: name of the model to compare the others against instead, in every group which has it
+    :return: list of MueUncertainty, group by group in the order of rows, density then Hvap for each model
+    """
+
+    uncertainties = []
+    for group in groups:
+        order = [group.models.index(row.model) for row in rows if row.group == group.group]
+        if not order:
+            continue
+        best = group.models.index(baseline) if baseline in group.models else order[0]
+        others = [index for index in order if index != best]
+
+        # Per quantity: MUE, its interval, and the paired difference from the baseline (NaN for the baseline itself).
+        stats = {}
+        for quantity in ('density', 'hvap'):
+            errors = getattr(group.results, quantity) - getattr(group.reference, quantity)
+            stdevs = getattr(group.results, f'{quantity}_stdev')
+            replicates, differences = bootstrap_mues(
+                errors, stdevs, [(index, best) for index in others], resamples=resamples, seed=seed,
+            )
+
+            absolute = np.abs(errors)
+            with np.errstate(invalid='ignore'):
+                common = ~np.isnan(absolute) & ~np.isnan(absolute[best])
+                difference = np.sum(np.where(common, absolute - absolute[best], 0), axis=-1) / np.sum(common, axis=-1)
+
+            paired = np.full((4, len(group.models)), np.nan)
+            difference_low, difference_high = confidence_interval(differences, confidence)
+            paired[:, others] = (difference[others], difference_low, difference_high, p_value(differences))
+            stats[quantity] = (np.nanmean(absolute, axis=-1), *confidence_interval(replicates, confidence), *paired)
+
+        for index in order:
+            for quantity, columns in stats.items():
+                uncertainties.append(MueUncertainty(
+                    group.group, group.models[index], quantity, *(float(column[index]) for column in columns[:3]),
+                    group.models[best], *(float(column[index]) for column in columns[3:]),
+                ))
+
+    return uncertainties
+
+
+def sort_leaderboard(rows, sort_by='density_mue'):
+    """Best first within each group; NaN scores go last."""
+
+    if sort_by not in STAT_NAMES:
+        raise KeyError(f'Cannot sort by {sort_by}; expected one of {STAT_NAMES}.')
+    return sorted(rows, key=lambda row: (row.group, np.isnan(abs(getattr(row, sort_by))), abs(getattr(row, sort_by))))
+
+
+def format_leaderboard(rows):
+    """Aligned text table of the rows."""
+
+    lines = [
+        f'{"group":<9} {"model":<9} {"source":<6} {"n":>3}  '
+        f'{"dens MUE":>8} {"RMSE":>7} {"MSE":>8}  {"Hvap MUE":>8} {"RMSE":>7} {"MSE":>8}'
+    ]
+    for row in rows:
+        lines.append(
+            f'{row.group:<9} {row.model:<9} {row.source:<6} {row.n:>3}  '
+            f'{row.density_mue:>8.4f} {row.density_rmse:>7.4f} {row.density_mse:>+8.4f}  '
+            f'{row.hvap_mue:>8.4f} {row.hvap_rmse:>7.4f} {row.hvap_mse:>+8.4f}'
+        )
+    return '\n'.join(lines)
+
+
+def format_uncertainties(uncertainties, confidence=DEFAULT_CONFIDENCE):
+    """Aligned text table of MueUncertainty records."""
+
+    interval = f'{confidence:.0%} CI'
+    lines = [
+        f'{"group":<9} {"model":<9} {"":<7} {"MUE":>7} {interval:>17}  {"vs":<9} {"dMUE":>8} {interval:>19} {"p":>6}'
+    ]
+    for row in uncertainties:
+        quantity = 'density' if row.quantity == 'density' else 'Hvap'
+        line = (
+            f'{row.group:<9} {row.model:<9} {quantity:<7} {row.mue:>7.4f} [{row.low:>7.4f}, {row.high:>7.4f}]  '
+            f'{row.baseline:<9}'
+        )
+        if not np.isnan(row.p_value):
+            line += (
+                f' {row.difference:>+8.4f} [{row.difference_low:>+8.4f}, {row.difference_high:>+8.4f}] '
+                f'{row.p_value:>6.4f}'
+            )
+        lines.append(line.rstrip())
+    return '\n'.join(lines)
+
+
+def write_leaderboard(output, rows):
+    with open(output, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(LeaderboardRow._fields)
+        writer.writerows(rows)
+
+
+def write_uncertainties(output, uncertainties):
+    with open(output, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(MueUncertainty._fields)
+        writer.writerows(uncertainties)
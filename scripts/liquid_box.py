@@ -0,0 +1,385 @@
+"""
+Build the liquid.pdb of ForceBalance targets without QUBEBench.
+
+A molecule's gas.pdb (or the final pdb of its QUBEKit run) is copied into a cubic box:
+every copy gets a random rotation and a site on a cubic lattice (or a random position),
+then all atom pairs closer than the tolerance are found at once with a cell list,
+and the copies involved in a clash are re-drawn until there are none.
+The box length is set from the experimental density, scaled down (as in the existing targets, which are built at
+roughly 0.5-0.9 of it) so the copies fit easily and NPT equilibration compresses the box, and rounded up to whole Angstrom.
+
+    build_liquid_box('targets/mol01_liquid/gas.pdb', 'targets/mol01_liquid/liquid.pdb', density=0.787)
+    build_targets('targets', jobs=8)    # every target, densities from input_files/training_data.csv
+
+Boxes are independent, so build_boxes spreads them over a process pool; each gets its own seed derived from
+the one given, so the output does not depend on the number of processes.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import os
+import re
+
+import numpy as np
+
+from leaderboard import read_reference
+from pdb_reader import read_pdb
+from reference_data import reference_file
+
+
+GAS_PDB = 'gas.pdb'
+LIQUID_PDB = 'liquid.pdb'
+DEFAULT_MOLECULES = 500
+# Fraction of the experimental density the box is built at.
+DEFAULT_DENSITY_SCALE = 0.7
+# Closest two atoms of different molecules may be, in Angstrom.
+DEFAULT_TOLERANCE = 2.0
+PLACEMENTS = ('lattice', 'random')
+# Rounds of insertion attempts before giving up, and roughly how many candidates each round tries.
+MAX_ROUNDS = 1000
+TRIALS_PER_ROUND = 2000
+# Query points looked up in a cell list at once; each needs an array of 27 cells' worth of neighbours.
+QUERY_CHUNK = 4096
+
+AVOGADRO = 6.02214076e23
+# g/mol
+ATOMIC_MASSES = {
+    'H': 1.008, 'B': 10.81, 'C': 12.011, 'N': 14.007, 'O': 15.999, 'F': 18.998, 'Si': 28.085, 'P': 30.974,
+    'S': 32.06, 'Cl': 35.45, 'Br': 79.904, 'I': 126.904,
+}
+
+
+def element_of(name, element=''):
+    """Element symbol of an atom, from the pdb element column or else the letters of its name (e.g. Cl2 -> Cl)."""
+
+    if element:
+        return element.capitalize()
+    letters = re.match('[A-Za-z]*', name).group().capitalize()
+    return letters if letters in ATOMIC_MASSES else letters[:1]
+
+
+def molecular_mass(names, elements):
+    """Mass of a molecule in g/mol."""
+
+    symbols = [element_of(name, element) for name, element in zip(names, elements)]
+    unknown = sorted(set(symbols) - ATOMIC_MASSES.keys())
+    if unknown:
+        raise KeyError(f'No atomic mass for {", ".join(unknown)}; expected one of {sorted(ATOMIC_MASSES)}.')
+    return sum(ATOMIC_MASSES[symbol] for symbol in symbols)
+
+
+def box_length(mass, molecules, density, scale=DEFAULT_DENSITY_SCALE):
+    """
+    Side of a cubic box of molecules at scale * density, rounded up to whole Angstrom.
+    :param mass: molecular mass, g/mol
+    :param density: g/cm^3
+    """
+
+    volume = mass * molecules / AVOGADRO / (density * scale) * 1e24
+    return float(np.ceil(volume ** (1 / 3)))
+
+
+def random_rotations(rng, count):
+    """(count, 3, 3) rotation matrices, uniform over rotations (from uniform unit quaternions)."""
+
+    w, x, y, z = rng.standard_normal((4, count))
+    norm = np.sqrt(w * w + x * x + y * y + z * z)
+    w, x, y, z = w / norm, x / norm, y / norm, z / norm
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], axis=-1),
+        np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], axis=-1),
+        np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=-1),
+    ], axis=1)
+
+
+class CellList:
+    """
+    Points in a periodic cubic box, binned into cells at least cutoff wide,
+    so the points near a batch of queries are found by looking only in the 27 cells around each query.
+    Every point has an integer label (its molecule); points of the same label never count as near.
+    """
+
+    def __init__(self, box, cutoff, capacity=8):
+        self.box = box
+        self.cutoff = cutoff
+        self.cells = max(int(box // cutoff), 1)
+        # slots[c] holds the indices of the points in cell c, padded with -1.
+        self.slots = np.full((self.cells ** 3, capacity), -1)
+        self.counts = np.zeros(self.cells ** 3, dtype=int)
+        self.positions = np.zeros((0, 3))
+        self.labels = np.zeros(0, dtype=int)
+        # neighbour_cells[c] lists the 27 cells around cell c, itself included.
+        grid = np.array(np.unravel_index(np.arange(self.cells ** 3), (self.cells,) * 3)).T
+        offsets = np.array(list(product((-1, 0, 1), repeat=3)))
+        self.neighbour_cells = np.ravel_multi_index(
+            np.moveaxis((grid[:, None, :] + offsets) % self.cells, -1, 0), (self.cells,) * 3,
+        )
+
+    def cell_of(self, points):
+        """(points, 3) integer cell coordinates of each point."""
+        return np.minimum((np.mod(points, self.box) * (self.cells / self.box)).astype(int), self.cells - 1)
+
+    def add(self, points, labels):
+        points = np.mod(points, self.box)
+        flat = np.ravel_multi_index(self.cell_of(points).T, (self.cells,) * 3)
+        order = np.argsort(flat, kind='stable')
+        new_counts = np.bincount(flat, minlength=len(self.counts))
+        # Rank of each new point among the new points of its cell, after those already there.
+        first = np.cumsum(new_counts) - new_counts
+        slot = np.empty(len(flat), dtype=int)
+        slot[order] = np.arange(len(flat)) - first[flat[order]]
+        slot += self.counts[flat]
+
+        if len(slot) and slot.max() >= self.slots.shape[1]:
+            extra = slot.max() + 1 - self.slots.shape[1]
+            self.slots = np.pad(self.slots, ((0, 0), (0, extra)), constant_values=-1)
+        self.slots[flat, slot] = np.arange(len(self.positions), len(self.positions) + len(flat))
+        self.counts += new_counts
+        self.positions = np.concatenate([self.positions, points])
+        self.labels = np.concatenate([self.labels, labels])
+
+    def voids(self):
+        """
+        Flat indices of the cells that neither hold a point nor touch a cell that does,
+        or if there are none, of the cells that hold no point.
+        """
+
+        occupied = (self.counts > 0).reshape((self.cells,) * 3)
+        touched = np.zeros_like(occupied)
+        for offset in product((-1, 0, 1), repeat=3):
+            touched |= np.roll(occupied, offset, axis=(0, 1, 2))
+        voids = np.flatnonzero(~touched)
+        return voids if len(voids) else np.flatnonzero(~occupied)
+
+    def random_points(self, rng, count, cells=None):
+        """Uniformly random points in the box, or within the given cells (flat indices) if any."""
+
+        if cells is None or not len(cells):
+            return rng.random((count, 3)) * self.box
+        corner = np.array(np.unravel_index(rng.choice(cells, count), (self.cells,) * 3)).T
+        return (corner + rng.random((count, 3))) * (self.box / self.cells)
+
+    def lowest_near(self, points, labels, none):
+        """
+        The lowest label of the points within cutoff of each query point, ignoring points of the query's own label.
+        :param none: value returned for queries with nothing near
+        """
+
+        lowest = np.full(len(points), none)
+        if not len(self.positions):
+            return lowest
+
+        for start in range(0, len(points), QUERY_CHUNK):
+            chunk = np.mod(points[start:start + QUERY_CHUNK], self.box)
+            cells = np.ravel_multi_index(self.cell_of(chunk).T, (self.cells,) * 3)
+            neighbours = self.slots[self.neighbour_cells[cells]].reshape(len(chunk), -1)
+            delta = chunk[:, None, :] - self.positions[neighbours]
+            delta -= self.box * np.round(delta / self.box)
+            near = (
+                (neighbours >= 0) & (np.einsum('ijk,ijk->ij', delta, delta) < self.cutoff ** 2)
+                & (self.labels[neighbours] != labels[start:start + QUERY_CHUNK, None])
+            )
+            lowest[start:start + QUERY_CHUNK] = np.where(near, self.labels[neighbours], none).min(axis=1)
+        return lowest
+
+
+def pack_box(coordinates, molecules, box, tolerance=DEFAULT_TOLERANCE, placement='lattice', seed=None,
+             max_rounds=MAX_ROUNDS, trials=TRIALS_PER_ROUND):
+    """
+    Place rotated copies of a molecule in a periodic cubic box with no two atoms of different copies within tolerance.
+
+    Copies are inserted in rounds. Each round draws candidate positions and rotations for the copies still to place
+    (the first round puts each on a site of a cubic lattice with placement='lattice'; later ones are random,
+    centred in cells with no atom in or next to them while such cells are left),
+    keeps the candidates clear of the copies already placed, and of those the ones clear of every earlier candidate.
+    Each check is one cell-list lookup for the same atom of every candidate, outermost atoms first,
+    so most rejected candidates cost a single lookup.
+    :param coordinates: (atoms, 3) coordinates of one molecule
+    :param seed: seed or SeedSequence of the random generator
+    :param trials: about how many candidate copies to draw per round, so rounds stay a similar size as the box fills
+    :return: (molecules, atoms, 3) coordinates of the copies, their centres inside the box
+    """
+
+    if placement not in PLACEMENTS:
+        raise ValueError(f'Unknown placement {placement!r}; expected one of {PLACEMENTS}.')
+
+    rng = np.random.default_rng(seed)
+    local = np.asarray(coordinates, dtype=float)
+    local = local - local.mean(axis=0)
+    atoms = len(local)
+    outermost = np.argsort(-np.einsum('ij,ij->i', local, local))
+
+    placed = CellList(box, tolerance)
+    positions = np.empty((molecules, atoms, 3))
+    remaining = np.arange(molecules)
+    for round_number in range(max_rounds):
+        if round_number == 0 and placement == 'lattice':
+            per_side = int(np.ceil(molecules ** (1 / 3) - 1e-9))
+            sites = (np.array(list(product(range(per_side), repeat=3))) + 0.5) * (box / per_side)
+            # Spread the empty sites of a partly filled lattice through the box.
+            centres = sites[np.sort(rng.choice(len(sites), molecules, replace=False))]
+            candidates = remaining
+        else:
+            candidates = np.repeat(remaining, max(1, trials // len(remaining)))
+            # Centre candidates on the empty space left between the copies placed so far, while there is any.
+            centres = placed.random_points(rng, len(candidates), placed.voids())
+
+        trial = centres[:, None, :] + np.einsum('mij,aj->mai', random_rotations(rng, len(candidates)), local)
+        # Check the coordinates as the pdb will hold them, so rounding cannot bring two atoms inside the tolerance.
+        trial = np.round(trial, 3)
+        # Test one atom of every candidate at a time, outermost first, dropping candidates as soon as one clashes.
+        clear = np.arange(len(candidates))
+        for atom in outermost:
+            hit = placed.lowest_near(trial[clear, atom], np.full(len(clear), -1), molecules) < molecules
+            clear = clear[~hit]
+        # One candidate per copy: the first of its clear ones.
+        clear_index = clear[np.unique(candidates[clear], return_index=True)[1]]
+
+        # Among those, keep each one that is clear of all the candidates before it.
+        batch = CellList(box, tolerance)
+        labels = np.repeat(np.arange(len(clear_index)), atoms)
+        batch.add(trial[clear_index].reshape(-1, 3), labels)
+        lowest = batch.lowest_near(trial[clear_index].reshape(-1, 3), labels, len(clear_index))
+        lowest = lowest.reshape(-1, atoms).min(axis=1)
+        accepted = clear_index[lowest > np.arange(len(clear_index))]
+
+        positions[candidates[accepted]] = trial[accepted]
+        placed.add(trial[accepted].reshape(-1, 3), np.repeat(candidates[accepted], atoms))
+        remaining = np.setdiff1d(remaining, candidates[accepted])
+        if not len(remaining):
+            return positions
+
+    raise ValueError(
+        f'Could not place {molecules} molecules in a {box:g} A box within {max_rounds} rounds '
+        f'({len(remaining)} left); try a lower density scale or a smaller tolerance.'
+    )
+
+
+def format_atom_name(name, element):
+    """Atom name in columns 13-16: names of one-letter elements start in column 14, as QUBEKit writes them."""
+    return name if len(name) == 4 or len(element) == 2 else f' {name:<3}'
+
+
+def write_liquid_pdb(file_path, positions, names, residue_name, elements, box, title=''):
+    """
+    Write a box of molecules in the layout of the targets' liquid.pdb: CRYST1, one MODEL, one residue per molecule.
+    :param positions: (molecules, atoms, 3) coordinates
+    """
+
+    atom_names = [format_atom_name(name, element_of(name, element)) for name, element in zip(names, elements)]
+    symbols = [element_of(name, element) for name, element in zip(names, elements)]
+    lines = [
+        f'TITLE     {title}',
+        'REMARK    THIS IS A SIMULATION BOX',
+        f'CRYST1{box:9.3f}{box:9.3f}{box:9.3f}{90:7.2f}{90:7.2f}{90:7.2f} P 1           1',
+        'MODEL        1',
+    ]
+    serial = 0
+    for residue, molecule in enumerate(positions.tolist(), start=1):
+        for name, symbol, (x, y, z) in zip(atom_names, symbols, molecule):
+            serial += 1
+            lines.append(
+                f'ATOM  {serial % 100000:5d} {name:4} {residue_name:>3}  {residue % 10000:4d}    '
+                f'{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00          {symbol:>2}'
+            )
+    lines.extend(['TER', 'ENDMDL', ''])
+
+    with open(file_path, 'w') as pdb_file:
+        pdb_file.write('\n'.join(lines))
+
+
+def build_liquid_box(pdb_path, output_path, density, molecules=DEFAULT_MOLECULES, scale=DEFAULT_DENSITY_SCALE,
+                     tolerance=DEFAULT_TOLERANCE, placement='lattice', seed=None, title=None):
+    """
+    Build and write the liquid box of one molecule.
+    :param pdb_path: pdb of a single molecule, e.g. a target's gas.pdb
+    :param density: experimental density, g/cm^3
+    :return: side of the box, Angstrom
+    """
+
+    molecule = read_pdb(pdb_path)
+    box = box_length(molecular_mass(molecule.names, molecule.elements), molecules, density, scale)
+    positions = pack_box(molecule.coordinates, molecules, box, tolerance, placement, seed)
+    residue_name = molecule.residue_names[0] if len(molecule.residue_names) else 'UNL'
+    if title is None:
+        title = molecule_name(pdb_path)
+    write_liquid_pdb(output_path, positions, molecule.names, residue_name, molecule.elements, box, title)
+    return box
+
+
+def build_boxes(specs, molecules=DEFAULT_MOLECULES, scale=DEFAULT_DENSITY_SCALE, tolerance=DEFAULT_TOLERANCE,
+                placement='lattice', seed=None, jobs=1):
+    """
+    Build many liquid boxes, in a process pool if jobs > 1.
+    :param specs: (pdb_path, output_path, density) of each box
+    :return: list of box sides, in the same order
+    """
+
+    specs = list(specs)
+    seeds = np.random.SeedSequence(seed).spawn(len(specs))
+    arguments = [
+        (pdb_path, output_path, density, molecules, scale, tolerance, placement, box_seed)
+        for (pdb_path, output_path, density), box_seed in zip(specs, seeds)
+    ]
+    if jobs > 1 and len(arguments) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(build_liquid_box, *zip(*arguments)))
+    return [build_liquid_box(*box_arguments) for box_arguments in arguments]
+
+
+def molecule_name(path):
+    """Molecule a target or run path belongs to, e.g. mol01 for targets/mol01_liquid/gas.pdb or model0/mol01."""
+
+    for part in reversed(os.path.normpath(os.path.abspath(path)).split(os.sep)):
+        match = re.match(r'mol\d+', part)
+        if match:
+            return match.group()
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def target_dirs(targets_dir='targets'):
+    """Every target directory with a gas.pdb in a ForceBalance targets directory, sorted by name."""
+
+    return [
+        os.path.join(targets_dir, target) for target in sorted(os.listdir(targets_dir))
+        if os.path.isfile(os.path.join(targets_dir, target, GAS_PDB))
+    ]
+
+
+def box_specs(paths, densities, output=None, overwrite=False):
+    """
+    (pdb_path, output_path, density) of the box for each path, skipping boxes that exist unless overwrite.
+    :param paths: target directories (gas.pdb -> liquid.pdb), or single-molecule pdbs (-> liquid.pdb beside them)
+    :param densities: dict of molecule name: density in g/cm^3
+    :param output: output path, only when building a single box
+    """
+
+    specs = []
+    for path in paths:
+        pdb_path = os.path.join(path, GAS_PDB) if os.path.isdir(path) else path
+        output_path = output or os.path.join(os.path.dirname(pdb_path), LIQUID_PDB)
+        if os.path.exists(output_path) and not overwrite:
+            continue
+        name = molecule_name(pdb_path)
+        if name not in densities:
+            raise KeyError(f'No reference density for {name} ({pdb_path}).')
+        specs.append((pdb_path, output_path, densities[name]))
+    return specs
+
+
+def reference_densities(reference_path=None):
+    """Experimental densities (g/cm^3) by molecule name, from input_files/training_data.csv unless given."""
+
+    reference = read_reference(reference_path or reference_file('training'))
+    return dict(zip(reference.names, reference.density.tolist()))
+
+
+def build_targets(targets_dir='targets', reference_path=None, overwrite=False, **options):
+    """
+    Build liquid.pdb in every target of a ForceBalance targets directory that has a gas.pdb.
+    :param options: passed on to build_boxes
+    :return: dict of liquid.pdb path: box side
+    """
+
+    specs = box_specs(target_dirs(targets_dir), reference_densities(reference_path), overwrite=overwrite)
+    return {output_path: box for (_, output_path, _), box in zip(specs, build_boxes(specs, **options))}
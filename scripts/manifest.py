@@ -0,0 +1,171 @@
+"""
+Single-pass index of QUBEKit outputs below a directory.
+
+The tree is walked once with os.scandir. Every QUBEKit_<name>_... run folder found is recorded with its
+final xml/pdb and ChargeMol directory; run folders themselves are not descended into.
+Folders of collected results (e.g. runs/training/model0/mol01/{mol01.xml, mol01.pdb}) are recorded too.
+
+The manifest can be saved as json (paths relative to the indexed root) and reloaded instead of re-walking the tree.
+"""
+
+from collections import namedtuple
+import json
+import os
+import shutil
+
+
+# kind is 'run' for a QUBEKit run folder or 'collected' for a folder holding just <name>.xml/<name>.pdb.
+# group is the directory (relative to the root) containing the folder, e.g. 'runs/training/model0'.
+# Any file or directory which could not be found is None.
+ManifestEntry = namedtuple('ManifestEntry', 'name kind group run_dir xml pdb charge_dir')
+
+MANIFEST_VERSION = 1
+
+
+def _index_run(run_dir, dir_name, group):
+    """Index a single QUBEKit run folder from one listing of its contents (plus one of its final folder)."""
+
+    # Default to the QUBEKit_<name>_<date>_log naming; the final xml's name is preferred when available.
+    name = dir_name.split('_')[1]
+    final_dir, charge_dir = None, None
+    with os.scandir(run_dir) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            if 'final' in entry.name:
+                final_dir = entry.path
+            elif 'charge' in entry.name and os.path.isdir(os.path.join(entry.path, 'ChargeMol')):
+                charge_dir = os.path.join(entry.path, 'ChargeMol')
+
+    xml, pdb = None, None
+    if final_dir is not None:
+        with os.scandir(final_dir) as entries:
+            files = {entry.name for entry in entries if entry.is_file()}
+        xmls = sorted(file[:-4] for file in files if file.endswith('.xml'))
+        if name not in xmls and len(xmls) == 1:
+            name = xmls[0]
+        if f'{name}.xml' in files:
+            xml = os.path.join(final_dir, f'{name}.xml')
+        if f'{name}.pdb' in files:
+            pdb = os.path.join(final_dir, f'{name}.pdb')
+
+    return ManifestEntry(name, 'run', group, run_dir, xml, pdb, charge_dir)
+
+
+def build_manifest(root='.'):
+    """
+    Walk root once and index every QUBEKit run folder and collected results folder.
+    :param root: directory to index
+    :return: list of ManifestEntry, sorted by folder path
+    """
+
+    manifest = []
+    stack = [(root, '.')]
+    while stack:
+        path, group = stack.pop()
+        files, dirs = set(), []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.name.startswith('QUBEKit_'):
+                        manifest.append(_index_run(entry.path, entry.name, group))
+                    else:
+                        dirs.append(entry)
+                else:
+                    files.add(entry.name)
+
+        name = os.path.basename(os.path.abspath(path))
+        if f'{name}.xml' in files:
+            manifest.append(ManifestEntry(
+                name, 'collected', os.path.dirname(group) or '.', path,
+                os.path.join(path, f'{name}.xml'),
+                os.path.join(path, f'{name}.pdb') if f'{name}.pdb' in files else None,
+                None,
+            ))
+
+        for entry in dirs:
+            stack.append((entry.path, os.path.normpath(os.path.join(group, entry.name))))
+
+    return sorted(manifest, key=lambda entry: entry.run_dir)
+
+
+def latest_runs(manifest, group=None):
+    """
+    Map molecule name -> run entry; if a molecule was run more than once, the last folder (sorted by path) wins.
+    :param group: only consider run folders directly inside this group (relative to the indexed root)
+    """
+
+    runs = dict()
+    for entry in manifest:
+        if entry.kind == 'run' and (group is None or entry.group == group):
+            runs[entry.name] = entry
+    return {name: runs[name] for name in sorted(runs)}
+
+
+def save_manifest(manifest, file_path, root='.'):
+    """Save as json with paths relative to root, so the manifest stays valid if the tree is moved."""
+
+    def relative(path):
+        return None if path is None else os.path.relpath(path, root)
+
+    entries = [
+        entry._replace(run_dir=relative(entry.run_dir), xml=relative(entry.xml), pdb=relative(entry.pdb),
+                       charge_dir=relative(entry.charge_dir))._asdict()
+        for entry in manifest
+    ]
+    with open(file_path, 'w') as manifest_file:
+        json.dump({'version': MANIFEST_VERSION, 'entries': entries}, manifest_file, indent=1)
+
+
+def load_manifest(file_path, root='.'):
+    with open(file_path) as manifest_file:
+        data = json.load(manifest_file)
+    if data.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'{file_path} was written by an incompatible version; please re-index.')
+
+    def absolute(path):
+        return None if path is None else os.path.join(root, path)
+
+    return [
+        ManifestEntry(**entry)._replace(
+            run_dir=absolute(entry['run_dir']), xml=absolute(entry['xml']), pdb=absolute(entry['pdb']),
+            charge_dir=absolute(entry['charge_dir']),
+        )
+        for entry in data['entries']
+    ]
+
+
+def get_manifest(root='.', manifest_path=None, reindex=False):
+    """
+    Load the saved manifest if there is one, otherwise index root (and save the result if a path is given).
+    :param manifest_path: json file to reuse / write; None always indexes without saving
+    :param reindex: ignore any saved manifest and index again
+    """
+
+    if manifest_path is not None and not reindex and os.path.exists(manifest_path):
+        return load_manifest(manifest_path, root)
+
+    manifest = build_manifest(root)
+    if manifest_path is not None:
+        save_manifest(manifest, manifest_path, root)
+    return manifest
+
+
+def collect_runs(manifest, dest='.'):
+    """
+    Copy each molecule's final pdb and xml out of its (latest) QUBEKit run folder into dest/<name>/,
+    the layout used for the collected results in runs/.
+    :return: list of the run folders collected
+    """
+
+    collected = []
+    for mol_name, entry in latest_runs(manifest).items():
+        mol_dir = os.path.join(dest, mol_name)
+        os.mkdir(mol_dir)
+        for source in (entry.pdb, entry.xml):
+            if source is not None:
+                shutil.copy(source, os.path.join(mol_dir, os.path.basename(source)))
+        collected.append(entry.run_dir)
+    return collected
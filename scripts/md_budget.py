@@ -0,0 +1,248 @@
+"""
+Share a total MD budget between the targets of an optimise.in by how noisy and how expensive each one is.
+
+Each target's contribution to the objective is weight * (delta / denominator)^2 per property, so the statistical noise
+it adds is set by weight * (stdev / denominator)^2, which falls as 1 / (production steps).
+From a finished (or running) optimise.out this noise is measured at the steps the target was run for, averaged over
+every iteration, and turned into a_t = noise * steps; the cost of a step, c_t, is taken as the atoms in the liquid box.
+Minimising the total noise sum(a_t / N_t) for a fixed compute sum(c_t * N_t) gives
+    N_t proportional to sqrt(a_t / c_t)
+so noisy targets get more steps and large boxes fewer. Targets are kept at or above a minimum number of steps
+(the rest of the budget is shared again between the others), steps are whole frames (liquid_interval / liquid_timestep),
+and each target keeps its ratio of equilibration to production steps.
+
+The budget is a total of liquid_md_steps; it buys the compute of that many steps spread evenly over the targets.
+By default it is the compute the optimise.in already asks for, so the plan costs the same as the run it replaces.
+
+    plan = plan_budget('runs/training/model0/optimise.out', 'runs/training/targets', 'example_fb_run/optimise.in')
+    write_optimise_in('optimise.in', plan.text)
+"""
+
+from collections import defaultdict, namedtuple
+import csv
+import os
+import re
+
+import numpy as np
+
+from fb_output import PropertyResult, Simulation, read_optimise_out
+from pdb_reader import read_targets
+
+
+MINIMUM_MD_STEPS = 100000
+# Global row of data.csv holding the denominator of each property, as named in the optimise.out tables.
+DENOMINATORS = {
+    'Density': 'rho_denom',
+    'Enthalpy of Vaporization': 'hvap_denom',
+}
+# ForceBalance's defaults, for targets whose data.csv does not give one.
+DEFAULT_DENOMINATORS = {
+    'rho_denom': 30.0,
+    'hvap_denom': 3.0,
+}
+
+# noise: weight * (stdev / denominator)^2 summed over the properties, at md_steps; NaN if never measured.
+TargetStats = namedtuple('TargetStats', 'name atoms eq_steps md_steps noise')
+BudgetRow = namedtuple('BudgetRow', 'name atoms noise md_steps planned_eq_steps planned_md_steps planned_noise')
+BudgetPlan = namedtuple('BudgetPlan', 'rows budget noise planned_noise text')
+
+OPTION_LINE = re.compile(r'(\s*)(\S+)(\s+)(\S+)(.*)')
+
+
+def read_denominators(data_path):
+    """The Global rows of a target's data.csv, e.g. {'rho_denom': 30.0, ...}; only the numeric ones."""
+
+    denominators = dict(DEFAULT_DENOMINATORS)
+    with open(data_path, newline='') as csv_file:
+        for row in csv.reader(csv_file):
+            if len(row) >= 3 and row[0] == 'Global':
+                try:
+                    denominators[row[1]] = float(row[2])
+                except ValueError:
+                    pass
+    return denominators
+
+
+def read_target_stats(optimise_out, targets_dir='targets'):
+    """
+    Steps, measured noise and box size of every target simulated in an optimise.out.
+    :param targets_dir: ForceBalance targets directory holding <target>/data.csv and <target>/liquid.pdb
+    :return: dict of target name: TargetStats
+    """
+
+    steps = {}
+    # (target, quantity): [sum of stdev^2, number of iterations, weight]
+    variances = defaultdict(lambda: [0.0, 0, 0.0])
+    for record in read_optimise_out(optimise_out):
+        if isinstance(record, Simulation):
+            steps[record.target] = (record.eq_steps, record.md_steps)
+        elif isinstance(record, PropertyResult) and record.quantity in DENOMINATORS:
+            variance = variances[record.target, record.quantity]
+            variance[0] += record.stdev ** 2
+            variance[1] += 1
+            variance[2] = record.weight
+
+    boxes = read_targets(targets_dir, ('liquid.pdb',)) if os.path.isdir(targets_dir) else {}
+    stats = {}
+    for name, (eq_steps, md_steps) in steps.items():
+        data_path = os.path.join(targets_dir, name, 'data.csv')
+        denominators = read_denominators(data_path) if os.path.isfile(data_path) else DEFAULT_DENOMINATORS
+        measured = [
+            (total / count) * weight / denominators[DENOMINATORS[quantity]] ** 2
+            for (target, quantity), (total, count, weight) in variances.items() if target == name and count
+        ]
+        atoms = len(boxes[name]['liquid'].coordinates) if 'liquid' in boxes.get(name, {}) else None
+        stats[name] = TargetStats(name, atoms, eq_steps, md_steps, sum(measured) if measured else np.nan)
+    return stats
+
+
+def allocate_steps(coefficients, costs, compute, minimum=MINIMUM_MD_STEPS, frame=1000):
+    """
+    Steps N_t minimising sum(coefficients / N) for sum(costs * N) = compute, with every N_t >= minimum.
+    Targets pushed below the minimum are held there and the rest of the compute is shared again by the others.
+    :param coefficients: noise of each target at one step, a_t
+    :param costs: cost of a step of each target, c_t
+    :param frame: steps are rounded to multiples of this
+    :return: integer array of steps
+    """
+
+    coefficients = np.asarray(coefficients, dtype=float)
+    costs = np.asarray(costs, dtype=float)
+    share = np.sqrt(coefficients / costs)
+    held = np.zeros(len(share), dtype=bool)
+    while True:
+        free = ~held
+        remaining = compute - minimum * np.sum(costs[held])
+        steps = np.where(held, minimum, remaining * share / max(np.sum(costs[free] * share[free]), 1e-300))
+        below = free & (steps < minimum)
+        if not np.any(below) or np.all(held | below):
+            steps[below] = minimum
+            break
+        held |= below
+
+    frames = np.maximum(np.round(steps / frame), np.ceil(minimum / frame))
+    return (frames * frame).astype(int)
+
+
+def target_blocks(text):
+    """(start, end) line indices of each $target block of an optimise.in and its options, in order."""
+
+    lines = text.splitlines()
+    blocks, start = [], None
+    for index, line in enumerate(lines):
+        word = line.strip().lower()
+        if word == '$target':
+            start = index
+        elif word == '$end' and start is not None:
+            options = {}
+            for option in lines[start + 1:index]:
+                match = OPTION_LINE.fullmatch(option)
+                if match is not None:
+                    options[match.group(2).lower()] = match.group(4)
+            blocks.append((start, index, options))
+            start = None
+    return blocks
+
+
+def rewrite_optimise_in(text, steps):
+    """
+    Set liquid_eq_steps and liquid_md_steps of the named $target blocks of an optimise.in, keeping everything else.
+    :param steps: dict of target name: (eq_steps, md_steps)
+    """
+
+    lines = text.splitlines()
+    # Work from the last block back, so inserted lines do not move the blocks still to do.
+    for start, end, options in reversed(target_blocks(text)):
+        name = options.get('name')
+        if name not in steps:
+            continue
+        values = dict(zip(('liquid_eq_steps', 'liquid_md_steps'), steps[name]))
+        for index in range(start + 1, end):
+            match = OPTION_LINE.fullmatch(lines[index])
+            if match is not None and match.group(2).lower() in values:
+                indent, key, gap, _, rest = match.groups()
+                lines[index] = f'{indent}{key}{gap}{values.pop(key.lower())}{rest}'
+        lines[end:end] = [f'{key} {value}' for key, value in values.items()]
+    return '\n'.join(lines) + '\n'
+
+
+def plan_budget(optimise_out, targets_dir='targets', optimise_in='optimise.in', budget=None,
+                minimum=MINIMUM_MD_STEPS):
+    """
+    Re-share the production steps of the targets of optimise_in by their measured noise and box size.
+    Targets never measured take the median noise, and targets without a liquid.pdb the median box.
+    :param budget: total liquid_md_steps to share, as the compute of that many steps spread evenly over the targets
+        (default: the compute of the current steps)
+    :return: BudgetPlan, with the planned total of liquid_md_steps as budget and the rewritten optimise.in as text
+    """
+
+    with open(optimise_in) as in_file:
+        text = in_file.read()
+    blocks = [options for _, _, options in target_blocks(text) if 'name' in options]
+    stats = read_target_stats(optimise_out, targets_dir)
+
+    names = [options['name'] for options in blocks]
+    md_steps = np.array([block_steps(options, stats, 'md') for options in blocks])
+    eq_steps = np.array([block_steps(options, stats, 'eq') for options in blocks])
+    # Noise is measured at the steps each target was run for; scale it to one step.
+    coefficients = fill_median([stats[name].noise * stats[name].md_steps if name in stats else np.nan for name in names])
+    atoms = [stats[name].atoms if name in stats and stats[name].atoms is not None else np.nan for name in names]
+    costs = fill_median(atoms)
+
+    compute = np.sum(costs * md_steps) if budget is None else budget * np.mean(costs)
+    frame = int(round(max(
+        (float(options.get('liquid_interval', 1.0)) / float(options.get('liquid_timestep', 1.0)) * 1000
+         for options in blocks), default=1000,
+    )))
+    planned = allocate_steps(coefficients, costs, compute, minimum, frame)
+    # Keep each target's ratio of equilibration to production (10% where there is none to go by).
+    ratio = np.divide(eq_steps, md_steps, out=np.full(len(names), 0.1), where=md_steps > 0)
+    planned_eq = (np.round(planned * ratio / frame) * frame).astype(int)
+
+    rows = [
+        BudgetRow(name, None if np.isnan(atom) else int(atom), coefficient / old, int(old), int(eq), int(new),
+                  coefficient / new)
+        for name, atom, coefficient, old, eq, new in zip(names, atoms, coefficients, md_steps, planned_eq, planned)
+    ]
+    new_text = rewrite_optimise_in(text, {row.name: (row.planned_eq_steps, row.planned_md_steps) for row in rows})
+    return BudgetPlan(
+        rows=rows, budget=int(np.sum(planned)), noise=float(np.sum(coefficients / md_steps)),
+        planned_noise=float(np.sum(coefficients / planned)), text=new_text,
+    )
+
+
+def block_steps(options, stats, kind):
+    """liquid_<kind>_steps of a $target block, else the steps it was run for in optimise.out, else 0."""
+
+    key = f'liquid_{kind}_steps'
+    if key in options:
+        return float(options[key])
+    stat = stats.get(options['name'])
+    return float(getattr(stat, f'{kind}_steps')) if stat is not None else 0.0
+
+
+def fill_median(values):
+    """Float array of values with NaNs replaced by the median of the rest (1 if there is none)."""
+
+    values = np.asarray(values, dtype=float)
+    fill = np.nanmedian(values) if np.any(~np.isnan(values)) else 1.0
+    return np.where(np.isnan(values), fill, values)
+
+
+def format_plan(plan):
+    """Aligned table of a BudgetPlan, with the total noise before and after."""
+
+    lines = [f'{"target":<16}{"atoms":>7}{"noise":>12}{"md_steps":>11}{"planned":>11}{"eq":>9}{"planned_noise":>15}']
+    for row in plan.rows:
+        atoms = '' if row.atoms is None else row.atoms
+        lines.append(
+            f'{row.name:<16}{atoms:>7}{row.noise:>12.4g}{row.md_steps:>11}{row.planned_md_steps:>11}'
+            f'{row.planned_eq_steps:>9}{row.planned_noise:>15.4g}'
+        )
+    lines.append(f'Total objective noise: {plan.noise:.4g} -> {plan.planned_noise:.4g}')
+    return '\n'.join(lines)
+
+
+def write_optimise_in(file_path, text):
+    with open(file_path, 'w') as out_file:
+        out_file.write(text)
@@ -1,63 +1,75 @@
 import os
+import re
+import time
 
+from fb_output import FinalObjective, Iteration, OptimiseOutFollower, PropertyResult, Step, read_optimise_out
+from qb_output import qb_out_paths, read_qb_out
 
-def get_dens_hvap_from_qb():
+
+# The results here are keyed by molecule number, e.g. 1 for mol01.
+MOLECULE_NUMBER = re.compile(r'\d+$')
+
+
+def target_number(target):
+    """Molecule number of a ForceBalance target, e.g. 1 for mol01_liquid or 100 for mol100_liquid; else None."""
+
+    number = MOLECULE_NUMBER.search(target.split('_')[0])
+    return None if number is None else int(number.group())
+
+
+def get_dens_hvap_from_qb(run_dir='.'):
     """
     Extract the densities and hvaps from the qubebench output.
+    :param run_dir: directory containing the *_qb_out.txt file(s); later files take precedence
     """
 
-    for file in os.listdir('.'):
-        if file.endswith('_qb_out.txt'):
-            qb_file_path = file
-            break
-    else:
+    qb_file_paths = qb_out_paths(run_dir)
+    if not qb_file_paths:
         raise FileNotFoundError('Cannot find qb output file.')
 
     # Initialise with empty values so order is preserved.
     densities = {i: 0 for i in range(1, 54)}
     enthalpies = {i: 0 for i in range(1, 54)}
 
-    with open(qb_file_path) as qb_file:
-        lines = qb_file.readlines()
-        for i, line in enumerate(lines):
-            if 'Results for:' in line:
-                key = int(line[-4:-2])
-                dens = float(lines[i+4].split('=')[1])
-                hvap = float(lines[i+7].split('=')[1])
-                densities[key] = dens
-                enthalpies[key] = hvap
+    for qb_file_path in qb_file_paths:
+        for result in read_qb_out(qb_file_path):
+            number = MOLECULE_NUMBER.search(result.name)
+            if number is not None:
+                key = int(number.group())
+                densities[key] = result.density
+                enthalpies[key] = result.hvap
 
     return densities, enthalpies
 
 
-def get_dens_hvap_from_fb(file_path='optimise.out'):
+def get_dens_hvap_from_fb(run_dir='.', file_path='optimise.out'):
     """
     Extract the densities and hvaps from the forcebalance output.
-    :param file_path: forcebalance output filepath optimise.out
+    :param run_dir: directory containing the forcebalance output
+    :param file_path: forcebalance output filepath optimise.out, relative to run_dir
     """
 
+    file_path = os.path.join(run_dir, file_path)
+
     densities = dict()
     enthalpies = dict()
 
-    with open(file_path) as opt_file:
-        lines = opt_file.readlines()
-        for i, line in enumerate(lines):
-            if 'Density (kg m^-3)' in line:
-                key = int(line.split('_')[0][-2:])
-                val = float(lines[i + 3].split('+-')[0][-9:].strip()) / 1000
-
-                densities[key] = val
-
-            elif 'Enthalpy of Vaporization (kJ mol^-1)' in line:
-                key = int(line.split('_')[0][-2:])
-                val = float(lines[i + 3].split('+-')[0][-8:].strip()) / 4.184
-
-                enthalpies[key] = val
+    # The last iteration's values win; the log is streamed rather than read in whole.
+    for record in read_optimise_out(file_path):
+        if isinstance(record, PropertyResult):
+            key = target_number(record.target)
+            if key is None:
+                continue
+            if record.quantity == 'Density':
+                densities[key] = record.calculated / 1000
+            elif record.quantity == 'Enthalpy of Vaporization':
+                enthalpies[key] = record.calculated / 4.184
 
     return densities, enthalpies
 
 
-def get_dens_hvap_from_csv(file_path='results.csv'):
+def get_dens_hvap_from_csv(run_dir='.', file_path='results.csv'):
+    file_path = os.path.join(run_dir, file_path)
     densities = {i: 0 for i in range(1, 54)}
     enthalpies = {i: 0 for i in range(1, 54)}
 
@@ -71,48 +83,139 @@ def get_dens_hvap_from_csv(file_path='results.csv'):
     return densities, enthalpies
 
 
-def calc_mues(run_type='qb', halos=False):
+def experimental_data(halos=False):
+    """
+    Experimental densities (g/cm^3) and Hvaps (kcal/mol) of the training set, keyed by molecule number.
+    Read from input_files/training_data.csv (or halo_data.csv).
+    :param halos: use the halogen training set instead.
+    """
+
+    from reference_data import read_reference_rows, reference_file
+
+    rows = read_reference_rows(reference_file('training', halos=halos))
+    densities = {int(name[3:]): density for name, density, _, _ in rows}
+    enthalpies = {int(name[3:]): hvap for name, _, hvap, _ in rows}
+    return densities, enthalpies
+
+
+def calc_mues(run_type='qb', halos=False, run_dir='.', resamples=0, confidence=0.95, seed=None):
     """
     Calculate the MUEs for the QUBEBench and Forcebalance outputs
+    :param run_type: which output to read; 'qb', 'fb' or 'csv'
+    :param run_dir: directory containing the outputs, e.g. runs/training/model0
+    :param resamples: if > 0, also print bootstrap confidence intervals of the MUEs from this many resamples
+        of the molecules (including ForceBalance's standard errors for 'fb').
     """
 
-    if halos:
-        exp_densities = {
-            1: 1096, 2: 831, 3: 707.47, 4: 1182.86, 5: 867.47,
-            6: 1153, 7: 1345.5, 8: 1209.52, 11: 1282.14,
-            12: 1989.90,
-        }
-        exp_enthalpies = {
-            1: 52.9, 2: 28.41, 3: 20.7, 4: 19.2, 5: 31.5,
-            6: 36.2, 7: 31.9, 8: 37.15, 11: 21.9, 12: 17.5,
-        }
-    else:
-        exp_densities = {
-            1: 787, 2: 787, 3: 733, 4: 736, 5: 713,
-            6: 862, 7: 861, 8: 944, 9: 973, 10: 1022,
-            11: 810, 12: 620, 13: 662, 14: 785, 15: 785,
-        }
-        exp_enthalpies = {
-            1: 37.8, 2: 33.4, 3: 35.8, 4: 27.9, 5: 27.4,
-            6: 38.1, 7: 42.4, 8: 46.8, 9: 27.7, 10: 55.8,
-            11: 52, 12: 25.2, 13: 23.9, 14: 31.3, 15: 45.5,
-        }
-    exp_densities = {key: value / 1000 for key, value in exp_densities.items()}
-    exp_enthalpies = {key: value / 4.184 for key, value in exp_enthalpies.items()}
+    exp_densities, exp_enthalpies = experimental_data(halos)
 
     densities, enthalpies = {
         'qb': get_dens_hvap_from_qb,
         'fb': get_dens_hvap_from_fb,
         'csv': get_dens_hvap_from_csv,
-    }.get(run_type)()
+    }[run_type](run_dir)
 
-    dens_avg_mue = sum(abs(dens - exp_dens) for dens, exp_dens in zip(densities.values(), exp_densities.values())) / len(exp_densities)
-    hvap_avg_mue = sum(abs(hvap - exp_hvap) for hvap, exp_hvap in zip(enthalpies.values(), exp_enthalpies.values())) / len(exp_enthalpies)
+    # Matched on molecule number, not position; molecules without experimental data are ignored.
+    dens_avg_mue = sum(abs(densities.get(key, 0) - exp_dens) for key, exp_dens in exp_densities.items()) / len(exp_densities)
+    hvap_avg_mue = sum(abs(enthalpies.get(key, 0) - exp_hvap) for key, exp_hvap in exp_enthalpies.items()) / len(exp_enthalpies)
 
     print(f'Density, Hvap MUEs: {round(dens_avg_mue, 4)}, {round(hvap_avg_mue, 4)}')
 
+    if resamples:
+        import numpy as np
+
+        from bootstrap import bootstrap_mues, confidence_interval
+        from leaderboard import read_results
+
+        stdevs = {}
+        if run_type == 'fb':
+            stdevs = {int(name[3:]): result[2:] for name, result in read_results(run_dir, 'fb').items()}
+
+        intervals = []
+        for column, (values, exp_values) in enumerate(((densities, exp_densities), (enthalpies, exp_enthalpies))):
+            errors = [values.get(key, 0) - exp_value for key, exp_value in exp_values.items()]
+            errors_stdev = [stdevs.get(key, (0, 0))[column] for key in exp_values]
+            replicates, _ = bootstrap_mues([errors], [errors_stdev], resamples=resamples, seed=seed)
+            intervals.append(np.round(confidence_interval(replicates, confidence), 4).ravel().tolist())
+
+        print(f'{confidence:.0%} CIs: [{intervals[0][0]}, {intervals[0][1]}], [{intervals[1][0]}, {intervals[1][1]}]')
+
+
+def follow_runs(run_dirs=('.',), halos=False, interval=10.0, once=False, file_path='optimise.out'):
+    """
+    Follow the forcebalance output of one or more running optimisations.
+    Each poll only reads what has been appended to each log since the last one.
+    The running density and Hvap MUEs of the current iteration are printed as each target finishes,
+    and a row of the convergence table as each iteration finishes.
+    Stops once every run has converged.
+    :param run_dirs: directories containing the forcebalance outputs
+    :param interval: seconds between polls
+    :param once: report what is in the logs so far and return instead of waiting for more
+    :param file_path: forcebalance output filepath, relative to each run_dir
+    """
+
+    exp_densities, exp_enthalpies = experimental_data(halos)
+    followers = {
+        os.path.normpath(run_dir): OptimiseOutFollower(os.path.join(run_dir, file_path)) for run_dir in run_dirs
+    }
+    width = max(len(run) for run in followers)
+    # Per run, the densities and enthalpies of the iteration in progress; None once converged.
+    current = {run: ({}, {}) for run in followers}
+
+    print(f'{"run":<{width}}  iter  {"-=X2=-":>11}  {"Delta(X2)":>10}  {"|grad|":>9}  {"|dk|":>9}  StepQual', flush=True)
+    while True:
+        for run, follower in followers.items():
+            for record in follower.poll():
+                if isinstance(record, Iteration):
+                    current[run] = ({}, {})
+
+                elif isinstance(record, PropertyResult) and current[run] is not None:
+                    densities, enthalpies = current[run]
+                    key = target_number(record.target)
+                    if key is None:
+                        continue
+                    if record.quantity == 'Density':
+                        densities[key] = record.calculated / 1000
+                    elif record.quantity == 'Enthalpy of Vaporization':
+                        enthalpies[key] = record.calculated / 4.184
+                        # As in calc_mues, only molecules with a reference value count towards the MUEs.
+                        dens_errors = [abs(dens - exp_densities[mol]) for mol, dens in densities.items()
+                                       if mol in exp_densities]
+                        hvap_errors = [abs(hvap - exp_enthalpies[mol]) for mol, hvap in enthalpies.items()
+                                       if mol in exp_enthalpies]
+                        if not dens_errors or not hvap_errors:
+                            continue
+                        dens_mue = sum(dens_errors) / len(dens_errors)
+                        hvap_mue = sum(hvap_errors) / len(hvap_errors)
+                        print(
+                            f'{run:<{width}}  {record.iteration:>4}  {record.target}: running density, Hvap MUEs '
+                            f'over {len(hvap_errors)} targets: {round(dens_mue, 4)}, {round(hvap_mue, 4)}',
+                            flush=True,
+                        )
+
+                elif isinstance(record, Step):
+                    print(
+                        f'{run:<{width}}  {record.step:>4}  {record.objective:>11.5e}  {record.delta:>10.3e}  '
+                        f'{record.grad:>9.3e}  {record.dk:>9.3e}  {record.quality:>8.3f}',
+                        flush=True,
+                    )
+
+                elif isinstance(record, FinalObjective):
+                    current[run] = None
+                    print(
+                        f'{run:<{width}}  converged: objective {record.objective:.6e}, '
+                        f'un-penalized {record.unpenalized:.6e}',
+                        flush=True,
+                    )
+
+        if once or all(state is None for state in current.values()):
+            return
+        time.sleep(interval)
+
 
 if __name__ == '__main__':
+    import sys
+
+    from qubekit2_data import main
 
-    os.chdir('../runs/training/019')
-    calc_mues('qb', halos=False)
+    sys.exit(main(['mue', *sys.argv[1:]]))
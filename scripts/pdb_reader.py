@@ -0,0 +1,218 @@
+"""
+Fixed-width PDB reader for the ForceBalance liquid.pdb / gas.pdb targets.
+
+Files are memory-mapped and viewed as byte arrays; the ATOM/HETATM lines are found from the newline positions and
+every field is cut out of all lines at once by its PDB columns, so a 3000-atom box costs a few array operations
+rather than 3000 line splits:
+    columns 13-16 atom name, 18-20 residue name, 23-26 residue number, 31-38/39-46/47-54 x/y/z, 77-78 element
+    CRYST1 columns 7-15/16-24/25-33 box lengths, 34-40/41-47/48-54 angles
+Coordinates written as %8.3f (as PDB requires) are decoded as fixed-point integers, exactly;
+any other layout falls back to NumPy's float parsing.
+Files read together (read_pdbs, read_targets) have their atom lines decoded in one batch.
+
+    structures = read_targets('example_fb_run/targets')
+    box = structures['mol01_liquid']['liquid'].box
+"""
+
+from collections import namedtuple
+from contextlib import ExitStack
+import mmap
+import os
+
+import numpy as np
+
+
+# coordinates: (atoms, 3) in Angstrom; box and angles: (3,) from CRYST1, or None when there is no CRYST1 record.
+PdbStructure = namedtuple('PdbStructure', 'coordinates names residue_names residue_numbers elements box angles')
+
+TARGET_FILES = ('liquid.pdb', 'gas.pdb')
+
+_ATOM = np.frombuffer(b'ATOM  ', dtype=np.uint8)
+_HETATM = np.frombuffer(b'HETATM', dtype=np.uint8)
+_CRYST1 = np.frombuffer(b'CRYST1', dtype=np.uint8)
+_SPACE, _MINUS, _POINT, _ZERO = b' -.0'
+# Digit weights of a %8.3f field, in thousandths; the decimal point (column 5 of the field) has no weight.
+_FIXED_POINT = np.array([1000000, 100000, 10000, 1000, 0, 100, 10, 1], dtype=np.int64)
+# Atom lines are read up to the end of the element symbol (column 78).
+ATOM_WIDTH = 78
+
+
+def _lines(data):
+    """Start offset and length (without the line ending) of every line of a byte array."""
+
+    newlines = np.flatnonzero(data == ord('\n'))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.append(newlines, len(data))
+    if len(data) and data[-1] == ord('\n'):
+        starts, ends = starts[:-1], ends[:-1]
+    # Drop the \r of \r\n endings.
+    ends = ends - ((ends > starts) & (data[np.maximum(ends - 1, 0)] == ord('\r')))
+    return starts, ends - starts
+
+
+def _columns(data, starts, lengths, first, last):
+    """
+    Bytes first:last (0-based, end exclusive) of each line as an (lines, last - first) array;
+    positions past the end of a line read as spaces.
+    """
+
+    offsets = np.arange(first, last)
+    index = starts[:, None] + offsets
+    inside = offsets < lengths[:, None]
+    return np.where(inside, data[np.minimum(index, len(data) - 1)], _SPACE).astype(np.uint8)
+
+
+def _atom_table(data, starts, lengths):
+    """
+    The atom lines as an (atoms, ATOM_WIDTH) byte array.
+    Lines of one width written back to back (as every writer does) are a strided view of the file itself;
+    otherwise each is copied out and padded with spaces.
+    """
+
+    if len(starts) and np.all(lengths == lengths[0]) and lengths[0] >= ATOM_WIDTH:
+        stride = starts[1] - starts[0] if len(starts) > 1 else 0
+        if len(starts) == 1 or np.all(np.diff(starts) == stride):
+            return np.lib.stride_tricks.as_strided(
+                data[starts[0]:], shape=(len(starts), ATOM_WIDTH), strides=(stride, 1), writeable=False,
+            )
+    return _columns(data, starts, lengths, 0, ATOM_WIDTH)
+
+
+def _strings(columns):
+    """Decode an (n, width) byte array into stripped str."""
+
+    width = columns.shape[1]
+    return np.char.strip(np.ascontiguousarray(columns).view(f'S{width}').ravel().astype(f'U{width}'))
+
+
+def _integers(columns):
+    """Decode right-justified integer fields, given as an (n, width) byte array; blank fields are 0."""
+
+    digits = columns.astype(np.int64) - _ZERO
+    digits[(digits < 0) | (digits > 9)] = 0
+    values = digits @ 10 ** np.arange(columns.shape[1] - 1, -1, -1, dtype=np.int64)
+    return np.where(np.any(columns == _MINUS, axis=1), -values, values)
+
+
+def _floats(columns):
+    """
+    Decode 8-wide number fields, given as a (..., 8) byte array.
+    %8.3f fields are read as integers of thousandths, one column of every field at a time;
+    anything else goes through NumPy's float parsing.
+    """
+
+    columns = np.ascontiguousarray(columns)
+    if np.all(columns[..., 4] == _POINT):
+        values = np.zeros(columns.shape[:-1], dtype=np.int64)
+        negative = np.zeros(columns.shape[:-1], dtype=bool)
+        for position, weight in enumerate(_FIXED_POINT):
+            if not weight:
+                continue
+            column = columns[..., position]
+            digit = column - np.uint8(_ZERO)
+            is_digit = digit < 10
+            if not np.all(is_digit | (column == _SPACE) | (column == _MINUS)):
+                break
+            negative |= column == _MINUS
+            values += np.where(is_digit, digit, 0) * weight
+        else:
+            return np.where(negative, -values, values) / 1000
+
+    return columns.view('S8')[..., 0].astype(float)
+
+
+def _scan(data):
+    """
+    Find the atom lines and the CRYST1 record of one file held as a byte array.
+    :return: (atoms, ATOM_WIDTH) byte array of the atom lines, box, angles
+    """
+
+    if not len(data):
+        return np.zeros((0, ATOM_WIDTH), dtype=np.uint8), None, None
+
+    starts, lengths = _lines(data)
+    record = _columns(data, starts, lengths, 0, 6)
+    atoms = np.all(record == _ATOM, axis=1) | np.all(record == _HETATM, axis=1)
+    table = _atom_table(data, starts[atoms], lengths[atoms])
+
+    cryst1 = np.flatnonzero(np.all(record == _CRYST1, axis=1))
+    if not len(cryst1):
+        return table, None, None
+    line = _columns(data, starts[cryst1[:1]], lengths[cryst1[:1]], 0, 54)[0].tobytes()
+    box = np.array([float(line[first:first + 9]) for first in (6, 15, 24)])
+    angles = np.array([float(line[first:first + 7]) for first in (33, 40, 47)])
+    return table, box, angles
+
+
+def parse_pdbs(buffers):
+    """
+    Decode the atoms and box of several PDBs held in memory, with their atom lines decoded together.
+    :param buffers: bytes, mmaps or uint8 arrays, each of a whole file
+    :return: list of PdbStructure, one per buffer
+    """
+
+    scanned = [_scan(np.frombuffer(buffer, dtype=np.uint8)) for buffer in buffers]
+    if not scanned:
+        return []
+    table = np.concatenate([atom_table for atom_table, _, _ in scanned])
+
+    fields = [
+        _floats(table[:, 30:54].reshape(len(table), 3, 8)),
+        _strings(table[:, 12:16]),
+        _strings(table[:, 17:20]),
+        _integers(table[:, 22:26]),
+        _strings(table[:, 76:78]),
+    ]
+    split = np.cumsum([len(atom_table) for atom_table, _, _ in scanned])[:-1]
+    per_file = zip(*(np.split(field, split) for field in fields))
+    return [PdbStructure(*atoms, box, angles) for atoms, (_, box, angles) in zip(per_file, scanned)]
+
+
+def parse_pdb(data):
+    """
+    Decode the atoms and box of a PDB held in memory.
+    :param data: bytes, mmap or uint8 array of the whole file
+    :return: PdbStructure
+    """
+
+    return parse_pdbs([data])[0]
+
+
+def read_pdbs(file_paths):
+    """Memory-map several PDB files and decode them in one batch; see parse_pdbs."""
+
+    with ExitStack() as stack:
+        buffers = []
+        for file_path in file_paths:
+            pdb_file = stack.enter_context(open(file_path, 'rb'))
+            if os.fstat(pdb_file.fileno()).st_size == 0:
+                buffers.append(b'')
+            else:
+                buffers.append(stack.enter_context(mmap.mmap(pdb_file.fileno(), 0, access=mmap.ACCESS_READ)))
+        # Every returned array is a decoded copy, so the maps can be closed straight away.
+        return parse_pdbs(buffers)
+
+
+def read_pdb(file_path):
+    """Memory-map a PDB file and decode it; see parse_pdb."""
+    return read_pdbs([file_path])[0]
+
+
+def read_targets(targets_dir='targets', file_names=TARGET_FILES):
+    """
+    Load the pdbs of every ForceBalance target in a directory, e.g. example_fb_run/targets, in one batch.
+    :param file_names: which pdbs to read from each target directory, where present
+    :return: dict of target name (e.g. mol01_liquid): {'liquid': PdbStructure, 'gas': PdbStructure}
+    """
+
+    found = []
+    for target in sorted(os.listdir(targets_dir)):
+        for file_name in file_names:
+            file_path = os.path.join(targets_dir, target, file_name)
+            if os.path.isfile(file_path):
+                found.append((target, file_name[:-len('.pdb')], file_path))
+
+    structures = {}
+    for (target, kind, _), structure in zip(found, read_pdbs([file_path for _, _, file_path in found])):
+        structures.setdefault(target, {})[kind] = structure
+    return structures
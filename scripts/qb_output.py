@@ -0,0 +1,110 @@
+"""
+Single-pass parser for QUBEBench's *_qb_out.txt.
+
+Each molecule's block is read field by field rather than at fixed offsets from its header, so the gmx / CUDA
+error lines and stray molecule names QUBEBench interleaves with the results are skipped wherever they fall:
+    Results for: mol01.
+    Energy at minima is 9.583 kcal/mol
+    Average liquid temperature (K) =  298.23742
+    Average liquid energy (kcal / mol) =  6.49378
+    Average liquid density (g / cc) =  0.85298
+    Average gas temperature (K) =  300.62202
+    Average gas energy (kcal / mol) =  13.24668
+    Heat of vap (kcal/mol) =  7.31658
+becomes QbResult('mol01', 9.583, 298.23742, 6.49378, 0.85298, 300.62202, 13.24668, 7.31658);
+fields missing from a block are None. Molecule names are taken as written, so they need not be molNN.
+
+A run directory may hold several *_qb_out.txt files (e.g. a rerun of some molecules); read_run_dirs parses every
+one of them, across any number of run directories, in a process pool, with later files taking precedence.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
+
+
+QbResult = namedtuple(
+    'QbResult',
+    'name minimum_energy liquid_temperature liquid_energy density gas_temperature gas_energy hvap',
+)
+
+_NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|nan'
+# One alternative per line of a result block; lastgroup names the field a line holds.
+LINE = re.compile(
+    r'(?:Results for:\s*(?P<name>\S+?)\.?'
+    rf'|Energy at minima is\s+(?P<minimum_energy>{_NUMBER})\s+kcal/mol'
+    rf'|Average liquid temperature \(K\) =\s*(?P<liquid_temperature>{_NUMBER})'
+    rf'|Average liquid energy \(kcal / mol\) =\s*(?P<liquid_energy>{_NUMBER})'
+    rf'|Average liquid density \(g / cc\) =\s*(?P<density>{_NUMBER})'
+    rf'|Average gas temperature \(K\) =\s*(?P<gas_temperature>{_NUMBER})'
+    rf'|Average gas energy \(kcal / mol\) =\s*(?P<gas_energy>{_NUMBER})'
+    rf'|Heat of vap \(kcal/mol\) =\s*(?P<hvap>{_NUMBER}))\s*'
+)
+
+QB_OUT_SUFFIX = '_qb_out.txt'
+
+
+def parse_qb_out(lines):
+    """
+    Parse an iterable of *_qb_out.txt lines, e.g. an open file.
+    :return: generator of QbResult, one per Results for: block in the order they appear
+    """
+
+    fields = None
+    for line in lines:
+        match = LINE.fullmatch(line.strip())
+        if match is None:
+            continue
+        field = match.lastgroup
+        if field == 'name':
+            if fields is not None:
+                yield QbResult(**fields)
+            fields = dict.fromkeys(QbResult._fields)
+            fields['name'] = match.group('name')
+        elif fields is not None:
+            fields[field] = float(match.group(field))
+
+    if fields is not None:
+        yield QbResult(**fields)
+
+
+def read_qb_out(file_path):
+    """All the result blocks of one *_qb_out.txt, as a list of QbResult."""
+
+    with open(file_path) as qb_file:
+        return list(parse_qb_out(qb_file))
+
+
+def qb_out_paths(run_dir='.'):
+    """Every *_qb_out.txt in run_dir, sorted by name."""
+    return [os.path.join(run_dir, file) for file in sorted(os.listdir(run_dir)) if file.endswith(QB_OUT_SUFFIX)]
+
+
+def read_qb_outs(file_paths, jobs=1):
+    """
+    Parse several *_qb_out.txt files, in a process pool if jobs > 1.
+    :return: list of the QbResult lists, in the same order as file_paths
+    """
+
+    file_paths = list(file_paths)
+    if jobs > 1 and len(file_paths) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(read_qb_out, file_paths))
+    return [read_qb_out(file_path) for file_path in file_paths]
+
+
+def read_run_dirs(run_dirs, jobs=1):
+    """
+    Parse every *_qb_out.txt in each of run_dirs, all at once.
+    Where a molecule appears more than once in a directory, the last block (of the last file by name) is kept.
+    :return: dict of run_dir: {molecule name: QbResult}
+    """
+
+    run_dirs = list(run_dirs)
+    paths = [(run_dir, path) for run_dir in run_dirs for path in qb_out_paths(run_dir)]
+
+    results = {run_dir: {} for run_dir in run_dirs}
+    for (run_dir, _), file_results in zip(paths, read_qb_outs([path for _, path in paths], jobs)):
+        results[run_dir].update((result.name, result) for result in file_results)
+    return results
@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+
+"""
+Single entry point for the QUBEKit2 data scripts.
+
+    qubekit2-data combine [-j N] [--manifest manifest.json] ...
+    qubekit2-data combine -j 4 runs/training/model* runs/test/model*
+    qubekit2-data combine-halos
+    qubekit2-data combine-008
+    qubekit2-data mue runs/training/model0 --source fb
+    qubekit2-data mue --follow runs/training/model*
+    qubekit2-data leaderboard runs --sort-by hvap_mue
+    qubekit2-data leaderboard --bootstrap --baseline model0
+    qubekit2-data rfree combined.xml --param CElement/cfree=2.1
+    qubekit2-data jacobian forcefield/combined.xml --dense
+    qubekit2-data screen combined.xml --vary CElement/cfree=1.9:2.3 --vary HElement/hfree=1.4:1.8 --random 5000 -j 4
+    qubekit2-data ingest --db results.sqlite
+    qubekit2-data query density --run-set training --matrix
+    qubekit2-data collect --dest .
+    qubekit2-data liquid-box targets -j 8
+    qubekit2-data targets input_files/Q2_halos.csv --pdbs runs/training/model0 --dest halo_run -j 8
+    qubekit2-data budget runs/training/model0/optimise.out --targets runs/training/targets --budget 12000000
+    qubekit2-data check example_fb_run/forcefield/combined.xml --targets example_fb_run/targets
+    qubekit2-data split result/optimise/combined.xml --optimise-out optimise.out --dest optimised
+
+Only argparse and os are imported up front; every subcommand imports what it needs when it runs,
+so `--help` and light subcommands start without paying for NumPy and the xml machinery.
+Use -C to run in another directory instead of relying on the current one.
+"""
+
+import argparse
+import os
+
+
+def run_combine(args):
+    from ddec_cache import DEFAULT_MAX_BYTES
+    from manifest import get_manifest
+    from xml_combiner import ParseXML, combine_models
+
+    options = dict(
+        jobs=args.jobs, cache_dir=None if args.no_cache else args.cache_dir, rebuild=args.rebuild,
+        ddec_cache_size=DEFAULT_MAX_BYTES if args.cache_size is None else int(args.cache_size * 1024 ** 2),
+    )
+    if not args.model_dirs:
+        ParseXML(manifest=get_manifest('.', args.manifest, args.reindex), **options)
+        return
+
+    root = os.path.commonpath([os.path.abspath(model_dir) for model_dir in args.model_dirs])
+    combine_models(args.model_dirs, manifest=get_manifest(root, args.manifest, args.reindex), **options)
+
+
+def run_combine_halos(args):
+    from xml_combiner_halos import ParseXML
+
+    ParseXML(cache_dir=None if args.no_cache else args.cache_dir)
+
+
+def run_combine_008(args):
+    from xml_combiner_008 import ParseXML
+
+    ParseXML(cache_dir=None if args.no_cache else args.cache_dir)
+
+
+def run_mue(args):
+    from mue import calc_mues, follow_runs
+
+    if args.follow:
+        follow_runs(args.run_dirs or ['.'], halos=args.halos, interval=args.interval, once=args.once)
+        return
+
+    for run_dir in args.run_dirs or ['.']:
+        if len(args.run_dirs) > 1:
+            print(f'{run_dir}: ', end='')
+        calc_mues(args.source, halos=args.halos, run_dir=run_dir, resamples=args.bootstrap, seed=args.seed)
+
+
+def run_leaderboard(args):
+    from leaderboard import (
+        bootstrap_leaderboard, build_leaderboard, format_leaderboard, format_uncertainties, load_groups,
+        sort_leaderboard, write_leaderboard, write_uncertainties,
+    )
+
+    groups = load_groups(args.runs_root, args.source, args.reference, args.jobs)
+    rows = sort_leaderboard(build_leaderboard(groups=groups), args.sort_by)
+    print(format_leaderboard(rows))
+    if args.output is not None:
+        write_leaderboard(args.output, rows)
+
+    if args.bootstrap:
+        uncertainties = bootstrap_leaderboard(
+            groups, rows, args.bootstrap, args.confidence, args.seed, args.baseline,
+        )
+        print()
+        print(format_uncertainties(uncertainties, args.confidence))
+        if args.bootstrap_output is not None:
+            write_uncertainties(args.bootstrap_output, uncertainties)
+
+
+def run_rfree(args):
+    import csv
+    import sys
+
+    from rfree import compile_forcefield, evaluate, parameter_vector
+
+    terms = compile_forcefield(require_file(args.xml))
+    sigma, epsilon = evaluate(terms, parameter_vector(terms, parse_params(args.param, terms.parameter_names)))
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['type', 'sigma', 'epsilon'])
+    writer.writerows(zip(terms.types, sigma.tolist(), epsilon.tolist()))
+
+
+def require_file(file_path):
+    if not os.path.isfile(file_path):
+        raise SystemExit(f'No such file: {file_path}')
+    return file_path
+
+
+def parse_params(assignments, parameter_names=None):
+    values = {}
+    for assignment in assignments:
+        name, _, value = assignment.partition('=')
+        try:
+            values[name] = float(value)
+        except ValueError:
+            raise SystemExit(f'Expected --param NAME=VALUE, got {assignment!r}') from None
+        if not name:
+            raise SystemExit(f'Expected --param NAME=VALUE, got {assignment!r}')
+        if parameter_names is not None and name not in parameter_names:
+            raise SystemExit(f'Unknown parameter {name}; expected one of {", ".join(parameter_names)}')
+    return values
+
+
+def run_jacobian(args):
+    from jacobian import default_path, save_jacobian
+    from rfree import compile_forcefield, parameter_vector
+
+    terms = compile_forcefield(require_file(args.xml))
+    output = args.output or default_path(args.xml)
+    parameters = parameter_vector(terms, parse_params(args.param, terms.parameter_names))
+    save_jacobian(output, terms, parameters, dense=args.dense)
+    print(f'Saved d(sigma, epsilon)/d({", ".join(terms.parameter_names)}) of {len(terms.types)} atoms to {output}')
+
+
+def run_screen(args):
+    from rfree import compile_forcefield
+    from rfree_screen import grid_sets, parse_range, random_sets, screen, write_ranking
+
+    terms = compile_forcefield(require_file(args.xml))
+    try:
+        ranges = [parse_range(spec) for spec in args.vary]
+        if args.random:
+            sets = random_sets(terms, ranges, args.random, args.seed)
+        else:
+            sets = grid_sets(terms, ranges)
+    except (KeyError, ValueError) as error:
+        # A bad --vary: its range does not parse, or it names a parameter the forcefield does not have.
+        raise SystemExit(f'--vary: {error.args[0]}') from None
+
+    stats = screen(terms, sets, jobs=args.jobs)
+    write_ranking(args.output, terms, sets, stats, args.rank_by, args.descending, args.top)
+    print(f'Screened {len(sets)} parameter sets; ranked by {args.rank_by} in {args.output}')
+
+
+def run_ingest(args):
+    from results_db import ResultsDatabase
+
+    with ResultsDatabase(args.db) as database:
+        summary = database.ingest(args.root, verbose=args.verbose)
+    print(
+        f'{args.db}: {summary.added} added, {summary.updated} updated, {summary.unchanged} unchanged, '
+        f'{summary.removed} removed'
+    )
+
+
+def run_query(args):
+    import csv
+    import sys
+
+    from results_db import ResultsDatabase
+
+    if args.iteration in ('last', 'all'):
+        iteration = None if args.iteration == 'all' else 'last'
+    else:
+        iteration = int(args.iteration)
+    writer = csv.writer(sys.stdout)
+    with ResultsDatabase(args.db) as database:
+        if args.matrix:
+            models, molecules, values = database.matrix(args.property, args.run_set, args.source, iteration)
+            writer.writerow(['run_set', 'model', *molecules])
+            writer.writerows([*model, *row] for model, row in zip(models, values.tolist()))
+        else:
+            rows = database.query(args.property, args.run_set, args.model, args.molecule, args.source, iteration)
+            writer.writerow(rows.dtype.names)
+            writer.writerows(rows.tolist())
+
+
+def run_collect(args):
+    from manifest import collect_runs, get_manifest
+
+    for run_dir in collect_runs(get_manifest(args.root, args.manifest, args.reindex), args.dest):
+        print(os.path.basename(run_dir))
+
+
+def run_liquid_box(args):
+    from liquid_box import GAS_PDB, box_specs, build_boxes, molecule_name, reference_densities, target_dirs
+
+    paths = []
+    for path in args.paths or ['targets']:
+        is_targets_dir = os.path.isdir(path) and not os.path.isfile(os.path.join(path, GAS_PDB))
+        paths.extend(target_dirs(path) if is_targets_dir else [path])
+    if args.density is None:
+        densities = reference_densities(args.reference)
+    else:
+        densities = {molecule_name(path): args.density for path in paths}
+
+    specs = box_specs(paths, densities, args.output, args.overwrite)
+    if len(specs) < len(paths):
+        print(f'Keeping {len(paths) - len(specs)} existing boxes; use --overwrite to rebuild them.')
+    boxes = build_boxes(
+        specs, args.molecules, args.scale, args.tolerance, args.placement, args.seed, args.jobs,
+    )
+    for (_, output_path, _), box in zip(specs, boxes):
+        print(f'{output_path}: {args.molecules} molecules in a {box:g} A box')
+
+
+def run_targets(args):
+    from target_tree import build_target_tree
+
+    specs, missing = build_target_tree(
+        args.molecules_csv, args.reference, args.dest, args.pdbs, args.forcefield, args.molecules, args.scale,
+        not args.no_boxes, args.seed, args.overwrite, args.jobs,
+    )
+    print(f'Wrote {len(specs)} targets and optimise.in to {args.dest}')
+    without_pdb = [spec.name for spec in specs if spec.pdb_path is None]
+    if args.pdbs is not None and without_pdb:
+        print(f'No pdb in {args.pdbs} (so no gas.pdb or liquid.pdb) for: {", ".join(without_pdb)}')
+    if missing:
+        print(f'No reference data for: {", ".join(missing)}')
+
+
+def run_budget(args):
+    from md_budget import format_plan, plan_budget, write_optimise_in
+
+    plan = plan_budget(args.optimise_out, args.targets, args.optimise_in, args.budget, args.minimum)
+    print(format_plan(plan))
+    if args.output is not None:
+        write_optimise_in(args.output, plan.text)
+        print(f'Wrote {args.output} ({plan.budget} md steps in total)')
+
+
+def run_check(args):
+    from forcefield_check import check_consistency, format_issues
+
+    issues = check_consistency(args.forcefield, args.targets, args.sources)
+    print(format_issues(issues))
+    return 1 if issues else 0
+
+
+def run_split(args):
+    from xml_splitter import split_forcefield
+
+    written = split_forcefield(require_file(args.forcefield), args.dest, args.optimise_out, parse_params(args.param))
+    print(f'Wrote {len(written)} molecule xmls to {args.dest}')
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        '--cache-dir', default='.combiner_cache',
+        help='Directory for cached per-molecule data, reused when the source files are unchanged.',
+    )
+    parser.add_argument('--no-cache', action='store_true', help='Neither read nor write any cache.')
+
+
+def add_manifest_arguments(parser):
+    parser.add_argument(
+        '--manifest', default=None,
+        help='Reuse (or create) a saved index of the run folders instead of walking the tree every time.',
+    )
+    parser.add_argument('--reindex', action='store_true', help='Re-index the run folders even if --manifest exists.')
+
+
+def add_param_arguments(parser):
+    parser.add_argument(
+        '--param', action='append', default=[], metavar='NAME=VALUE',
+        help='Parameter value, e.g. CElement/cfree=2.1 or xbeta/beta=0.5; repeat for several. '
+             'Others keep the values in the ForceBalance section.',
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='qubekit2-data', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('-C', '--directory', default=None, help='Run as if started in this directory.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    combine = subparsers.add_parser(
+        'combine', help='Combine QUBEKit run folders into combined.xml for ForceBalance.',
+        description='Combine QUBEKit run folders into combined.xml for ForceBalance.',
+    )
+    combine.add_argument(
+        'model_dirs', nargs='*',
+        help='Build combined.xml in each of these directories in one go (default: just the current directory).',
+    )
+    combine.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of processes used to load the molecule xmls and DDEC data.',
+    )
+    add_cache_arguments(combine)
+    combine.add_argument('--rebuild', action='store_true', help='Re-render every molecule, ignoring the cache.')
+    combine.add_argument(
+        '--cache-size', type=float, default=None,
+        help='Size cap (MB) of the parsed Chargemol cache; least recently used molecules are evicted beyond it.',
+    )
+    add_manifest_arguments(combine)
+    combine.set_defaults(handler=run_combine)
+
+    for name, handler, help_text in (
+            ('combine-halos', run_combine_halos, 'combined.xml with the halogen (and sulfur) Rfree parameters.'),
+            ('combine-008', run_combine_008, 'combined.xml for model 008, scaling the QUBEKit epsilons directly.'),
+    ):
+        variant = subparsers.add_parser(name, help=help_text, description=help_text)
+        add_cache_arguments(variant)
+        variant.set_defaults(handler=handler)
+
+    mue = subparsers.add_parser(
+        'mue', help='Density and Hvap MUEs against experiment.',
+        description='Density and Hvap MUEs against experiment.',
+    )
+    mue.add_argument('run_dirs', nargs='*', help='Directories containing the outputs to score (default: .).')
+    mue.add_argument(
+        '--source', choices=('qb', 'fb', 'csv'), default='qb',
+        help='Read the QUBEBench output (*_qb_out.txt), ForceBalance output (optimise.out) or results.csv.',
+    )
+    mue.add_argument('--halos', action='store_true', help='Compare against the halogen training set.')
+    mue.add_argument(
+        '--follow', action='store_true',
+        help='Follow running optimisations: poll each optimise.out, read only what was appended, and report the '
+             'running MUEs as targets finish and the convergence table as iterations finish.',
+    )
+    mue.add_argument('--interval', type=float, default=10.0, help='Seconds between polls with --follow.')
+    mue.add_argument('--once', action='store_true', help='With --follow, report what is there so far and exit.')
+    mue.add_argument(
+        '--bootstrap', type=int, nargs='?', const=10000, default=0, metavar='RESAMPLES',
+        help='Also print 95%% bootstrap confidence intervals of the MUEs (10000 resamples unless given).',
+    )
+    mue.add_argument('--seed', type=int, default=None, help='Seed for --bootstrap.')
+    mue.set_defaults(handler=run_mue)
+
+    leaderboard = subparsers.add_parser(
+        'leaderboard', help='Density and Hvap MUE, RMSE and signed error of every model, best first.',
+        description='Score every model directory under <runs_root>/training and <runs_root>/test against the '
+                    'reference tables in input_files, joined on molecule name, and print them best first.',
+    )
+    leaderboard.add_argument('runs_root', nargs='?', default='runs', help='Directory containing the groups of models.')
+    leaderboard.add_argument(
+        '--source', choices=('qb', 'csv', 'fb'), default=None,
+        help='Only score models with this output (default: each model\'s *_qb_out.txt, else results.csv, '
+             'else optimise.out).',
+    )
+    leaderboard.add_argument(
+        '--reference', default=None, help='Reference csv (molecule,density,hvap,temp) to use for every group.',
+    )
+    leaderboard.add_argument(
+        '--sort-by', default='density_mue',
+        help='Column to rank on, e.g. hvap_mue or density_rmse; signed errors rank by size (default: density_mue).',
+    )
+    leaderboard.add_argument(
+        '-j', '--jobs', type=int, default=1, help='Number of processes used to parse the *_qb_out.txt files.',
+    )
+    leaderboard.add_argument('-o', '--output', default=None, help='Also write the leaderboard to this csv.')
+    leaderboard.add_argument(
+        '--bootstrap', type=int, nargs='?', const=10000, default=0, metavar='RESAMPLES',
+        help='Bootstrap confidence intervals of each MUE over the molecules (10000 resamples unless given), '
+             'and paired tests of every model against the best of its group.',
+    )
+    leaderboard.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the intervals.')
+    leaderboard.add_argument('--seed', type=int, default=None, help='Seed for --bootstrap.')
+    leaderboard.add_argument(
+        '--baseline', default=None, help='Model to compare the others against with --bootstrap (default: the best).',
+    )
+    leaderboard.add_argument('--bootstrap-output', default=None, help='Also write the --bootstrap results to this csv.')
+    leaderboard.set_defaults(handler=run_leaderboard)
+
+    rfree = subparsers.add_parser(
+        'rfree', help='Sigma and epsilon of every atom in a combined.xml for a set of Rfree parameters.',
+        description='Evaluate the parameter_eval of every atom in a combined.xml at once and write type,sigma,epsilon '
+                    'as csv; parameters not given keep the values in the ForceBalance section.',
+    )
+    rfree.add_argument('xml', nargs='?', default='combined.xml', help='Combined forcefield to evaluate.')
+    add_param_arguments(rfree)
+    rfree.set_defaults(handler=run_rfree)
+
+    jacobian = subparsers.add_parser(
+        'jacobian', help='Save the exact d(sigma, epsilon)/d(parameters) of every atom next to combined.xml.',
+        description='Save the exact derivatives of every atom\'s sigma and epsilon with respect to the Rfree, '
+                    'xalpha and xbeta parameters as an npz (sparse COO triplets unless --dense).',
+    )
+    jacobian.add_argument('xml', nargs='?', default='combined.xml', help='Combined forcefield to differentiate.')
+    add_param_arguments(jacobian)
+    jacobian.add_argument('--dense', action='store_true', help='Store dense (atoms, parameters) arrays.')
+    jacobian.add_argument(
+        '-o', '--output', default=None, help='Where to save the npz (default: combined_jacobian.npz next to the xml).',
+    )
+    jacobian.set_defaults(handler=run_jacobian)
+
+    screen = subparsers.add_parser(
+        'screen', help='Rank many candidate Rfree sets by cheap LJ statistics.',
+        description='Evaluate a grid (or random sample) of Rfree parameter sets against a combined.xml '
+                    'and write them to a csv ranked by their sigma/epsilon statistics.',
+    )
+    screen.add_argument('xml', nargs='?', default='combined.xml', help='Combined forcefield to screen.')
+    screen.add_argument(
+        '--vary', action='append', default=[], metavar='NAME=LOW:HIGH[:STEPS]',
+        help='Range of one parameter, e.g. CElement/cfree=1.9:2.3:9; repeat for several. '
+             'Grids use STEPS values (default 5) of each.',
+    )
+    screen.add_argument('--random', type=int, default=0, help='Draw this many random sets instead of a grid.')
+    screen.add_argument('--seed', type=int, default=None, help='Seed for --random.')
+    screen.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used to evaluate the sets.')
+    screen.add_argument(
+        '--rank-by', default='deviation',
+        help='Statistic to rank on, e.g. deviation, epsilon_deviation or cfree_sigma_std (default: deviation).',
+    )
+    screen.add_argument('--descending', action='store_true', help='Rank largest first.')
+    screen.add_argument('--top', type=int, default=None, help='Only write the best N sets.')
+    screen.add_argument('-o', '--output', default='screen.csv', help='Where to write the ranked sets.')
+    screen.set_defaults(handler=run_screen)
+
+    ingest = subparsers.add_parser(
+        'ingest', help='Load every result file into a local SQLite database, re-reading only changed files.',
+        description='Load the optimise.out, *_qb_out.txt, results.csv, Q2_*.csv, experimental csv and xlsx files '
+                    'below root into a SQLite database. Files are skipped while their size and mtime '
+                    '(or contents) are unchanged.',
+    )
+    ingest.add_argument('root', nargs='?', default='.', help='Top of the repository to ingest.')
+    ingest.add_argument('--db', default='results.sqlite', help='Database file (created if missing).')
+    ingest.add_argument('-v', '--verbose', action='store_true', help='List each file as it is (re)loaded.')
+    ingest.set_defaults(handler=run_ingest)
+
+    query = subparsers.add_parser(
+        'query', help='Print results from the database made by ingest as csv.',
+        description='Print one property (density, hvap, liquid_energy, ...) from the results database as csv; '
+                    'densities are in g/cm^3 and Hvaps in kcal/mol.',
+    )
+    query.add_argument('property', help='e.g. density, hvap, minimum_energy, gas_temperature.')
+    query.add_argument('--db', default='results.sqlite', help='Database file written by ingest.')
+    query.add_argument('--run-set', default=None, help='e.g. training or test.')
+    query.add_argument('--model', default=None, help='e.g. model5d, or experiment for the reference values.')
+    query.add_argument('--molecule', default=None, help='e.g. mol01.')
+    query.add_argument('--source', choices=('qb', 'csv', 'fb', 'experiment'), default=None)
+    query.add_argument(
+        '--iteration', default='last',
+        help='ForceBalance iteration: a number, last (default) or all.',
+    )
+    query.add_argument('--matrix', action='store_true', help='One row per model, one column per molecule.')
+    query.set_defaults(handler=run_query)
+
+    collect = subparsers.add_parser(
+        'collect', help="Copy each run's final pdb and xml into <name>/ folders.",
+        description="Copy each QUBEKit run's final pdb and xml into <dest>/<name>/.",
+    )
+    collect.add_argument('root', nargs='?', default='.', help='Directory containing the QUBEKit run folders.')
+    collect.add_argument('--dest', default='.', help='Where to create the <name>/ folders.')
+    add_manifest_arguments(collect)
+    collect.set_defaults(handler=run_collect)
+
+    liquid_box = subparsers.add_parser(
+        'liquid-box', help='Build the liquid.pdb of ForceBalance targets from their gas.pdb.',
+        description='Pack rotated copies of each molecule into a cubic box sized from its experimental density, '
+                    'with no two atoms of different copies closer than the tolerance, and write liquid.pdb. '
+                    'Existing boxes are kept unless --overwrite.',
+    )
+    liquid_box.add_argument(
+        'paths', nargs='*',
+        help='Targets directories, target directories (gas.pdb) or single-molecule pdbs such as '
+             'runs/training/model0/mol01/mol01.pdb (default: targets).',
+    )
+    liquid_box.add_argument(
+        '--reference', default=None,
+        help='Reference csv (molecule,density,hvap,temp) to take densities from (default: training_data.csv).',
+    )
+    liquid_box.add_argument('--density', type=float, default=None, help='Density (g/cm^3) to use for every box.')
+    liquid_box.add_argument('--molecules', type=int, default=500, help='Molecules per box.')
+    liquid_box.add_argument(
+        '--scale', type=float, default=0.7, help='Fraction of the density the box is built at (default: 0.7).',
+    )
+    liquid_box.add_argument(
+        '--tolerance', type=float, default=2.0, help='Closest distance (A) between atoms of different molecules.',
+    )
+    liquid_box.add_argument(
+        '--placement', choices=('lattice', 'random'), default='lattice',
+        help='Start the molecules on a cubic lattice, or at random positions.',
+    )
+    liquid_box.add_argument('--seed', type=int, default=None, help='Seed for the positions and rotations.')
+    liquid_box.add_argument('-j', '--jobs', type=int, default=1, help='Number of boxes built at once.')
+    liquid_box.add_argument('-o', '--output', default=None, help='Where to write the box, when building just one.')
+    liquid_box.add_argument('--overwrite', action='store_true', help='Rebuild boxes that already exist.')
+    liquid_box.set_defaults(handler=run_liquid_box)
+
+    targets = subparsers.add_parser(
+        'targets', help='Write the ForceBalance targets tree and optimise.in for the molecules of an input csv.',
+        description='Write targets/<name>_liquid/{data.csv, gas.pdb, liquid.pdb} for every molecule of a QUBEKit '
+                    'input csv with reference data, and an optimise.in with one Liquid_OpenMM target per molecule.',
+    )
+    targets.add_argument('molecules_csv', help='e.g. input_files/Q2_trainingset.csv or input_files/Q2_halos.csv.')
+    targets.add_argument(
+        '--reference', default=None,
+        help='Reference csv (molecule,density,hvap,temp) (default: the matching table in input_files, '
+             'e.g. halo_data.csv for Q2_halos.csv).',
+    )
+    targets.add_argument('--dest', default='.', help='Directory to write targets/ and optimise.in into.')
+    targets.add_argument(
+        '--pdbs', default=None,
+        help='QUBEKit model or collect directory holding <name>/<name>.pdb, copied to each target as gas.pdb.',
+    )
+    targets.add_argument('--forcefield', default=None, help='combined.xml to copy into <dest>/forcefield.')
+    targets.add_argument('--no-boxes', action='store_true', help='Do not build liquid.pdb (see liquid-box).')
+    targets.add_argument('--molecules', type=int, default=500, help='Molecules per liquid box.')
+    targets.add_argument(
+        '--scale', type=float, default=0.7, help='Fraction of the density the boxes are built at (default: 0.7).',
+    )
+    targets.add_argument('--seed', type=int, default=None, help='Seed for the liquid boxes.')
+    targets.add_argument('--overwrite', action='store_true', help='Replace existing gas.pdb and liquid.pdb files.')
+    targets.add_argument('-j', '--jobs', type=int, default=1, help='Number of targets written at once.')
+    targets.set_defaults(handler=run_targets)
+
+    budget = subparsers.add_parser(
+        'budget', help='Share a total of MD steps between the targets of optimise.in by their noise and box size.',
+        description='Use the Stdev of each target in an optimise.out and the atoms in its liquid.pdb to share the '
+                    'production steps of an optimise.in so the summed statistical noise of the objective is '
+                    'smallest for the same compute, and print (or write) the planned steps.',
+    )
+    budget.add_argument('optimise_out', nargs='?', default='optimise.out', help='Log of a previous run of the targets.')
+    budget.add_argument('--targets', default='targets', help='Targets directory with each data.csv and liquid.pdb.')
+    budget.add_argument('--optimise-in', default='optimise.in', help='optimise.in to re-plan.')
+    budget.add_argument(
+        '--budget', type=int, default=None,
+        help='Total liquid_md_steps to share, as the compute of that many steps spread evenly '
+             '(default: the compute of the current steps).',
+    )
+    budget.add_argument('--minimum', type=int, default=100000, help='Fewest production steps any target gets.')
+    budget.add_argument('-o', '--output', default=None, help='Write the re-planned optimise.in here.')
+    budget.set_defaults(handler=run_budget)
+
+    check = subparsers.add_parser(
+        'check', help='Check a combined.xml against its targets\' pdbs and the QUBEKit xmls it was built from.',
+        description='Report every inconsistency in a combined.xml (duplicate types or classes, bad bond or VirtualSite '
+                    'references, ids outside their molecule, missing NonbondedForce atoms), between its residues '
+                    'and the gas.pdb and liquid.pdb of each target, and against the per-molecule QUBEKit xmls. '
+                    'Exits with 1 when anything is found.',
+    )
+    check.add_argument('forcefield', nargs='?', default='combined.xml', help='Combined forcefield to check.')
+    check.add_argument('--targets', default=None, help='ForceBalance targets directory, e.g. example_fb_run/targets.')
+    check.add_argument(
+        '--sources', default=None,
+        help='QUBEKit model directory the forcefield was combined from, holding <name>/<name>.xml.',
+    )
+    check.set_defaults(handler=run_check)
+
+    split = subparsers.add_parser(
+        'split', help='Write the molecules of an optimised combined.xml back out as per-molecule xmls.',
+        description='Undo the renumbering of combined.xml and write <dest>/<name>/<name>.xml for every molecule, '
+                    'with sigma and epsilon evaluated at the final physical parameters of an optimise.out.',
+    )
+    split.add_argument('forcefield', nargs='?', default='combined.xml', help='Combined forcefield to split.')
+    split.add_argument('--dest', default='.', help='Directory to write <name>/<name>.xml into.')
+    split.add_argument(
+        '--optimise-out', default=None,
+        help='ForceBalance log to take the final parameters from (default: the forcefield\'s own values).',
+    )
+    add_param_arguments(split)
+    split.set_defaults(handler=run_split)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.directory is not None:
+        os.chdir(args.directory)
+    return args.handler(args) or 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,38 @@
+"""
+The experimental reference tables in input_files: molecule,density,hvap,temp in kg/m^3, kJ/mol and K.
+
+Kept free of NumPy so that the plain MUE path (mue.py) can read them without loading it;
+leaderboard.read_reference builds its arrays from read_reference_rows.
+"""
+
+import csv
+import os
+
+
+REFERENCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'input_files')
+# Reference table for each group of runs, i.e. each directory directly under runs/.
+REFERENCE_FILES = {
+    'training': 'training_data.csv',
+    'test': 'test_data.csv',
+}
+HALO_REFERENCE_FILE = 'halo_data.csv'
+
+
+def reference_file(group=None, halos=False):
+    """Path of the reference table for a group of runs (or the halogen training set)."""
+
+    name = HALO_REFERENCE_FILE if halos else REFERENCE_FILES[group]
+    return os.path.join(REFERENCE_DIR, name)
+
+
+def read_reference_rows(file_path):
+    """
+    Read a reference table.
+    :return: list of (name, density, hvap, temperature), with density in g/cm^3, hvap in kcal/mol and temperature in K
+    """
+
+    with open(file_path) as csv_file:
+        return [
+            (row['molecule'], float(row['density']) / 1000, float(row['hvap']) / 4.184, float(row['temp']))
+            for row in csv.DictReader(csv_file)
+        ]
@@ -0,0 +1,66 @@
+"""
+Renumbering of the class, name and type ids in QUBEKit xmls.
+
+Every id is parsed once into a prefix, a number and a zero-padded width, e.g.
+    'QUBE_0003' -> IdFormat('QUBE_', 3, 4)
+    'v-site0012' -> IdFormat('v-site', 12, 4)
+    'C12' -> IdFormat('C', 12, 0)
+    '7' -> IdFormat('', 7, 0)
+Offsetting a molecule is then plain integer addition; anything not in one of these formats is an error
+rather than being guessed at.
+"""
+
+from collections import namedtuple
+import re
+
+
+IdFormat = namedtuple('IdFormat', 'prefix number width')
+
+ID_PATTERN = re.compile(r'(QUBE_|v-site|[A-Za-z]{0,2})(\d+)')
+# Prefixes whose numbers are zero-padded (to at least this many digits); all others are written as is.
+PADDED_PREFIXES = {'QUBE_': 4, 'v-site': 4}
+
+
+def parse_id(string):
+    """Split an id into its IdFormat; raises ValueError for unknown formats."""
+
+    match = ID_PATTERN.fullmatch(string)
+    if match is None:
+        raise ValueError(
+            f'Cannot renumber {string!r}; expected QUBE_<n>, v-site<n>, <n> or up to two letters followed by <n>.'
+        )
+    prefix, digits = match.groups()
+    return IdFormat(prefix, int(digits), PADDED_PREFIXES.get(prefix, 0))
+
+
+def format_field(id_format, slot):
+    """
+    str.format field which writes id_format's prefix and padding around positional argument slot,
+    e.g. IdFormat('QUBE_', 3, 4), 0 -> 'QUBE_{0:04d}'.
+    """
+
+    if id_format.width:
+        return f'{id_format.prefix}{{{slot}:0{id_format.width}d}}'
+    return f'{id_format.prefix}{{{slot}}}'
+
+
+def offset_numbers(numbers, offset):
+    """Offset a molecule's parsed id numbers in one go, ready to fill its format fields."""
+    return [number + offset for number in numbers]
+
+
+def renumber_id(string, offset):
+    """Offset a single id string, keeping its prefix and padding."""
+
+    prefix, number, width = parse_id(string)
+    return f'{prefix}{str(number + offset).zfill(width)}'
+
+
+def restore_id(string, offset):
+    """
+    Undo renumber_id: move an id back by offset, written unpadded as in the QUBEKit xmls,
+    e.g. 'QUBE_0103', 100 -> 'QUBE_3'.
+    """
+
+    prefix, number, _ = parse_id(string)
+    return f'{prefix}{number - offset}'
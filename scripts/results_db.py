@@ -0,0 +1,458 @@
+"""
+Local SQLite database of every result in the repository, so cross-model analyses are indexed queries
+rather than repeated scans of the run trees.
+
+ingest walks a root directory and loads
+    runs/<run set>/<model>/optimise.out        ForceBalance property tables, objective breakdowns and parameters
+    runs/<run set>/<model>/*_qb_out.txt        QUBEBench results
+    runs/<run set>/<model>/results.csv         QUBEBench results (csv)
+    **/Q2_*.csv                                molecule names, smiles and QUBEKit configs
+    input_files/*_data.csv                     experimental densities and Hvaps (model 'experiment')
+    data/*.xlsx                                every non-empty cell of every sheet
+Each file is recorded with its size, mtime and sha256; on the next ingest, files whose size and mtime are unchanged
+are skipped, files which were touched but hash the same only have their stats updated, and only changed, new or
+deleted files have their rows replaced.
+
+Densities are stored in g/cm^3 and Hvaps in kcal/mol whatever the source, as in mue.py;
+iteration is the ForceBalance iteration, and NULL for results which have none.
+
+    database = ResultsDatabase('results.sqlite')
+    database.ingest('.')
+    models, molecules, densities = database.matrix('density', run_set='training')
+"""
+
+from collections import namedtuple
+import csv
+import os
+import re
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+
+import numpy as np
+
+from fb_output import ObjectiveTerm, ParameterValue, PropertyResult, read_optimise_out
+from fragment_cache import hash_files
+from qb_output import QB_OUT_SUFFIX, read_qb_out
+
+
+DEFAULT_DATABASE = 'results.sqlite'
+SCHEMA_VERSION = 1
+
+# Preferred source for each model when several are present, as in leaderboard.SOURCES.
+SOURCES = ('qb', 'csv', 'fb')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    kind TEXT NOT NULL,
+    run_set TEXT NOT NULL,
+    model TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    ingested REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    run_set TEXT NOT NULL,
+    model TEXT NOT NULL,
+    molecule TEXT NOT NULL,
+    property TEXT NOT NULL,
+    iteration INTEGER,
+    source TEXT NOT NULL,
+    value REAL,
+    stdev REAL,
+    reference REAL,
+    temperature REAL
+);
+CREATE INDEX IF NOT EXISTS results_lookup ON results (run_set, model, molecule, property, iteration);
+CREATE INDEX IF NOT EXISTS results_property ON results (property, run_set, model);
+CREATE TABLE IF NOT EXISTS objective (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    run_set TEXT NOT NULL,
+    model TEXT NOT NULL,
+    iteration INTEGER,
+    name TEXT NOT NULL,
+    residual REAL,
+    weight REAL,
+    contribution REAL
+);
+CREATE INDEX IF NOT EXISTS objective_lookup ON objective (run_set, model, name, iteration);
+CREATE TABLE IF NOT EXISTS parameters (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    run_set TEXT NOT NULL,
+    model TEXT NOT NULL,
+    iteration INTEGER,
+    block TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS parameters_lookup ON parameters (run_set, model, name, block, iteration);
+CREATE TABLE IF NOT EXISTS molecules (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    run_set TEXT NOT NULL,
+    model TEXT NOT NULL,
+    molecule TEXT NOT NULL,
+    smiles TEXT,
+    config_file TEXT
+);
+CREATE INDEX IF NOT EXISTS molecules_lookup ON molecules (molecule, run_set, model);
+CREATE TABLE IF NOT EXISTS cells (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    sheet TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS cells_lookup ON cells (sheet, row, col);
+'''
+
+IngestSummary = namedtuple('IngestSummary', 'added updated unchanged removed')
+
+# qb_output.QbResult fields and results.csv columns, by the property name they are stored under.
+QB_PROPERTIES = (
+    'density', 'hvap', 'minimum_energy', 'liquid_temperature', 'liquid_energy', 'gas_temperature', 'gas_energy',
+)
+CSV_PROPERTIES = {
+    'density': 'density', 'hvap': 'heat_of_vap', 'liquid_temperature': 'liq_temp', 'liquid_energy': 'liq_energy',
+    'gas_temperature': 'gas_temp', 'gas_energy': 'gas_energy',
+}
+# ForceBalance property tables: stored name and factor converting to g/cm^3 or kcal/mol.
+FB_PROPERTIES = {'Density': ('density', 1 / 1000), 'Enthalpy of Vaporization': ('hvap', 1 / 4.184)}
+
+_XLSX = {'m': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+_CELL_REFERENCE = re.compile(r'([A-Z]+)(\d+)')
+
+
+def file_kind(name, parts):
+    """What a file holds, from its name and its path relative to the ingested root; None if it is not ingested."""
+
+    if name == 'optimise.out':
+        return 'fb'
+    if name.endswith(QB_OUT_SUFFIX):
+        return 'qb'
+    if name == 'results.csv' and parts[0] == 'runs':
+        return 'csv'
+    if name.startswith('Q2_') and name.endswith('.csv'):
+        return 'molecules'
+    if name.endswith('_data.csv') and parts[0] == 'input_files':
+        return 'experiment'
+    if name.endswith('.xlsx') and parts[0] == 'data':
+        return 'xlsx'
+    return None
+
+
+def path_labels(relative_path):
+    """
+    (run set, model) of a file from its path relative to the ingested root:
+    runs/<run set>/<model>/... for run outputs, otherwise (first directory, '').
+    """
+
+    parts = relative_path.split('/')
+    if parts[0] == 'runs' and len(parts) >= 4:
+        return parts[1], parts[2]
+    return (parts[0] if len(parts) > 1 else ''), ''
+
+
+def find_files(root='.'):
+    """
+    Every ingestible file below root.
+    :return: dict of path relative to root (with / separators): kind
+    """
+
+    found = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+        for name in file_names:
+            relative = os.path.relpath(os.path.join(dir_path, name), root).replace(os.sep, '/')
+            kind = file_kind(name, relative.split('/'))
+            if kind is not None:
+                found[relative] = kind
+    return found
+
+
+def read_xlsx_cells(file_path):
+    """
+    Every non-empty cell of every sheet of an xlsx workbook, read with the standard library.
+    :return: generator of (sheet name, row, column, text), with 1-based row and column numbers
+    """
+
+    with zipfile.ZipFile(file_path) as workbook:
+        names = workbook.namelist()
+        strings = []
+        if 'xl/sharedStrings.xml' in names:
+            for item in ET.fromstring(workbook.read('xl/sharedStrings.xml')).iterfind('m:si', _XLSX):
+                strings.append(''.join(text.text or '' for text in item.iter(f'{{{_XLSX["m"]}}}t')))
+
+        relations = {
+            relation.get('Id'): relation.get('Target')
+            for relation in ET.fromstring(workbook.read('xl/_rels/workbook.xml.rels'))
+        }
+        relation_id = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+        for sheet in ET.fromstring(workbook.read('xl/workbook.xml')).iterfind('m:sheets/m:sheet', _XLSX):
+            target = relations[sheet.get(relation_id)].lstrip('/')
+            target = target if target.startswith('xl/') else f'xl/{target}'
+            for cell in ET.fromstring(workbook.read(target)).iterfind('m:sheetData/m:row/m:c', _XLSX):
+                value = cell.find('m:v', _XLSX)
+                if cell.get('t') == 'inlineStr':
+                    text = ''.join(part.text or '' for part in cell.iter(f'{{{_XLSX["m"]}}}t'))
+                elif value is None or value.text is None:
+                    continue
+                else:
+                    text = strings[int(value.text)] if cell.get('t') == 's' else value.text
+
+                letters, row = _CELL_REFERENCE.match(cell.get('r')).groups()
+                column = 0
+                for letter in letters:
+                    column = column * 26 + ord(letter) - ord('A') + 1
+                yield sheet.get('name'), int(row), column, text
+
+
+def _number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+class ResultsDatabase:
+    """
+    The results database; open it with ResultsDatabase(path), fill it with ingest and read it with
+    query, matrix and objective_trace.
+    """
+
+    def __init__(self, path=DEFAULT_DATABASE):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, SCHEMA_VERSION):
+            raise ValueError(f'{path} has schema version {version}; expected {SCHEMA_VERSION}. Delete it to rebuild.')
+        self.connection.executescript(SCHEMA)
+        self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ingest(self, root='.', verbose=False):
+        """
+        Bring the database up to date with the files below root.
+        Unchanged files (same size and mtime, or same contents) are not re-read.
+        :return: IngestSummary of the number of files added, updated, unchanged and removed
+        """
+
+        known = {
+            path: (file_id, size, mtime_ns, digest)
+            for file_id, path, size, mtime_ns, digest in self.connection.execute(
+                'SELECT id, path, size, mtime_ns, sha256 FROM files'
+            )
+        }
+        found = find_files(root)
+        added = updated = unchanged = 0
+
+        for relative, kind in sorted(found.items()):
+            file_path = os.path.join(root, relative)
+            stat = os.stat(file_path)
+            previous = known.get(relative)
+            if previous is not None and previous[1:3] == (stat.st_size, stat.st_mtime_ns):
+                unchanged += 1
+                continue
+
+            digest = hash_files([file_path])
+            with self.connection:
+                if previous is not None and previous[3] == digest:
+                    # Touched but not changed.
+                    self.connection.execute(
+                        'UPDATE files SET size = ?, mtime_ns = ? WHERE id = ?',
+                        (stat.st_size, stat.st_mtime_ns, previous[0]),
+                    )
+                    unchanged += 1
+                    continue
+
+                if previous is not None:
+                    self.connection.execute('DELETE FROM files WHERE id = ?', (previous[0],))
+                run_set, model = path_labels(relative)
+                file_id = self.connection.execute(
+                    'INSERT INTO files (path, kind, run_set, model, size, mtime_ns, sha256, ingested) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (relative, kind, run_set, model, stat.st_size, stat.st_mtime_ns, digest, time.time()),
+                ).lastrowid
+                getattr(self, f'_ingest_{kind}')(file_id, file_path, run_set, model)
+
+            if verbose:
+                print(f'{"updated" if previous is not None else "added"} {relative}')
+            if previous is None:
+                added += 1
+            else:
+                updated += 1
+
+        removed = [known[path][0] for path in known if path not in found]
+        with self.connection:
+            self.connection.executemany('DELETE FROM files WHERE id = ?', [(file_id,) for file_id in removed])
+
+        return IngestSummary(added, updated, unchanged, len(removed))
+
+    def _insert_results(self, rows):
+        self.connection.executemany(
+            'INSERT INTO results (file_id, run_set, model, molecule, property, iteration, source, value, stdev, '
+            'reference, temperature) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            rows,
+        )
+
+    def _ingest_fb(self, file_id, file_path, run_set, model):
+        results, objective, parameters = [], [], []
+        for record in read_optimise_out(file_path):
+            if isinstance(record, PropertyResult) and record.quantity in FB_PROPERTIES:
+                name, factor = FB_PROPERTIES[record.quantity]
+                results.append((
+                    file_id, run_set, model, record.target.split('_')[0], name, record.iteration, 'fb',
+                    record.calculated * factor, record.stdev * factor, record.reference * factor, record.temperature,
+                ))
+            elif isinstance(record, ObjectiveTerm):
+                objective.append((
+                    file_id, run_set, model, record.iteration, record.name, record.residual, record.weight,
+                    record.contribution,
+                ))
+            elif isinstance(record, ParameterValue):
+                parameters.append((file_id, run_set, model, record.iteration, record.block, record.name, record.value))
+
+        self._insert_results(results)
+        self.connection.executemany('INSERT INTO objective VALUES (?, ?, ?, ?, ?, ?, ?, ?)', objective)
+        self.connection.executemany('INSERT INTO parameters VALUES (?, ?, ?, ?, ?, ?, ?)', parameters)
+
+    def _ingest_qb(self, file_id, file_path, run_set, model):
+        self._insert_results(
+            (file_id, run_set, model, result.name, name, None, 'qb', getattr(result, name), None, None,
+             result.liquid_temperature)
+            for result in read_qb_out(file_path) for name in QB_PROPERTIES
+            if getattr(result, name) is not None
+        )
+
+    def _ingest_csv(self, file_id, file_path, run_set, model):
+        with open(file_path) as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        self._insert_results(
+            (file_id, run_set, model, row['name'], name, None, 'csv', _number(row.get(column)), None, None,
+             _number(row.get('liq_temp')))
+            for row in rows for name, column in CSV_PROPERTIES.items()
+            if _number(row.get(column)) is not None
+        )
+
+    def _ingest_experiment(self, file_id, file_path, run_set, model):
+        # training_data.csv -> run set 'training'; halo_data.csv -> 'halo'.
+        run_set = os.path.basename(file_path)[:-len('_data.csv')]
+        with open(file_path) as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        self._insert_results(
+            (file_id, run_set, 'experiment', row['molecule'], name, None, 'experiment', float(row[name]) * factor,
+             None, None, _number(row.get('temp')))
+            for row in rows for name, factor in (('density', 1 / 1000), ('hvap', 1 / 4.184))
+        )
+
+    def _ingest_molecules(self, file_id, file_path, run_set, model):
+        with open(file_path) as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        self.connection.executemany(
+            'INSERT INTO molecules VALUES (?, ?, ?, ?, ?, ?)',
+            [(file_id, run_set, model, row['name'], row.get('smiles'), row.get('config_file')) for row in rows],
+        )
+
+    def _ingest_xlsx(self, file_id, file_path, run_set, model):
+        self.connection.executemany(
+            'INSERT INTO cells VALUES (?, ?, ?, ?, ?, ?)',
+            [
+                (file_id, sheet, row, column, text, _number(text))
+                for sheet, row, column, text in read_xlsx_cells(file_path)
+            ],
+        )
+
+    def query(self, property, run_set=None, model=None, molecule=None, source=None, iteration='last'):
+        """
+        Rows of the results table.
+        :param property: e.g. 'density', 'hvap', 'gas_energy'
+        :param run_set: e.g. 'training'; None for all (likewise model, molecule and source)
+        :param iteration: a ForceBalance iteration number, 'last' for the last iteration of each run,
+            or None for every iteration; results without iterations are always included.
+        :return: structured array with fields run_set, model, molecule, source, iteration (-1 for none),
+            value, stdev, reference and temperature (NaN where missing)
+        """
+
+        conditions, parameters = ['property = ?'], [property]
+        for column, value in (('run_set', run_set), ('model', model), ('molecule', molecule), ('source', source)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
+        if iteration == 'last':
+            conditions.append(
+                '(iteration IS NULL OR iteration = (SELECT MAX(last.iteration) FROM results AS last '
+                'WHERE last.run_set = results.run_set AND last.model = results.model '
+                'AND last.molecule = results.molecule AND last.property = results.property))'
+            )
+        elif iteration is not None:
+            conditions.append('(iteration IS NULL OR iteration = ?)')
+            parameters.append(iteration)
+
+        rows = self.connection.execute(
+            'SELECT run_set, model, molecule, source, COALESCE(iteration, -1), value, stdev, reference, temperature '
+            f'FROM results WHERE {" AND ".join(conditions)} ORDER BY run_set, model, molecule, source, iteration',
+            parameters,
+        ).fetchall()
+        return np.array(
+            [tuple(np.nan if value is None else value for value in row) for row in rows],
+            dtype=[
+                ('run_set', object), ('model', object), ('molecule', object), ('source', object), ('iteration', int),
+                ('value', float), ('stdev', float), ('reference', float), ('temperature', float),
+            ],
+        )
+
+    def matrix(self, property, run_set=None, source=None, iteration='last'):
+        """
+        One property of every model, lined up by molecule for cross-model analysis.
+        :param source: take every model's values from this source; by default the first of SOURCES each model has.
+        :return: models (list of (run_set, model)), molecules (list of names), (models, molecules) array, NaN if missing
+        """
+
+        rows = self.query(property, run_set=run_set, source=source, iteration=iteration)
+        rows = rows[rows['source'] != 'experiment'] if source is None else rows
+
+        preferred = {}
+        for row in rows:
+            key = (row['run_set'], row['model'])
+            rank = SOURCES.index(row['source']) if row['source'] in SOURCES else len(SOURCES)
+            preferred[key] = min(preferred.get(key, rank), rank)
+
+        models = sorted(preferred)
+        molecules = sorted(set(rows['molecule'].tolist()))
+        values = np.full((len(models), len(molecules)), np.nan)
+        model_index = {model: index for index, model in enumerate(models)}
+        molecule_index = {molecule: index for index, molecule in enumerate(molecules)}
+        for row in rows:
+            key = (row['run_set'], row['model'])
+            if row['source'] in SOURCES and SOURCES.index(row['source']) != preferred[key]:
+                continue
+            values[model_index[key], molecule_index[row['molecule']]] = row['value']
+        return models, molecules, values
+
+    def objective_trace(self, run_set, model, name='Total'):
+        """
+        One term of the Objective Function Breakdown of a ForceBalance run, iteration by iteration.
+        :return: iterations, contributions arrays
+        """
+
+        rows = self.connection.execute(
+            'SELECT iteration, contribution FROM objective WHERE run_set = ? AND model = ? AND name = ? '
+            'ORDER BY iteration',
+            (run_set, model, name),
+        ).fetchall()
+        rows = np.array(rows, dtype=float).reshape(-1, 2)
+        return rows[:, 0].astype(int), rows[:, 1]
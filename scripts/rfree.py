@@ -0,0 +1,209 @@
+"""
+Vectorised evaluation of the Rfree parameter_eval expressions in a combined.xml.
+
+ForceBalance evaluates each atom's parameter_eval string on its own, e.g.
+    epsilon=(PARM['xalpha/alpha']*46.6*(16.58/34.4)**PARM['xbeta/beta'])/(128*PARM['CElement/cfree']**6)*57.65,
+    sigma=2**(5/6)*(16.58/34.4)**(1/3)*PARM['CElement/cfree']*0.1
+Every atom of the forcefield is instead compiled once into columns of an RfreeTerms
+(volume, vfree, bfree, the index of its Rfree parameter, ...) so that sigma and epsilon for all atoms,
+for one or many candidate parameter sets, are a handful of array operations:
+    epsilon = prefactor * alpha * bfree * (volume / vfree) ** exponent / (128 * rfree ** 6) * epsilon_scale
+    sigma = 2 ** (5 / 6) * (volume / vfree) ** (1 / 3) * rfree * sigma_scale
+where alpha and exponent are the xalpha/alpha and xbeta/beta parameters for atoms which use them.
+
+The expressions written by xml_combiner.py, xml_combiner_halos.py and xml_combiner_008.py are understood;
+anything else is an error rather than being guessed at.
+"""
+
+from collections import namedtuple
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from forcefield_check import iter_forcefield
+
+
+RfreeTerms = namedtuple(
+    'RfreeTerms',
+    'types parameter_names initial volume vfree bfree prefactor exponent '
+    'free_index alpha_index beta_index epsilon_scale sigma_scale',
+)
+
+_NUMBER = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+_PARM = r"PARM\['([^']+)'\]"
+_RATIO = rf'\({_NUMBER}/{_NUMBER}\)'
+
+# Each pattern's groups are mapped onto the RfreeTerms columns by the function next to it.
+EPSILON_FORMS = (
+    # xml_combiner.py: epsilon=(PARM['xalpha/alpha']*bfree*(vol/vfree)**PARM['xbeta/beta'])/(128*PARM[rfree]**6)*scale
+    (
+        re.compile(rf'epsilon=\({_PARM}\*{_NUMBER}\*{_RATIO}\*\*{_PARM}\)/\(128\*{_PARM}\*\*6\)\*{_NUMBER}'),
+        lambda alpha, bfree, vol, vfree, beta, free, scale: dict(
+            alpha=alpha, bfree=bfree, volume=vol, vfree=vfree, beta=beta, free=free, epsilon_scale=scale,
+        ),
+    ),
+    # xml_combiner_halos.py: epsilon=(prefactor*(vol/vfree)**exponent)*bfree/(128*PARM[rfree]**6)*scale
+    (
+        re.compile(rf'epsilon=\({_NUMBER}\*{_RATIO}\*\*{_NUMBER}\)\*{_NUMBER}/\(128\*{_PARM}\*\*6\)\*{_NUMBER}'),
+        lambda prefactor, vol, vfree, exponent, bfree, free, scale: dict(
+            prefactor=prefactor, volume=vol, vfree=vfree, exponent=exponent, bfree=bfree, free=free,
+            epsilon_scale=scale,
+        ),
+    ),
+    # xml_combiner_008.py (and the fixed-volume variant): epsilon=bfree/(128*PARM[rfree]**6)*scale
+    (
+        re.compile(rf'epsilon={_NUMBER}/\(128\*{_PARM}\*\*6\)\*{_NUMBER}'),
+        lambda bfree, free, scale: dict(bfree=bfree, exponent='0', free=free, epsilon_scale=scale),
+    ),
+)
+SIGMA_FORM = re.compile(rf'sigma=2\*\*\(5/6\)\*{_RATIO}\*\*\(1/3\)\*{_PARM}\*{_NUMBER}')
+
+
+def parse_expression(parameter_eval):
+    """
+    Match one atom's parameter_eval against the known forms; raises ValueError for anything else.
+    :return: dict of its RfreeTerms values, with the parameter names (alpha, beta, free) still as strings
+    """
+
+    epsilon, sigma = (part.strip() for part in parameter_eval.split(','))
+    for pattern, terms in EPSILON_FORMS:
+        match = pattern.fullmatch(epsilon)
+        if match is not None:
+            break
+    else:
+        raise ValueError(f'Unrecognised epsilon expression {epsilon!r}.')
+
+    sigma_match = SIGMA_FORM.fullmatch(sigma)
+    if sigma_match is None:
+        raise ValueError(f'Unrecognised sigma expression {sigma!r}.')
+    vol, vfree, free, sigma_scale = sigma_match.groups()
+
+    # The volume ratio is taken from sigma, which always has it; with a fixed exponent of 0 epsilon does not.
+    expression = dict(prefactor='1', alpha=None, beta=None, exponent='nan', sigma_scale=sigma_scale)
+    expression.update(terms(*match.groups()))
+    expression.update(volume=vol, vfree=vfree)
+    if expression['free'] != free:
+        raise ValueError(f'epsilon and sigma use different Rfree parameters in {parameter_eval!r}.')
+    return expression
+
+
+def read_parameters(root):
+    """
+    Initial values of the parameters listed in a forcefield's ForceBalance section.
+    :return: dict of 'Tag/attribute' name: value, in the order ForceBalance numbers them
+    """
+
+    parameters = {}
+    for element in root.iterfind('ForceBalance/*'):
+        for attribute in element.get('parameterize', '').split(','):
+            attribute = attribute.strip()
+            if attribute:
+                parameters[f'{element.tag}/{attribute}'] = float(element.get(attribute))
+    return parameters
+
+
+def compile_forcefield(xml_path='combined.xml'):
+    """
+    Compile every parameter_eval in a combined.xml into an RfreeTerms.
+    Parameters are numbered in ForceBalance order, followed by any that are only referenced by the atoms
+    (e.g. xalpha/alpha when there is no xalpha element), whose initial value is the atom's matching attribute
+    (alpha="1.0") or NaN when there is none.
+    The file is streamed with forcefield_check.iter_forcefield, so hard-wrapped forcefields are read as well.
+    :return: RfreeTerms with one entry per parameterised atom
+    """
+
+    root = ET.Element('ForceField')
+    forcebalance = ET.SubElement(root, 'ForceBalance')
+    atoms = []
+    for section, element in iter_forcefield(xml_path):
+        if section == 'ForceBalance':
+            forcebalance.append(element)
+        elif section == 'NonbondedForce' and element.tag == 'Atom' and element.get('parameter_eval') is not None:
+            atoms.append(element)
+    return compile_atoms(atoms, read_parameters(root))
+
+
+def compile_atoms(atoms, initial):
+    """
+    Compile the parameter_eval of some NonbondedForce Atom elements, e.g. one molecule's, into an RfreeTerms;
+    see compile_forcefield.
+    :param initial: dict of parameter name: initial value, from read_parameters
+    """
+
+    initial = dict(initial)
+    types, columns = [], {key: [] for key in (
+        'volume', 'vfree', 'bfree', 'prefactor', 'exponent', 'free', 'alpha', 'beta', 'epsilon_scale', 'sigma_scale',
+    )}
+    for atom in atoms:
+        expression = parse_expression(atom.get('parameter_eval'))
+        for key in ('free', 'alpha', 'beta'):
+            name = expression[key]
+            if name is not None and name not in initial:
+                initial[name] = float(atom.get(name.split('/')[-1], 'nan'))
+        types.append(atom.get('type'))
+        for key, column in columns.items():
+            column.append(expression[key])
+
+    parameter_names = list(initial)
+    index = {name: position for position, name in enumerate(parameter_names)}
+
+    def parameter_index(names):
+        return np.array([index.get(name, -1) for name in names], dtype=int)
+
+    return RfreeTerms(
+        types=types,
+        parameter_names=parameter_names,
+        initial=np.array(list(initial.values()), dtype=float),
+        volume=np.array(columns['volume'], dtype=float),
+        vfree=np.array(columns['vfree'], dtype=float),
+        bfree=np.array(columns['bfree'], dtype=float),
+        prefactor=np.array(columns['prefactor'], dtype=float),
+        exponent=np.array(columns['exponent'], dtype=float),
+        free_index=parameter_index(columns['free']),
+        alpha_index=parameter_index(columns['alpha']),
+        beta_index=parameter_index(columns['beta']),
+        epsilon_scale=np.array(columns['epsilon_scale'], dtype=float),
+        sigma_scale=np.array(columns['sigma_scale'], dtype=float),
+    )
+
+
+def parameter_vector(terms, values=None):
+    """
+    Build a parameter vector from the initial values, with some of them replaced.
+    :param values: dict of parameter name (e.g. 'CElement/cfree'): value
+    """
+
+    parameters = terms.initial.copy()
+    for name, value in (values or {}).items():
+        try:
+            parameters[terms.parameter_names.index(name)] = value
+        except ValueError:
+            raise KeyError(f'{name} is not a parameter of this forcefield; expected one of {terms.parameter_names}.')
+    return parameters
+
+
+def evaluate(terms, parameters=None):
+    """
+    Sigma and epsilon of every atom for one or many parameter sets.
+    :param terms: RfreeTerms from compile_forcefield
+    :param parameters: array of shape (..., len(terms.parameter_names)), e.g. one row per candidate set;
+        the initial values by default.
+    :return: sigma, epsilon arrays of shape (..., number of atoms)
+    """
+
+    parameters = terms.initial if parameters is None else np.asarray(parameters, dtype=float)
+    if parameters.shape[-1] != len(terms.parameter_names):
+        raise ValueError(
+            f'Expected {len(terms.parameter_names)} parameters ({", ".join(terms.parameter_names)}), '
+            f'got {parameters.shape[-1]}.'
+        )
+
+    rfree = parameters[..., terms.free_index]
+    alpha = np.where(terms.alpha_index >= 0, parameters[..., terms.alpha_index], 1.0)
+    exponent = np.where(terms.beta_index >= 0, parameters[..., terms.beta_index], terms.exponent)
+    ratio = terms.volume / terms.vfree
+
+    epsilon = (terms.prefactor * alpha * terms.bfree * ratio ** exponent) / (128 * rfree ** 6) * terms.epsilon_scale
+    sigma = 2 ** (5 / 6) * ratio ** (1 / 3) * rfree * terms.sigma_scale
+    return sigma, epsilon
@@ -0,0 +1,162 @@
+"""
+Batch screening of candidate Rfree parameter sets before any of them are sent to ForceBalance.
+
+A combined.xml already holds everything needed to compute its LJ parameters for any Rfree set:
+the per-atom DDEC volumes and the elem_dict bfree/vfree of each atom (see rfree.py).
+Thousands of candidate sets, either a grid or random samples over chosen parameter ranges, are evaluated
+in blocks across a process pool. Each is summarised by cheap statistics:
+    deviation: RMS relative change of sigma and epsilon from the starting forcefield (sigma_ and epsilon_deviation)
+    <parameter>_sigma_mean, _sigma_std, _epsilon_mean, _epsilon_std: spread over the atoms using each Rfree parameter
+and the sets are written to a csv ranked by one of these columns, so only the promising ones need simulating.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import csv
+
+import numpy as np
+
+from rfree import evaluate
+
+
+# Each block of sets is evaluated in one go; its sigma and epsilon arrays are (block size, number of atoms) floats.
+DEFAULT_BLOCK_SIZE = 256
+DEFAULT_STEPS = 5
+
+# Set in each worker (or this process when jobs == 1) by init_screen.
+_terms = None
+_baseline = None
+
+
+def parse_range(spec):
+    """
+    Parse a NAME=LOW:HIGH[:STEPS] command line range, e.g. 'CElement/cfree=1.9:2.2:7'.
+    :return: (name, low, high, steps); steps is only used for grids.
+    """
+
+    name, _, bounds = spec.partition('=')
+    values = bounds.split(':')
+    if not name or len(values) not in (2, 3):
+        raise ValueError(f'Expected NAME=LOW:HIGH[:STEPS], got {spec!r}.')
+    try:
+        steps = int(values[2]) if len(values) == 3 else DEFAULT_STEPS
+        return name, float(values[0]), float(values[1]), steps
+    except ValueError:
+        raise ValueError(f'Expected numbers for LOW:HIGH[:STEPS], got {spec!r}.') from None
+
+
+def _columns(terms, ranges):
+    columns = []
+    for name, *_ in ranges:
+        if name not in terms.parameter_names:
+            raise KeyError(f'{name} is not a parameter of this forcefield; expected one of {terms.parameter_names}.')
+        columns.append(terms.parameter_names.index(name))
+    return columns
+
+
+def grid_sets(terms, ranges):
+    """
+    Every combination of evenly spaced values of the ranged parameters; the others keep their initial values.
+    :param ranges: list of (name, low, high, steps) from parse_range
+    :return: array of shape (number of sets, number of parameters)
+    """
+
+    axes = np.meshgrid(*(np.linspace(low, high, steps) for _, low, high, steps in ranges), indexing='ij')
+    sets = np.tile(terms.initial, (axes[0].size if axes else 1, 1))
+    for column, axis in zip(_columns(terms, ranges), axes):
+        sets[:, column] = axis.ravel()
+    return sets
+
+
+def random_sets(terms, ranges, count, seed=None):
+    """
+    count sets with the ranged parameters drawn uniformly between their bounds; the others keep their initial values.
+    :return: array of shape (count, number of parameters)
+    """
+
+    rng = np.random.default_rng(seed)
+    sets = np.tile(terms.initial, (count, 1))
+    for column, (_, low, high, _) in zip(_columns(terms, ranges), ranges):
+        sets[:, column] = rng.uniform(low, high, count)
+    return sets
+
+
+def group_names(terms):
+    """Short names (e.g. cfree, hpolfree) of the Rfree parameters used by at least one atom, in parameter order."""
+    return [terms.parameter_names[index].split('/')[-1] for index in np.unique(terms.free_index)]
+
+
+def stat_names(terms):
+    names = ['deviation', 'sigma_deviation', 'epsilon_deviation']
+    for group in group_names(terms):
+        names.extend(f'{group}_{stat}' for stat in ('sigma_mean', 'sigma_std', 'epsilon_mean', 'epsilon_std'))
+    return names
+
+
+def init_screen(terms):
+    global _terms, _baseline
+    _terms = terms
+    _baseline = evaluate(terms)
+
+
+def screen_block(sets):
+    """
+    Evaluate one block of parameter sets in this process; init_screen must have been called.
+    :return: array of shape (len(sets), len(stat_names(terms)))
+    """
+
+    sigma, epsilon = evaluate(_terms, sets)
+    base_sigma, base_epsilon = _baseline
+
+    sigma_deviation = np.sqrt(np.mean((sigma / base_sigma - 1) ** 2, axis=-1))
+    epsilon_deviation = np.sqrt(np.mean((epsilon / base_epsilon - 1) ** 2, axis=-1))
+    stats = [np.sqrt((sigma_deviation ** 2 + epsilon_deviation ** 2) / 2), sigma_deviation, epsilon_deviation]
+
+    for index in np.unique(_terms.free_index):
+        group = _terms.free_index == index
+        for values in (sigma[:, group], epsilon[:, group]):
+            stats.extend((values.mean(axis=-1), values.std(axis=-1)))
+
+    return np.column_stack(stats)
+
+
+def screen(terms, sets, jobs=1, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Compute the screening statistics of many parameter sets, in a process pool if jobs > 1.
+    :param terms: RfreeTerms from rfree.compile_forcefield
+    :param sets: array of shape (number of sets, number of parameters)
+    :return: array of shape (number of sets, len(stat_names(terms))), in the same order as sets
+    """
+
+    sets = np.atleast_2d(np.asarray(sets, dtype=float))
+    blocks = [sets[start:start + block_size] for start in range(0, len(sets), block_size)]
+
+    if jobs > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_screen, initargs=(terms,)) as pool:
+            return np.concatenate(list(pool.map(screen_block, blocks)))
+
+    init_screen(terms)
+    return np.concatenate([screen_block(block) for block in blocks])
+
+
+def write_ranking(output, terms, sets, stats, rank_by='deviation', descending=False, top=None):
+    """
+    Write the screened sets to a csv, best first.
+    :param rank_by: stat_names column to sort on; smallest first unless descending.
+    :param top: only write this many sets.
+    :return: row indices into sets, in ranked order
+    """
+
+    names = stat_names(terms)
+    if rank_by not in names:
+        raise KeyError(f'Cannot rank by {rank_by}; expected one of {names}.')
+
+    key = stats[:, names.index(rank_by)]
+    order = np.argsort(-key if descending else key, kind='stable')[:top]
+
+    with open(output, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['rank', *terms.parameter_names, *names])
+        for rank, row in enumerate(order, start=1):
+            writer.writerow([rank, *sets[row].tolist(), *stats[row].tolist()])
+
+    return order
@@ -0,0 +1,208 @@
+"""
+Set up a ForceBalance run from the input csvs: the targets/ tree and a matching optimise.in.
+
+For every molecule of a QUBEKit input csv (e.g. input_files/Q2_trainingset.csv) that has a row in the reference table
+(molecule,density,hvap,temp), a target directory is written:
+    targets/molNN_liquid/data.csv    Global denominators, then T,P,MBAR,Rho,Rho_wt,Hvap,Hvap_wt
+    targets/molNN_liquid/gas.pdb     copied from the molecule's QUBEKit pdb, when a directory of them is given
+    targets/molNN_liquid/liquid.pdb  built from gas.pdb by liquid_box
+and optimise.in gets one Liquid_OpenMM $target block per directory, after an $options block pointing at combined.xml.
+Targets are written in a process pool; the liquid boxes are by far the slowest part, so skip them to lay out
+a large campaign in seconds and build the boxes later with `qubekit2-data liquid-box`.
+
+    build_target_tree('input_files/Q2_halos.csv', dest='halo_run', pdb_dir='runs/training/model0', jobs=8)
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import os
+import shutil
+
+import numpy as np
+
+from liquid_box import DEFAULT_DENSITY_SCALE, DEFAULT_MOLECULES, GAS_PDB, LIQUID_PDB, build_liquid_box
+from reference_data import REFERENCE_DIR
+
+
+# Reference table for each QUBEKit input csv in input_files.
+REFERENCE_TABLES = {
+    'Q2_trainingset.csv': 'training_data.csv',
+    'Q2_testset.csv': 'test_data.csv',
+    'Q2_halos.csv': 'halo_data.csv',
+}
+
+DATA_CSV = 'data.csv'
+TARGET_SUFFIX = '_liquid'
+# The Global rows of data.csv, as in example_fb_run.
+GLOBALS = (
+    ('rho_denom', 30),
+    ('hvap_denom', 3),
+    ('alpha_denom', 1),
+    ('kappa_denom', 5),
+    ('cp_denom', 2),
+    ('eps0_denom', 2),
+    ('use_cvib_intra', 'FALSE'),
+    ('use_cvib_inter', 'FALSE'),
+    ('use_cni', 'FALSE'),
+)
+DATA_COLUMNS = ('T', 'P', 'MBAR', 'Rho', 'Rho_wt', 'Hvap', 'Hvap_wt')
+PRESSURE = '1.0 atm'
+
+OPTIONS = (
+    ('forcefield', 'combined.xml'),
+    ('jobtype', 'newton'),
+    ('trust0', 0.3),
+    ('penalty_type', 'L2'),
+    ('penalty_additive', 1.0),
+    ('print_gradient', 1),
+    ('print_hessian', 0),
+    ('print_parameters', 1),
+    ('error_tolerance', 1.0),
+    ('mintrust', 0.1),
+    ('convergence_gradient', 0.001),
+    ('convergence_objective', 0.1),
+    ('convergence_step', 0.005),
+)
+TARGET_OPTIONS = (
+    ('type', 'Liquid_OpenMM'),
+    ('liquid_eq_steps', 100000),
+    ('liquid_md_steps', 1000000),
+    ('liquid_timestep', 1.0),
+    ('liquid_interval', 1.0),
+)
+
+# One target to write: the reference row of its molecule (as written in the table: kg/m^3, kJ/mol, K),
+# and the QUBEKit pdb to copy to gas.pdb, or None.
+TargetSpec = namedtuple('TargetSpec', 'name target_dir temperature density hvap pdb_path')
+
+
+def read_molecule_names(file_path):
+    """Molecule names of a QUBEKit input csv (name,smiles,...), in order."""
+
+    with open(file_path) as csv_file:
+        return [row['name'] for row in csv.DictReader(csv_file) if row['name']]
+
+
+def default_reference(molecules_csv):
+    """Reference table of one of the input csvs in input_files, e.g. halo_data.csv for Q2_halos.csv."""
+
+    name = os.path.basename(molecules_csv)
+    if name not in REFERENCE_TABLES:
+        raise KeyError(f'No default reference table for {name}; expected one of {sorted(REFERENCE_TABLES)}.')
+    return os.path.join(REFERENCE_DIR, REFERENCE_TABLES[name])
+
+
+def find_pdb(pdb_dir, name):
+    """The pdb of a molecule in a QUBEKit model (or collect) directory: <name>/<name>.pdb or <name>.pdb; else None."""
+
+    for file_path in (os.path.join(pdb_dir, name, f'{name}.pdb'), os.path.join(pdb_dir, f'{name}.pdb')):
+        if os.path.isfile(file_path):
+            return file_path
+    return None
+
+
+def target_specs(molecules_csv, reference_path=None, targets_dir='targets', pdb_dir=None):
+    """
+    The targets of every molecule in the input csv that has reference data.
+    :return: list of TargetSpec, list of the molecules without reference data
+    """
+
+    with open(reference_path or default_reference(molecules_csv)) as csv_file:
+        reference = {row['molecule']: row for row in csv.DictReader(csv_file)}
+
+    specs, missing = [], []
+    for name in read_molecule_names(molecules_csv):
+        if name not in reference:
+            missing.append(name)
+            continue
+        row = reference[name]
+        specs.append(TargetSpec(
+            name=name,
+            target_dir=os.path.join(targets_dir, f'{name}{TARGET_SUFFIX}'),
+            temperature=row['temp'],
+            density=row['density'],
+            hvap=row['hvap'],
+            pdb_path=find_pdb(pdb_dir, name) if pdb_dir is not None else None,
+        ))
+    return specs, missing
+
+
+def write_data_csv(file_path, temperature, density, hvap, density_weight=1, hvap_weight=1, globals_=GLOBALS):
+    """
+    Write a target's data.csv in the layout of example_fb_run.
+    :param density: kg/m^3
+    :param hvap: kJ/mol
+    """
+
+    with open(file_path, 'w', newline='') as csv_file:
+        # example_fb_run's data.csv files end their lines with \n, not csv's default \r\n.
+        writer = csv.writer(csv_file, lineterminator='\n')
+        writer.writerows(('Global', name, value) for name, value in globals_)
+        writer.writerow(DATA_COLUMNS)
+        writer.writerow((temperature, PRESSURE, 'FALSE', density, density_weight, hvap, hvap_weight))
+
+
+def write_target(spec, molecules=DEFAULT_MOLECULES, scale=DEFAULT_DENSITY_SCALE, build_box=True, seed=None,
+                 overwrite=False):
+    """
+    Write one target directory: data.csv, and gas.pdb and liquid.pdb when the spec has a pdb.
+    Existing gas.pdb and liquid.pdb are kept unless overwrite; data.csv is always rewritten.
+    :return: the spec's target_dir
+    """
+
+    os.makedirs(spec.target_dir, exist_ok=True)
+    write_data_csv(os.path.join(spec.target_dir, DATA_CSV), spec.temperature, spec.density, spec.hvap)
+    if spec.pdb_path is None:
+        return spec.target_dir
+
+    gas_path = os.path.join(spec.target_dir, GAS_PDB)
+    if overwrite or not os.path.exists(gas_path):
+        shutil.copyfile(spec.pdb_path, gas_path)
+    liquid_path = os.path.join(spec.target_dir, LIQUID_PDB)
+    if build_box and (overwrite or not os.path.exists(liquid_path)):
+        build_liquid_box(gas_path, liquid_path, float(spec.density) / 1000, molecules, scale=scale, seed=seed)
+    return spec.target_dir
+
+
+def format_optimise_in(target_names, options=OPTIONS, target_options=TARGET_OPTIONS):
+    """optimise.in text: the $options block, then one $target block per target name."""
+
+    blocks = ['$options', *(f'{key} {value}' for key, value in options), '$end', '']
+    for name in target_names:
+        target = dict(target_options, name=name)
+        blocks.extend(['$target', f'type {target.pop("type")}', f'name {target.pop("name")}'])
+        blocks.extend(f'{key} {value}' for key, value in target.items())
+        blocks.extend(['$end', ''])
+    return '\n'.join(blocks[:-1]) + '\n'
+
+
+def build_target_tree(molecules_csv, reference_path=None, dest='.', pdb_dir=None, forcefield=None,
+                      molecules=DEFAULT_MOLECULES, scale=DEFAULT_DENSITY_SCALE, build_boxes=True, seed=None,
+                      overwrite=False, jobs=1):
+    """
+    Write dest/targets/<name>_liquid for every molecule of molecules_csv with reference data, and dest/optimise.in.
+    :param pdb_dir: QUBEKit model or collect directory to copy each molecule's pdb from, as gas.pdb
+    :param forcefield: combined.xml to copy to dest/forcefield, if given
+    :return: list of TargetSpec written, list of the molecules skipped for want of reference data
+    """
+
+    specs, missing = target_specs(molecules_csv, reference_path, os.path.join(dest, 'targets'), pdb_dir)
+    seeds = np.random.SeedSequence(seed).spawn(len(specs))
+    arguments = [
+        (spec, molecules, scale, build_boxes, target_seed, overwrite) for spec, target_seed in zip(specs, seeds)
+    ]
+    if jobs > 1 and len(arguments) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(write_target, *zip(*arguments)))
+    else:
+        for target_arguments in arguments:
+            write_target(*target_arguments)
+
+    if forcefield is not None:
+        os.makedirs(os.path.join(dest, 'forcefield'), exist_ok=True)
+        shutil.copyfile(forcefield, os.path.join(dest, 'forcefield', os.path.basename(forcefield)))
+    options = OPTIONS if forcefield is None else (('forcefield', os.path.basename(forcefield)), *OPTIONS[1:])
+    with open(os.path.join(dest, 'optimise.in'), 'w') as optimise_file:
+        optimise_file.write(format_optimise_in([os.path.basename(spec.target_dir) for spec in specs], options))
+    return specs, missing
@@ -0,0 +1,34 @@
+"""
+Array-based topology helpers.
+
+Atoms are identified by their index in a molecule's AtomTypes and bonds are (from, to) pairs of those indices,
+exactly as they appear in the QUBEKit xmls.
+"""
+
+import numpy as np
+
+
+# A hydrogen bonded to any of these is polar and gets its own XElement/hpolfree parameter.
+POLAR_ELEMENTS = ('O', 'N', 'S')
+
+
+def polar_hydrogens(elements, bonds):
+    """
+    Classify every hydrogen in one vectorised pass over the bonds.
+    :param elements: element symbol per atom, None for virtual sites
+    :param bonds: iterable of (from, to) atom index pairs
+    :return: boolean array, True for each hydrogen bonded to O, N or S
+    """
+
+    elements = np.array([element or '' for element in elements], dtype=str)
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+
+    hydrogen = elements == 'H'
+    polar = np.isin(elements, POLAR_ELEMENTS)
+
+    polar_h = np.zeros(len(elements), dtype=bool)
+    # Bonds are undirected; check the hydrogen at either end.
+    for atom, partner in ((bonds[:, 0], bonds[:, 1]), (bonds[:, 1], bonds[:, 0])):
+        polar_h[atom[hydrogen[atom] & polar[partner]]] = True
+
+    return polar_h
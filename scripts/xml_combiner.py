@@ -13,85 +13,64 @@ Script will:
 """
 
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import os
-from types import SimpleNamespace
-from xml.dom.minidom import parseString
+import re
 import xml.etree.ElementTree as ET
 
-import networkx as nx
+from ddec import VOLUME_FILE_NAME, charge_file_name, read_ddec
+from ddec_cache import DEFAULT_MAX_BYTES, DDECCache
+from fragment_cache import FragmentCache, hash_files, model_cache_dir
+from manifest import build_manifest, latest_runs
+from renumber import format_field, offset_numbers, parse_id, renumber_id
+from topology import polar_hydrogens
+from xml_writer import StreamingXMLWriter, format_element
 
 
-class CustomNamespace(SimpleNamespace):
-    """
-    Adds iteration and dict-style access of keys, values and items to SimpleNamespace.
-    TODO Add get() method? (similar to dict)
-    """
-    def keys(self):
-        for key in self.__dict__:
-            yield key
+# Bump whenever render_molecule changes its output so cached fragments are re-rendered.
+FRAGMENT_VERSION = '2'
 
-    def values(self):
-        for value in self.__dict__.values():
-            yield value
 
-    def items(self):
-        for key, value in self.__dict__.items():
-            yield key, value
+def source_files(xml_path, charge_dir):
+    """All files a molecule's fragment is rendered from; used to key the fragment cache."""
 
-    def __iter__(self):
-        return self.items()
+    files = [xml_path]
+    if charge_dir is not None:
+        files.extend(os.path.join(charge_dir, file_name) for file_name in (charge_file_name(), VOLUME_FILE_NAME))
+    return [file for file in files if file is not None and os.path.exists(file)]
 
 
-def extract_charge_data():
+def build_fragment(mol_name, xml_path, charge_dir, ddec_cache_dir=None):
     """
-    From Chargemol output files, extract the necessary parameters for calculation of L-J.
+    Load the final xml and DDEC data for a single molecule and render its fragment of combined.xml.
+    Only paths are used (no os.chdir) so this is safe to call from worker processes.
+    :param ddec_cache_dir: DDECCache directory to load the parsed Chargemol outputs through; None parses them directly.
     """
 
-    net_charge_file_name = 'DDEC6_even_tempered_net_atomic_charges.xyz'
-
-    if not os.path.exists(net_charge_file_name):
-        raise FileNotFoundError(
-            'Cannot find the DDEC output file.\nThis could be indicative of several issues.\n'
-            'Please check Chargemol is installed in the correct location and that the configs'
-            ' point to that location.'
-        )
-
-    with open(net_charge_file_name, 'r+') as charge_file:
-        lines = charge_file.readlines()
-
-    # Find number of atoms
-    atom_total = int(lines[0])
-
-    for pos, row in enumerate(lines):
-        # Data marker:
-        if 'The following XYZ' in row:
-            start_pos = pos + 2
-            break
+    xml = ET.parse(xml_path)
+    if charge_dir is None:
+        ddec_data = None
+    elif ddec_cache_dir is not None:
+        ddec_data = DDECCache(ddec_cache_dir).read(charge_dir)
     else:
-        raise EOFError(f'Cannot find charge data in {net_charge_file_name}.')
-
-    ddec_data = {}
-
-    for line in lines[start_pos: start_pos + atom_total]:
-        # _s are the xyz coords, then the quadrupole moment tensor eigenvalues
-        atom_count, atomic_symbol, _, _, _, charge, x_dipole, y_dipole, z_dipole, _, q_xy, q_xz, q_yz, q_x2_y2, q_3z2_r2, *_ = line.split()
-        # File counts from 1 not 0; thereby requiring -1 to get the index
-        atom_index = int(atom_count) - 1
-        ddec_data[atom_index] = CustomNamespace(
-            atomic_symbol=atomic_symbol, charge=float(charge), volume=None, r_aim=None, b_i=None, a_i=None
-        )
-
-    r_cubed_file_name = 'DDEC_atomic_Rcubed_moments.xyz'
+        ddec_data = read_ddec(charge_dir)
 
-    with open(r_cubed_file_name, 'r+') as vol_file:
-        lines = vol_file.readlines()
+    return ParseXML.compile_fragment(ParseXML.render_molecule(mol_name, xml, ddec_data))
 
-    vols = [float(line.split()[-1]) for line in lines[2:atom_total + 2]]
 
-    for atom_index in ddec_data:
-        ddec_data[atom_index].volume = vols[atom_index]
+def render_fragments(stale, jobs=1):
+    """
+    Run build_fragment for every molecule in stale, in a process pool if jobs > 1.
+    :param stale: list of build_fragment argument tuples
+    :return: list of fragments, in the same order as stale
+    """
 
-    return ddec_data
+    if jobs > 1 and len(stale) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            # map yields results in submission order, regardless of which worker finishes first.
+            chunksize = max(1, len(stale) // (4 * jobs))
+            return list(pool.map(build_fragment, *zip(*stale), chunksize=chunksize))
+    return [build_fragment(*args) for args in stale]
 
 
 class ParseXML:
@@ -112,268 +91,413 @@ class ParseXML:
         "I": FreeParams(153.8, 385.0, 2.04),
     }
 
-    def __init__(self):
+    # Top-level sections of combined.xml, in the order they are written.
+    sections = (
+        ('AtomTypes', {}),
+        ('Residues', {}),
+        ('HarmonicBondForce', {}),
+        ('HarmonicAngleForce', {}),
+        ('PeriodicTorsionForce', {}),
+        ('NonbondedForce', {'coulomb14scale': '0.83333', 'lj14scale': '0.5', 'combination': 'amber'}),
+        ('ForceBalance', {}),
+    )
+    free_params = (
+        ('CElement', {'cfree': '2.08', 'bfree': '46.6', 'vfree': '34.4', 'parameterize': 'cfree'}),
+        ('NElement', {'nfree': '1.72', 'bfree': '24.2', 'vfree': '25.9', 'parameterize': 'nfree'}),
+        ('OElement', {'ofree': '1.60', 'bfree': '15.6', 'vfree': '22.1', 'parameterize': 'ofree'}),
+        ('HElement', {'hfree': '1.64', 'bfree': '6.5', 'vfree': '7.6', 'parameterize': 'hfree'}),
+        ('XElement', {'hpolfree': '1.00', 'bfree': '6.5', 'vfree': '7.6', 'parameterize': 'hpolfree'}),
+    )
+
+    def __init__(self, jobs=1, cache_dir='.combiner_cache', rebuild=False, manifest=None,
+                 ddec_cache_size=DEFAULT_MAX_BYTES, model_dir='.', ddec_cache=None, combine=True):
+        """
+        :param jobs: number of worker processes used to load the molecules; 1 loads them in this process.
+        :param cache_dir: where rendered fragments (and, in cache_dir/ddec, parsed Chargemol outputs)
+            are cached between runs, relative to model_dir; an absolute cache_dir keeps each model's fragments
+            apart (see fragment_cache.model_cache_dir) and shares the Chargemol cache. None disables caching.
+        :param rebuild: re-render every molecule, ignoring (but refreshing) any cached fragments.
+        :param manifest: list of ManifestEntry to combine; by default model_dir is indexed.
+        :param ddec_cache_size: size cap (bytes) of the Chargemol cache; least recently used entries are evicted.
+        :param model_dir: directory containing the QUBEKit run folders; combined.xml is written here.
+        :param ddec_cache: DDECCache to use instead of the one in cache_dir, e.g. one shared by several models.
+        :param combine: load the molecules and write combined.xml straight away.
+        """
 
+        self.output = os.path.join(model_dir, 'combined.xml')
         try:
-            os.remove('combined.xml')
+            os.remove(self.output)
         except FileNotFoundError:
             pass
 
-        self.xmls = dict()
-        self.ddec_data = dict()
-
-        self.find_xmls_and_ddec_data()
-        self.combine_molecules()
-
-    def find_xmls_and_ddec_data(self):
-        for root, dirs, files in os.walk('.', topdown=True):
-            for di in dirs:
-                if f'QUBEKit_mol' in di:
-                    mol_name = di.split('_')[1]
-                    os.chdir(di)
-                    for file in os.listdir('.'):
-                        if 'final' in file:
-                            os.chdir(file)
-                            self.xmls[mol_name] = ET.parse(f'{mol_name}.xml')
-                            os.chdir('../')
-                        elif 'charge' in file:
-                            os.chdir(os.path.join(file, 'ChargeMol'))
-                            self.ddec_data[mol_name] = extract_charge_data()
-                            os.chdir('../../')
-                    os.chdir('../')
+        self.jobs = jobs
+        self.model_dir = model_dir
+        self.cache = FragmentCache(model_cache_dir(model_dir, cache_dir)) if cache_dir is not None else None
+        if ddec_cache is None and cache_dir is not None:
+            ddec_cache = DDECCache(os.path.join(model_dir, cache_dir, 'ddec'), ddec_cache_size)
+        self.ddec_cache = ddec_cache
+        self.rebuild = rebuild
+        self.manifest = build_manifest(model_dir) if manifest is None else manifest
+        self.fragments = dict()
+        self.keys = dict()
+
+        if combine:
+            self.load_fragments()
+            self.combine_molecules()
+
+    def load_fragments(self):
+        """
+        Render every QUBEKit run folder in the manifest into its fragment of combined.xml.
+        Molecules whose source files are unchanged since the last run are taken from the cache;
+        the rest are loaded and rendered, in a process pool if jobs > 1.
+        """
+
+        stale = self.find_stale()
+        self.store_fragments(stale, render_fragments(stale, self.jobs))
+        if self.ddec_cache is not None:
+            self.ddec_cache.evict()
+
+    def find_stale(self):
+        """
+        Take every molecule whose source files are unchanged from the cache.
+        Fragments are stored in sorted name order so the combined xml is deterministic.
+        :return: build_fragment arguments for each molecule which still needs rendering
+        """
+
+        stale = []
+        ddec_cache_dir = self.ddec_cache.cache_dir if self.ddec_cache is not None else None
+        for mol_name, entry in latest_runs(self.manifest).items():
+            xml_path, charge_dir = entry.xml, entry.charge_dir
+            if xml_path is None:
+                continue
+            fragment = None
+            if self.cache is not None:
+                self.keys[mol_name] = hash_files(
+                    source_files(xml_path, charge_dir), salt=FRAGMENT_VERSION + mol_name,
+                )
+                if not self.rebuild:
+                    fragment = self.cache.get(mol_name, self.keys[mol_name])
+            # Placeholder keeps the sorted order when stale molecules are filled in below.
+            self.fragments[mol_name] = fragment
+            if fragment is None:
+                stale.append((mol_name, xml_path, charge_dir, ddec_cache_dir))
+
+        return stale
+
+    def store_fragments(self, stale, rendered):
+        """Fill in (and cache) the fragments rendered for the molecules find_stale returned."""
+
+        for (mol_name, *_), fragment in zip(stale, rendered):
+            self.fragments[mol_name] = fragment
+            if self.cache is not None:
+                self.cache.put(mol_name, self.keys[mol_name], fragment)
+
+        if self.cache is not None:
+            self.cache.prune(self.fragments)
+        prefix = '' if self.model_dir == '.' else f'{self.model_dir}: '
+        print(f'{prefix}Rendered {len(stale)} molecule(s), {len(self.fragments) - len(stale)} from cache.')
 
     @staticmethod
     def increment_str(string, increment):
         """Take any standard numbered string from the xml and increment it."""
-        if 'QUBE' in string:
-            num = int(string[5:]) + increment
-            return f'QUBE_{str(num).zfill(4)}'
-        if 'v-site' in string:
-            num = int(string[6:]) + increment
-            return f'v-site{str(num).zfill(4)}'
-        try:
-            return str(int(string) + increment)
-        except ValueError:
-            try:
-                num = int(string[1:]) + increment
-                return string[:1] + str(num)
-            except ValueError:
-                num = int(string[2:]) + increment
-                return string[:2] + str(num)
-
-    def combine_molecules(self):
+        return renumber_id(string, increment)
+
+    @classmethod
+    def render_molecule(cls, mol_name, xmlclass, ddec_data):
         """
-        * Create a skeleton xml containing all forcefield info.
-        * Loop over all molecule xmls found and insert them into this new file.
-        * For the Lennard-Jones section, make the necessary adjustments for FB.
+        Render one molecule's contribution to every section of combined.xml.
+        Class, name and type ids are left numbered from zero; combine_molecules offsets them when writing,
+        so a rendered fragment can be cached and reused whatever position the molecule ends up in.
+        :return: dict with the molecule's atom_count and, per section, a list of (tag, attrib, renumber, children);
+            renumber lists the attributes to offset and children is a list of (tag, attrib, renumber).
         """
 
-        # Create skeleton structure to add molecules into.
-        base = ET.Element('ForceField')
-        AtomTypes = ET.SubElement(base, 'AtomTypes')
-        Residues = ET.SubElement(base, 'Residues')
+        fragment = {section: [] for section, _ in cls.sections}
+        fragment['atom_count'] = 0
+
+        # Used to find polar Hs
+        bonds = []
+        elements = []
+
+        root = xmlclass.getroot()
+        if root.tag != 'ForceField':
+            raise RuntimeError('Not a proper forcefield file.')
+
+        # Residue children are collected per molecule and written as one element.
+        residue_children = []
+        for child in root:
+            if child.tag == 'AtomTypes':
+                for i, atom in enumerate(child):
+                    elements.append(atom.get('element'))
+                    if atom.get('element') is not None:
+                        # Normal Atom
+                        fragment['AtomTypes'].append(['Type', {
+                            'class': atom.get('class'),
+                            'element': atom.get('element'),
+                            'mass': atom.get('mass'),
+                            'name': atom.get('name'),
+                        }, ['class', 'name'], []])
+                    else:
+                        # Virtual Site
+                        fragment['AtomTypes'].append(['Type', {
+                            'class': atom.get('class'),
+                            'mass': atom.get('mass'),
+                            'name': atom.get('name'),
+                        }, ['class', 'name'], []])
+                    residue_children.append(['Atom', {
+                        'name': atom.get('class'),
+                        'type': atom.get('name'),
+                    }, ['name', 'type']])
+                # Get the final value of i for the number of atoms in the molecule.
+                fragment['atom_count'] = i + 1
+
+            elif child.tag == 'Residues':
+                for residue in child:
+                    for atom_or_bond in residue:
+                        if atom_or_bond.tag == 'Bond':
+                            residue_children.append(['Bond', {
+                                # Don't increment the atom indices for the bonds
+                                'from': atom_or_bond.get('from'),
+                                'to': atom_or_bond.get('to'),
+                            }, []])
+                            bonds.append((int(atom_or_bond.get('from')), int(atom_or_bond.get('to'))))
+                        elif atom_or_bond.tag == 'VirtualSite':
+                            if atom_or_bond.get('wx4') is None:
+                                residue_children.append(['VirtualSite', {
+                                    'atom1': atom_or_bond.get('atom1'),
+                                    'atom2': atom_or_bond.get('atom2'),
+                                    'atom3': atom_or_bond.get('atom3'),
+                                    'index': atom_or_bond.get('index'),
+                                    'p1': atom_or_bond.get('p1'),
+                                    'p2': atom_or_bond.get('p2'),
+                                    'p3': atom_or_bond.get('p3'),
+                                    'type': 'localCoords',
+                                    'wo1': '1.0',
+                                    'wo2': '0.0',
+                                    'wo3': '0.0',
+                                    'wx1': '-1.0',
+                                    'wx2': '1.0',
+                                    'wx3': '0.0',
+                                    'wy1': '-1.0',
+                                    'wy2': '0.0',
+                                    'wy3': '1.0',
+                                }, []])
+                            else:
+                                residue_children.append(['VirtualSite', {
+                                    'atom1': atom_or_bond.get('atom1'),
+                                    'atom2': atom_or_bond.get('atom2'),
+                                    'atom3': atom_or_bond.get('atom3'),
+                                    'atom4': atom_or_bond.get('atom4'),
+                                    'index': atom_or_bond.get('index'),
+                                    'p1': atom_or_bond.get('p1'),
+                                    'p2': atom_or_bond.get('p2'),
+                                    'p3': atom_or_bond.get('p3'),
+                                    'type': 'localCoords',
+                                    'wo1': '1.0',
+                                    'wo2': '0.0',
+                                    'wo3': '0.0',
+                                    'wo4': '0.0',
+                                    'wx1': '-1.0',
+                                    'wx2': '0.33333333',
+                                    'wx3': '0.33333333',
+                                    'wx4': '0.33333333',
+                                    'wy1': '1.0',
+                                    'wy2': '-1.0',
+                                    'wy3': '0.0',
+                                    'wy4': '0.0',
+                                }, []])
+            elif child.tag == 'HarmonicBondForce':
+                for force in child:
+                    fragment['HarmonicBondForce'].append(['Bond', {
+                        'class1': force.get('class1'),
+                        'class2': force.get('class2'),
+                        'length': force.get('length'),
+                        'k': force.get('k'),
+                    }, ['class1', 'class2'], []])
+
+            elif child.tag == 'HarmonicAngleForce':
+                for force in child:
+                    fragment['HarmonicAngleForce'].append(['Angle', {
+                        'class1': force.get('class1'),
+                        'class2': force.get('class2'),
+                        'class3': force.get('class3'),
+                        'angle': force.get('angle'),
+                        'k': force.get('k'),
+                    }, ['class1', 'class2', 'class3'], []])
+
+            elif child.tag == 'PeriodicTorsionForce':
+                for force in child:
+                    fragment['PeriodicTorsionForce'].append([force.tag, {
+                        'class1': force.get('class1'),
+                        'class2': force.get('class2'),
+                        'class3': force.get('class3'),
+                        'class4': force.get('class4'),
+                        'k1': force.get('k1'),
+                        'k2': force.get('k2'),
+                        'k3': force.get('k3'),
+                        'k4': force.get('k4'),
+                        'periodicity1': force.get('periodicity1'),
+                        'periodicity2': force.get('periodicity2'),
+                        'periodicity3': force.get('periodicity3'),
+                        'periodicity4': force.get('periodicity4'),
+                        'phase1': force.get('phase1'),
+                        'phase2': force.get('phase2'),
+                        'phase3': force.get('phase3'),
+                        'phase4': force.get('phase4'),
+                    }, ['class1', 'class2', 'class3', 'class4'], []])
+
+            elif child.tag == 'NonbondedForce':
+                symbols, volumes = ddec_data['symbol'].tolist(), ddec_data['volume'].tolist()
+                polar_h = polar_hydrogens(elements, bonds)
+                for atom_index, force in enumerate(child):
+                    if 'v-site' in force.get('type'):
+                        fragment['NonbondedForce'].append(['Atom', {
+                            'charge': force.get('charge'),
+                            'sigma': force.get('sigma'),
+                            'epsilon': force.get('epsilon'),
+                            'type': force.get('type'),
+                        }, ['type'], []])
+                    else:
+                        typ = force.get('type').split('_')[1]
+                        atomic_symbol = symbols[atom_index]
+                        ele = atomic_symbol
+                        free = atomic_symbol.lower()
+                        if polar_h[int(typ)]:
+                            ele = 'X'
+                            free = 'hpol'
+                        vol = volumes[atom_index]
+                        bfree = cls.elem_dict[atomic_symbol].bfree
+                        vfree = cls.elem_dict[atomic_symbol].vfree
+                        alpha = 1.0
+                        beta = 0.001
+                        fragment['NonbondedForce'].append(['Atom', {
+                            'charge': force.get('charge'),
+                            'sigma': force.get('sigma'),
+                            'epsilon': force.get('epsilon'),
+                            'type': force.get('type'),
+                            'volume': f'{vol}',
+                            'bfree': f'{bfree}',
+                            'vfree': f'{vfree}',
+                            'alpha': f'{alpha}',
+                            'beta': f'{beta}',
+                            'parameter_eval':
+                                f"epsilon=(PARM['xalpha/alpha']*{bfree}*({vol}/{vfree})**PARM['xbeta/beta'])/(128*PARM['{ele}Element/{free}free']**6)*{57.65243631675715}, "
+                                # f"epsilon={bfree}/(128*PARM['{ele}Element/{free}free']**6)*{57.65243631675715}, "
+                                f"sigma=2**(5/6)*({vol}/{vfree})**(1/3)*PARM['{ele}Element/{free}free']*{0.1}",
+                        }, ['type'], []])
+
+        fragment['Residues'].append(['Residue', {'name': mol_name}, [], residue_children])
+
+        return fragment
 
-        HarmonicBondForce = ET.SubElement(base, 'HarmonicBondForce')
-        HarmonicAngleForce = ET.SubElement(base, 'HarmonicAngleForce')
-        PeriodicTorsionForce = ET.SubElement(base, 'PeriodicTorsionForce')
+    @staticmethod
+    def compile_fragment(rendered):
+        """
+        Serialise a rendered molecule into one text template per section.
+        Each renumbered attribute is parsed once (see renumber.py) and becomes a format field,
+        e.g. QUBE_{3:04d}, into the fragment's list of id numbers,
+        so writing the molecule at any offset is a single str.format per section.
+        :return: dict with atom_count, numbers (the zero-based id numbers) and sections (section name: template)
+        """
 
-        NonbondedForce = ET.SubElement(base, 'NonbondedForce', attrib={
-            'coulomb14scale': '0.83333', 'lj14scale': '0.5',
-            'combination': 'amber'})
+        numbers, fields, slots = [], [], dict()
+
+        def placeholders(attrib, renumber):
+            attrib = dict(attrib)
+            for key in renumber:
+                if attrib[key] not in slots:
+                    id_format = parse_id(attrib[key])
+                    slots[attrib[key]] = len(numbers)
+                    fields.append(format_field(id_format, len(numbers)))
+                    numbers.append(id_format.number)
+                # NUL cannot appear in xml so it safely marks the slot through escaping.
+                attrib[key] = f'\x00{slots[attrib[key]]}\x00'
+            return attrib
+
+        sections = dict()
+        for section, _ in ParseXML.sections:
+            text = ''.join(
+                format_element(
+                    tag, placeholders(attrib, renumber),
+                    [(child_tag, placeholders(child_attrib, child_renumber))
+                     for child_tag, child_attrib, child_renumber in children],
+                )
+                for tag, attrib, renumber, children in rendered[section]
+            )
+            text = text.replace('{', '{{').replace('}', '}}')
+            sections[section] = re.sub(r'\x00(\d+)\x00', lambda match: fields[int(match.group(1))], text)
+
+        return {'atom_count': rendered['atom_count'], 'numbers': numbers, 'sections': sections}
+
+    def combine_molecules(self, writer=None):
+        """
+        * Create a skeleton xml containing all forcefield info.
+        * Loop over all rendered molecules and insert them into this new file, offsetting their ids.
+        :param writer: StreamingXMLWriter to write into; defaults to combined.xml in model_dir.
+        """
 
-        ForceBalance = ET.SubElement(base, 'ForceBalance')
-        ET.SubElement(ForceBalance, 'CElement', cfree='2.08', bfree='46.6', vfree='34.4', parameterize='cfree')
-        ET.SubElement(ForceBalance, 'NElement', nfree='1.72', bfree='24.2', vfree='25.9', parameterize='nfree')
-        ET.SubElement(ForceBalance, 'OElement', ofree='1.60', bfree='15.6', vfree='22.1', parameterize='ofree')
-        ET.SubElement(ForceBalance, 'HElement', hfree='1.64', bfree='6.5', vfree='7.6', parameterize='hfree')
-        ET.SubElement(ForceBalance, 'XElement', hpolfree='1.00', bfree='6.5', vfree='7.6', parameterize='hpolfree')
+        # Skeleton structure to add molecules into; each section is streamed to file as it is built.
+        if writer is None:
+            writer = StreamingXMLWriter(self.output, 'ForceField', self.sections)
 
         # Increase by the number of atoms in each molecule upon addition to the combined xml.
         increment = 0
-        raise_by = 0
-
-        for mol_name, xmlclass in self.xmls.items():
-
-            # Used to find polar Hs
-            topology = nx.Graph()
-            atoms = dict()
-
-            root = xmlclass.getroot()
-            if root.tag != 'ForceField':
-                raise RuntimeError('Not a proper forcefield file.')
-
-            Residue = ET.SubElement(Residues, 'Residue', name=mol_name)
-            for child in root:
-                if child.tag == 'AtomTypes':
-                    for i, atom in enumerate(child):
-                        atoms[str(i)] = atom.get('element')
-                        if atom.get('element') is not None:
-                            # Normal Atom
-                            ET.SubElement(AtomTypes, 'Type', attrib={
-                                'class': self.increment_str(atom.get('class'), increment),
-                                'element': atom.get('element'),
-                                'mass': atom.get('mass'),
-                                'name': self.increment_str(atom.get('name'), increment),
-                            })
-                        else:
-                            # Virtual Site
-                            ET.SubElement(AtomTypes, 'Type', attrib={
-                                'class': self.increment_str(atom.get('class'), increment),
-                                'mass': atom.get('mass'),
-                                'name': self.increment_str(atom.get('name'), increment),
-                            })
-                        ET.SubElement(Residue, 'Atom', attrib={
-                            'name': self.increment_str(atom.get('class'), increment),
-                            'type': self.increment_str(atom.get('name'), increment),
-                        })
-                    # Get the final value of i for the number of atoms in the molecule.
-                    raise_by = i + 1
-
-                elif child.tag == 'Residues':
-                    for residue in child:
-                        for atom_or_bond in residue:
-                            if atom_or_bond.tag == 'Bond':
-                                ET.SubElement(Residue, 'Bond', attrib={
-                                    # Don't increment the atom indices for the bonds
-                                    'from': atom_or_bond.get('from'),
-                                    'to': atom_or_bond.get('to'),
-                                })
-                                topology.add_node(atom_or_bond.get('from'))
-                                topology.add_node(atom_or_bond.get('to'))
-                                topology.add_edge(atom_or_bond.get('from'), atom_or_bond.get('to'))
-                            elif atom_or_bond.tag == 'VirtualSite':
-                                if atom_or_bond.get('wx4') is None:
-                                    ET.SubElement(Residue, 'VirtualSite', attrib={
-                                        'atom1': atom_or_bond.get('atom1'),
-                                        'atom2': atom_or_bond.get('atom2'),
-                                        'atom3': atom_or_bond.get('atom3'),
-                                        'index': atom_or_bond.get('index'),
-                                        'p1': atom_or_bond.get('p1'),
-                                        'p2': atom_or_bond.get('p2'),
-                                        'p3': atom_or_bond.get('p3'),
-                                        'type': 'localCoords',
-                                        'wo1': '1.0',
-                                        'wo2': '0.0',
-                                        'wo3': '0.0',
-                                        'wx1': '-1.0',
-                                        'wx2': '1.0',
-                                        'wx3': '0.0',
-                                        'wy1': '-1.0',
-                                        'wy2': '0.0',
-                                        'wy3': '1.0',
-                                    })
-                                else:
-                                    ET.SubElement(Residue, 'VirtualSite', attrib={
-                                        'atom1': atom_or_bond.get('atom1'),
-                                        'atom2': atom_or_bond.get('atom2'),
-                                        'atom3': atom_or_bond.get('atom3'),
-                                        'atom4': atom_or_bond.get('atom4'),
-                                        'index': atom_or_bond.get('index'),
-                                        'p1': atom_or_bond.get('p1'),
-                                        'p2': atom_or_bond.get('p2'),
-                                        'p3': atom_or_bond.get('p3'),
-                                        'type': 'localCoords',
-                                        'wo1': '1.0',
-                                        'wo2': '0.0',
-                                        'wo3': '0.0',
-                                        'wo4': '0.0',
-                                        'wx1': '-1.0',
-                                        'wx2': '0.33333333',
-                                        'wx3': '0.33333333',
-                                        'wx4': '0.33333333',
-                                        'wy1': '1.0',
-                                        'wy2': '-1.0',
-                                        'wy3': '0.0',
-                                        'wy4': '0.0',
-                                    })
-                elif child.tag == 'HarmonicBondForce':
-                    for force in child:
-                        ET.SubElement(HarmonicBondForce, 'Bond', attrib={
-                            'class1': self.increment_str(force.get('class1'), increment),
-                            'class2': self.increment_str(force.get('class2'), increment),
-                            'length': force.get('length'),
-                            'k': force.get('k'),
-                        })
-
-                elif child.tag == 'HarmonicAngleForce':
-                    for force in child:
-                        ET.SubElement(HarmonicAngleForce, 'Angle', attrib={
-                            'class1': self.increment_str(force.get('class1'), increment),
-                            'class2': self.increment_str(force.get('class2'), increment),
-                            'class3': self.increment_str(force.get('class3'), increment),
-                            'angle': force.get('angle'),
-                            'k': force.get('k'),
-                        })
-
-                elif child.tag == 'PeriodicTorsionForce':
-                    for force in child:
-                        ET.SubElement(PeriodicTorsionForce, force.tag, attrib={
-                            'class1': self.increment_str(force.get('class1'), increment),
-                            'class2': self.increment_str(force.get('class2'), increment),
-                            'class3': self.increment_str(force.get('class3'), increment),
-                            'class4': self.increment_str(force.get('class4'), increment),
-                            'k1': force.get('k1'),
-                            'k2': force.get('k2'),
-                            'k3': force.get('k3'),
-                            'k4': force.get('k4'),
-                            'periodicity1': force.get('periodicity1'),
-                            'periodicity2': force.get('periodicity2'),
-                            'periodicity3': force.get('periodicity3'),
-                            'periodicity4': force.get('periodicity4'),
-                            'phase1': force.get('phase1'),
-                            'phase2': force.get('phase2'),
-                            'phase3': force.get('phase3'),
-                            'phase4': force.get('phase4'),
-                        })
-
-                elif child.tag == 'NonbondedForce':
-                    for atom_index, force in enumerate(child):
-                        if 'v-site' in force.get('type'):
-                            ET.SubElement(NonbondedForce, 'Atom', attrib={
-                                'charge': force.get('charge'),
-                                'sigma': force.get('sigma'),
-                                'epsilon': force.get('epsilon'),
-                                'type': self.increment_str(force.get('type'), increment),
-                            })
-                        else:
-                            typ = force.get('type').split('_')[1]
-                            atomic_symbol = self.ddec_data[mol_name][atom_index].atomic_symbol
-                            ele = atomic_symbol
-                            free = atomic_symbol.lower()
-                            if atoms[typ] == 'H':
-                                for bonded in topology.neighbors(typ):
-                                    if atoms[bonded] in ['O', 'N', 'S']:
-                                        ele = 'X'
-                                        free = 'hpol'
-                            vol = self.ddec_data[mol_name][atom_index].volume
-                            bfree = self.elem_dict[atomic_symbol].bfree
-                            vfree = self.elem_dict[atomic_symbol].vfree
-                            alpha = 1.0
-                            beta = 0.001
-                            ET.SubElement(NonbondedForce, 'Atom', attrib={
-                                'charge': force.get('charge'),
-                                'sigma': force.get('sigma'),
-                                'epsilon': force.get('epsilon'),
-                                'type': self.increment_str(force.get('type'), increment),
-                                'volume': f'{vol}',
-                                'bfree': f'{bfree}',
-                                'vfree': f'{vfree}',
-                                'alpha': f'{alpha}',
-                                'beta': f'{beta}',
-                                'parameter_eval':
-                                    f"epsilon=(PARM['xalpha/alpha']*{bfree}*({vol}/{vfree})**PARM['xbeta/beta'])/(128*PARM['{ele}Element/{free}free']**6)*{57.65243631675715}, "
-                                    # f"epsilon={bfree}/(128*PARM['{ele}Element/{free}free']**6)*{57.65243631675715}, "
-                                    f"sigma=2**(5/6)*({vol}/{vfree})**(1/3)*PARM['{ele}Element/{free}free']*{0.1}",
-                            })
-            increment += raise_by
-
-        tree = ET.ElementTree(base).getroot()
-        messy = ET.tostring(tree, 'utf-8')
-        pretty_xml_as_string = parseString(messy).toprettyxml(indent="")
-
-        with open('combined.xml', 'w+') as xml_doc:
-            xml_doc.write(pretty_xml_as_string)
+
+        for fragment in self.fragments.values():
+            numbers = offset_numbers(fragment['numbers'], increment)
+            for section, template in fragment['sections'].items():
+                writer.text(section, template.format(*numbers))
+            increment += fragment['atom_count']
+
+        for tag, attrib in self.free_params:
+            writer.element('ForceBalance', tag, attrib)
+
+        writer.close()
+
+
+def combine_models(model_dirs, jobs=1, cache_dir='.combiner_cache', rebuild=False, manifest=None,
+                   ddec_cache_size=DEFAULT_MAX_BYTES):
+    """
+    Build combined.xml in each of several model directories (e.g. runs/training/model*) in one go.
+    The directories are indexed once, together, and every stale molecule from every model is rendered in one pool.
+    Rendered fragments are cached per model (molecule names repeat between models),
+    while parsed Chargemol outputs go into one cache, cache_dir/ddec relative to the cwd, shared by all models.
+    :param model_dirs: directories containing QUBEKit run folders
+    :param manifest: ManifestEntry list covering all of model_dirs; by default their common parent is indexed.
+    See ParseXML for the remaining parameters.
+    """
+
+    if manifest is None:
+        manifest = build_manifest(os.path.commonpath([os.path.abspath(model_dir) for model_dir in model_dirs]))
+    ddec_cache = DDECCache(os.path.join(cache_dir, 'ddec'), ddec_cache_size) if cache_dir is not None else None
+
+    models, stale = [], []
+    for model_dir in model_dirs:
+        model_root = os.path.abspath(model_dir)
+        entries = [
+            entry for entry in manifest
+            if os.path.commonpath([model_root, os.path.abspath(entry.run_dir)]) == model_root
+        ]
+        model = ParseXML(
+            cache_dir=cache_dir, rebuild=rebuild, manifest=entries, model_dir=model_dir, ddec_cache=ddec_cache,
+            combine=False,
+        )
+        models.append(model)
+        stale.append(model.find_stale())
+
+    # One flat list of work so the pool stays busy however unevenly the stale molecules are spread over models.
+    rendered = iter(render_fragments([args for model_stale in stale for args in model_stale], jobs))
+    for model, model_stale in zip(models, stale):
+        model.store_fragments(model_stale, [next(rendered) for _ in model_stale])
+        model.combine_molecules()
+
+    if ddec_cache is not None:
+        ddec_cache.evict()
 
 
 if __name__ == '__main__':
-    ParseXML()
+    import sys
+
+    from qubekit2_data import main
+
+    sys.exit(main(['combine', *sys.argv[1:]]))
@@ -5,7 +5,9 @@ import os
 from xml.dom.minidom import parseString
 import xml.etree.ElementTree as ET
 
-import networkx as nx
+from ddec import read_ddec
+from ddec_cache import DDECCache
+from manifest import build_manifest, latest_runs
 
 
 """
@@ -20,102 +22,6 @@ Script will:
         * Params needed for forcebalance`
 """
 
-from types import SimpleNamespace
-
-
-class CustomNamespace(SimpleNamespace):
-    """
-    Adds iteration and dict-style access of keys, values and items to SimpleNamespace.
-    """
-    def keys(self):
-        for key in self.__dict__:
-            yield key
-
-    def values(self):
-        for value in self.__dict__.values():
-            yield value
-
-    def items(self):
-        for key, value in self.__dict__.items():
-            yield key, value
-
-    def __iter__(self):
-        return self.items()
-
-
-def extract_charge_data(ddec_version=6):
-    """
-    From Chargemol output files, extract the necessary parameters for calculation of L-J.
-
-    :returns: 3 CustomNamespaces, ddec_data; dipole_moment_data; and quadrupole_moment_data
-    ddec_data used for calculating monopole esp and L-J values (used by both LennardJones and Charges classes)
-    dipole_moment_data used for calculating dipole esp
-    quadrupole_moment_data used for calculating quadrupole esp
-    """
-
-    if ddec_version == 6:
-        net_charge_file_name = 'DDEC6_even_tempered_net_atomic_charges.xyz'
-
-    elif ddec_version == 3:
-        net_charge_file_name = 'DDEC3_net_atomic_charges.xyz'
-
-    else:
-        raise ValueError('Unsupported DDEC version; please use version 3 or 6.')
-
-    if not os.path.exists(net_charge_file_name):
-        raise FileNotFoundError(
-            'Cannot find the DDEC output file.\nThis could be indicative of several issues.\n'
-            'Please check Chargemol is installed in the correct location and that the configs'
-            ' point to that location.'
-        )
-
-    with open(net_charge_file_name, 'r+') as charge_file:
-        lines = charge_file.readlines()
-
-    # Find number of atoms
-    atom_total = int(lines[0])
-
-    for pos, row in enumerate(lines):
-        # Data marker:
-        if 'The following XYZ' in row:
-            start_pos = pos + 2
-            break
-    else:
-        raise EOFError(f'Cannot find charge data in {net_charge_file_name}.')
-
-    ddec_data = {}
-    dipole_moment_data = {}
-    quadrupole_moment_data = {}
-
-    for line in lines[start_pos: start_pos + atom_total]:
-        # _s are the xyz coords, then the quadrupole moment tensor eigenvalues
-        atom_count, atomic_symbol, _, _, _, charge, x_dipole, y_dipole, z_dipole, _, q_xy, q_xz, q_yz, q_x2_y2, q_3z2_r2, *_ = line.split()
-        # File counts from 1 not 0; thereby requiring -1 to get the index
-        atom_index = int(atom_count) - 1
-        ddec_data[atom_index] = CustomNamespace(
-            atomic_symbol=atomic_symbol, charge=float(charge), volume=None, r_aim=None, b_i=None, a_i=None
-        )
-
-        dipole_moment_data[atom_index] = CustomNamespace(
-            x_dipole=float(x_dipole), y_dipole=float(y_dipole), z_dipole=float(z_dipole)
-        )
-
-        quadrupole_moment_data[atom_index] = CustomNamespace(
-            q_xy=float(q_xy), q_xz=float(q_xz), q_yz=float(q_yz), q_x2_y2=float(q_x2_y2), q_3z2_r2=float(q_3z2_r2)
-        )
-
-    r_cubed_file_name = 'DDEC_atomic_Rcubed_moments.xyz'
-
-    with open(r_cubed_file_name, 'r+') as vol_file:
-        lines = vol_file.readlines()
-
-    vols = [float(line.split()[-1]) for line in lines[2:atom_total + 2]]
-
-    for atom_index in ddec_data:
-        ddec_data[atom_index].volume = vols[atom_index]
-
-    return ddec_data, dipole_moment_data, quadrupole_moment_data
-
 
 class ParseXML:
 
@@ -135,7 +41,11 @@ class ParseXML:
         "I": FreeParams(153.8, 385.0, 2.04),
     }
 
-    def __init__(self):
+    def __init__(self, cache_dir='.combiner_cache'):
+        """
+        :param cache_dir: where parsed Chargemol outputs are cached between runs (in cache_dir/ddec);
+            None disables the cache.
+        """
 
         try:
             os.remove('combined.xml')
@@ -144,23 +54,25 @@ class ParseXML:
 
         self.xmls = dict()
         self.ddec_data = dict()
+        self.ddec_cache = DDECCache(os.path.join(cache_dir, 'ddec')) if cache_dir is not None else None
 
         self.find_xmls_and_ddec_data()
         self.combine_molecules()
 
     def find_xmls_and_ddec_data(self):
-        for root, dirs, files in os.walk('.', topdown=True):
-            for di in dirs:
-                if f'QUBEKit_mol' in di:
-                    mol_name = di.split('_')[1]
-                    self.xmls[mol_name] = ET.parse(f'{di}/final_parameters/{mol_name}.xml')
-
-                    home = os.getcwd()
-                    os.chdir(f'{di}/charges/ChargeMol')
-                    ddec_data, _, _ = extract_charge_data()
-                    os.chdir(home)
-
-                    self.ddec_data[mol_name] = ddec_data
+        for mol_name, entry in latest_runs(build_manifest('.')).items():
+            # Half-finished runs are left out; the Rfree terms need both the final xml and the DDEC volumes.
+            if entry.xml is None or entry.charge_dir is None:
+                missing = 'final xml' if entry.xml is None else 'DDEC outputs'
+                print(f'Skipping {mol_name}: no {missing} in {entry.run_dir}')
+                continue
+            self.xmls[mol_name] = ET.parse(entry.xml)
+            if self.ddec_cache is not None:
+                self.ddec_data[mol_name] = self.ddec_cache.read(entry.charge_dir)
+            else:
+                self.ddec_data[mol_name] = read_ddec(entry.charge_dir)
+        if self.ddec_cache is not None:
+            self.ddec_cache.evict()
 
     @staticmethod
     def increment_str(string, increment):
@@ -213,10 +125,6 @@ class ParseXML:
 
         for mol_name, xmlclass in self.xmls.items():
 
-            # Used to find polar Hs
-            topology = nx.Graph()
-            atoms = dict()
-
             root = xmlclass.getroot()
             if root.tag != 'ForceField':
                 raise RuntimeError('Not a proper forcefield file.')
@@ -225,7 +133,6 @@ class ParseXML:
             for child in root:
                 if child.tag == 'AtomTypes':
                     for i, atom in enumerate(child):
-                        atoms[str(i)] = atom.get('element')
                         if atom.get('element') is not None:
                             ET.SubElement(AtomTypes, 'Type', attrib={
                                 'class': self.increment_str(atom.get('class'), increment),
@@ -255,9 +162,6 @@ class ParseXML:
                                     'from': atom_or_bond.get('from'),
                                     'to': atom_or_bond.get('to'),
                                 })
-                                topology.add_node(atom_or_bond.get('from'))
-                                topology.add_node(atom_or_bond.get('to'))
-                                topology.add_edge(atom_or_bond.get('from'), atom_or_bond.get('to'))
                 elif child.tag == 'HarmonicBondForce':
                     for force in child:
                         ET.SubElement(HarmonicBondForce, 'Bond', attrib={
@@ -300,16 +204,10 @@ class ParseXML:
 
                 elif child.tag == 'NonbondedForce':
                     for atom_index, force in enumerate(child):
-                        typ = force.get('type').split('_')[1]
-                        atomic_symbol = self.ddec_data[mol_name][atom_index].atomic_symbol
+                        atomic_symbol = str(self.ddec_data[mol_name]['symbol'][atom_index])
                         ele = atomic_symbol
                         free = atomic_symbol.lower()
-                        # if atoms[typ] == 'H':
-                        #     for bonded in topology.neighbors(typ):
-                        #         if atoms[bonded] in ['O', 'N', 'S']:
-                        #             ele = 'X'
-                        #             free = 'hpol'
-                        vol = self.ddec_data[mol_name][atom_index].volume
+                        vol = float(self.ddec_data[mol_name]['volume'][atom_index])
                         bfree = self.elem_dict[atomic_symbol].bfree
                         vfree = self.elem_dict[atomic_symbol].vfree
                         ET.SubElement(NonbondedForce, 'Atom', attrib={
@@ -336,4 +234,8 @@ class ParseXML:
 
 
 if __name__ == '__main__':
-    ParseXML()
+    import sys
+
+    from qubekit2_data import main
+
+    sys.exit(main(['combine-008', *sys.argv[1:]]))
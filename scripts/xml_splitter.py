@@ -0,0 +1,207 @@
+"""
+Split an optimised combined.xml back into one QUBEKit-style xml per molecule, with the final sigma and epsilon.
+
+combine_molecules writes each molecule's elements, in the same molecule order, into every section of combined.xml,
+with its class, name and type ids offset by the atoms written before it (QUBE_0003 -> QUBE_0103).
+Each section is therefore read by its own stream (see forcefield_check.iter_forcefield), all of them kept in step:
+a molecule's Residue gives its block of ids [offset, offset + atoms), its elements are taken from the front of every
+other section while their ids fall in that block, and the molecule is written as
+    <dest>/<name>/<name>.xml    residue UNK, ids back from zero, NonbondedForce sigma/epsilon as numbers
+before the next is read. Only one molecule is held at a time however large the forcefield.
+
+sigma and epsilon come from each atom's parameter_eval (see rfree.py) at the final physical parameters of
+an optimise.out: its Final physical parameters, or for an unfinished run the Next column of its last
+Physical Parameters block (the parameters it saved to optimise.sav). Parameters not in optimise.out keep
+their values in the forcefield.
+
+    split_forcefield('result/optimise/combined.xml', 'optimised', optimise_out='optimise.out')
+"""
+
+import os
+import xml.etree.ElementTree as ET
+
+from fb_output import ParameterValue, read_optimise_out
+from forcefield_check import iter_forcefield
+from renumber import parse_id, restore_id
+from rfree import compile_atoms, evaluate, parameter_vector, read_parameters
+from xml_combiner import ParseXML
+from xml_writer import format_attributes, format_element
+
+
+RESIDUE_NAME = 'UNK'
+# Sections of a per-molecule xml, and the attribute whose id places each of their elements in a molecule.
+SECTIONS = tuple(section for section in ParseXML.sections if section[0] != 'ForceBalance')
+SECTION_KEYS = {
+    'AtomTypes': 'name',
+    'HarmonicBondForce': 'class1',
+    'HarmonicAngleForce': 'class1',
+    'PeriodicTorsionForce': 'class1',
+    'NonbondedForce': 'type',
+}
+# Attributes holding ids to renumber, per tag; anything else is copied as it is.
+RENUMBERED = {
+    'Type': ('class', 'name'),
+    'Atom': ('name', 'type'),
+    'Bond': ('class1', 'class2'),
+    'Angle': ('class1', 'class2', 'class3'),
+    'Proper': ('class1', 'class2', 'class3', 'class4'),
+    'Improper': ('class1', 'class2', 'class3', 'class4'),
+}
+# Attributes of the combiner's NonbondedForce Atoms which only serve parameter_eval.
+RFREE_ATTRIBUTES = ('volume', 'bfree', 'vfree', 'alpha', 'beta', 'parameter_eval')
+
+
+def final_parameters(optimise_out='optimise.out'):
+    """
+    The last physical parameters of a ForceBalance run.
+    :return: dict of parameter name (e.g. CElement/cfree): value; empty if the log has none
+    """
+
+    final, last = {}, {}
+    for record in read_optimise_out(optimise_out):
+        if not isinstance(record, ParameterValue):
+            continue
+        if record.block == 'final physical':
+            final[record.name] = record.value
+        elif record.block == 'physical' and record.next is not None:
+            last[record.name] = record.next
+    return final or last
+
+
+class SectionStream:
+    """The children of one section of a forcefield, taken from the front a molecule at a time."""
+
+    def __init__(self, xml_path, section, key):
+        """
+        :param key: attribute whose id number places an element in a molecule's block, e.g. 'type'
+        """
+
+        self.section = section
+        self.key = key
+        self.elements = (element for tag, element in iter_forcefield(xml_path) if tag == section)
+        self.pending = next(self.elements, None)
+
+    def take(self, first, last):
+        """Every element, from the front of the stream, whose id number is in [first, last)."""
+
+        taken = []
+        while self.pending is not None:
+            number = parse_id(self.pending.get(self.key)).number
+            if number >= last:
+                break
+            if number < first:
+                raise ValueError(
+                    f'{self.section} {self.pending.get(self.key)} is out of molecule order; '
+                    f'check the forcefield with `qubekit2-data check`.'
+                )
+            taken.append(self.pending)
+            self.pending = next(self.elements, None)
+        return taken
+
+    def close(self):
+        self.elements.close()
+
+
+def restore_attributes(element, offset):
+    """An element's attributes with its ids moved back by offset."""
+
+    attrib = dict(element.attrib)
+    for key in RENUMBERED.get(element.tag, ()):
+        if key in attrib:
+            attrib[key] = restore_id(attrib[key], offset)
+    return attrib
+
+
+def nonbonded_atoms(atoms, offset, initial, parameters):
+    """
+    A molecule's NonbondedForce Atom attributes, with sigma and epsilon evaluated at parameters.
+    :param initial: dict of parameter name: value for those not given in parameters; updated with the values
+        of any first seen in these atoms, so later molecules evaluate at the same ones
+    """
+
+    terms = compile_atoms((atom for atom in atoms if atom.get('parameter_eval') is not None), initial)
+    for name, value in zip(terms.parameter_names, terms.initial):
+        initial.setdefault(name, value)
+    values = {name: value for name, value in parameters.items() if name in terms.parameter_names}
+    sigma, epsilon = evaluate(terms, parameter_vector(terms, values))
+    evaluated = {atom_type: (s, e) for atom_type, s, e in zip(terms.types, sigma, epsilon)}
+
+    written = []
+    for atom in atoms:
+        attrib = {key: value for key, value in atom.attrib.items() if key not in RFREE_ATTRIBUTES}
+        if atom.get('type') in evaluated:
+            atom_sigma, atom_epsilon = evaluated[atom.get('type')]
+            attrib.update(sigma=f'{atom_sigma:.6f}', epsilon=f'{atom_epsilon:.6f}')
+        attrib['type'] = restore_id(attrib['type'], offset)
+        written.append(dict(sorted(attrib.items())))
+    return written
+
+
+def write_molecule(file_path, offset, residue, elements, nonbonded):
+    """
+    Write one molecule's xml in the layout of the QUBEKit xmls.
+    :param elements: dict of section: elements taken from combined.xml, other than Residues and NonbondedForce
+    :param nonbonded: NonbondedForce Atom attributes from nonbonded_atoms
+    """
+
+    children = [(child.tag, restore_attributes(child, offset)) for child in residue]
+    with open(file_path, 'w') as xml_file:
+        xml_file.write('<?xml version="1.0" ?>\n<ForceField>\n')
+        for section, attrib in SECTIONS:
+            if section == 'Residues':
+                content = format_element('Residue', {'name': RESIDUE_NAME}, children)
+            elif section == 'NonbondedForce':
+                content = ''.join(format_element('Atom', atom) for atom in nonbonded)
+            else:
+                content = ''.join(
+                    format_element(element.tag, restore_attributes(element, offset)) for element in elements[section]
+                )
+            # QUBEKit's xmls list attributes alphabetically.
+            attrib = dict(sorted(attrib.items()))
+            if content:
+                xml_file.write(f'<{section}{format_attributes(attrib)}>\n{content}</{section}>\n')
+            else:
+                xml_file.write(format_element(section, attrib))
+        xml_file.write('</ForceField>\n')
+
+
+def split_forcefield(xml_path='combined.xml', dest='.', optimise_out=None, parameters=None):
+    """
+    Write <dest>/<name>/<name>.xml for every molecule (Residue) of a combined.xml.
+    :param optimise_out: ForceBalance log to take the final physical parameters from
+    :param parameters: dict of parameter name: value, over those of optimise_out; the rest keep the forcefield's
+    :return: list of the xmls written, in the order of combined.xml
+    """
+
+    values = final_parameters(optimise_out) if optimise_out is not None else {}
+    values.update(parameters or {})
+
+    forcebalance = ET.Element('ForceField')
+    section = ET.SubElement(forcebalance, 'ForceBalance')
+    section.extend(element for tag, element in iter_forcefield(xml_path) if tag == 'ForceBalance')
+    initial = read_parameters(forcebalance)
+
+    streams = {section: SectionStream(xml_path, section, key) for section, key in SECTION_KEYS.items()}
+    residues = (element for tag, element in iter_forcefield(xml_path) if tag == 'Residues')
+    written, offset = [], 0
+    try:
+        for residue in residues:
+            name = residue.get('name')
+            atoms = len(residue.findall('Atom'))
+            elements = {section: stream.take(offset, offset + atoms) for section, stream in streams.items()}
+            nonbonded = nonbonded_atoms(elements.pop('NonbondedForce'), offset, initial, values)
+
+            os.makedirs(os.path.join(dest, name), exist_ok=True)
+            file_path = os.path.join(dest, name, f'{name}.xml')
+            write_molecule(file_path, offset, residue, elements, nonbonded)
+            written.append(file_path)
+            offset += atoms
+    finally:
+        residues.close()
+        for stream in streams.values():
+            stream.close()
+
+    left = [stream.section for stream in streams.values() if stream.pending is not None]
+    if left:
+        raise ValueError(f'{", ".join(left)} of {xml_path} hold elements beyond the last molecule.')
+    return written
@@ -0,0 +1,91 @@
+"""
+Streaming writer for forcefield xmls.
+
+Produces the same layout as ET.tostring -> minidom.toprettyxml(indent=''),
+one element per line with attributes in insertion order,
+without holding the whole tree (or its serialised string) in memory.
+"""
+
+import shutil
+import tempfile
+from xml.sax.saxutils import escape
+
+# saxutils.escape handles &, < and >; minidom also escapes double quotes in attribute values.
+ATTRIBUTE_ENTITIES = {'"': '&quot;'}
+
+
+def format_attributes(attrib):
+    """Serialise a dict of attributes, escaping the values the same way minidom does."""
+    return ''.join(f' {key}="{escape(value, ATTRIBUTE_ENTITIES)}"' for key, value in attrib.items())
+
+
+def format_element(tag, attrib, children=None):
+    """
+    Serialise a single element (and optionally one level of children) to text.
+    :param tag: element tag e.g. 'Atom'
+    :param attrib: dict of attribute names and (string) values
+    :param children: optional iterable of (tag, attrib) pairs nested inside the element
+    """
+
+    attrs = format_attributes(attrib)
+    if not children:
+        return f'<{tag}{attrs}/>\n'
+    inner = ''.join(format_element(child_tag, child_attrib) for child_tag, child_attrib in children)
+    return f'<{tag}{attrs}>\n{inner}</{tag}>\n'
+
+
+class StreamingXMLWriter:
+    """
+    Write an xml with a fixed set of top-level sections, e.g. AtomTypes, Residues, ...
+    Elements can be added to any section in any order; each section is spooled to its own temporary file
+    and the sections are stitched together (in the order given) when the writer is closed.
+    Peak memory is therefore independent of the number of elements written.
+    """
+
+    def __init__(self, file_path, root_tag, sections):
+        """
+        :param file_path: where to write the finished xml
+        :param root_tag: tag of the root element e.g. 'ForceField'
+        :param sections: ordered iterable of (tag, attrib) for each top-level section
+        """
+        self.file_path = file_path
+        self.root_tag = root_tag
+        self.sections = {tag: attrib for tag, attrib in sections}
+        self.spools = {tag: tempfile.TemporaryFile(mode='w+') for tag in self.sections}
+        self.counts = {tag: 0 for tag in self.sections}
+
+    def element(self, section, tag, attrib, children=None):
+        """Add an element (with optional children) to the end of a section."""
+        self.spools[section].write(format_element(tag, attrib, children))
+        self.counts[section] += 1
+
+    def text(self, section, text):
+        """Add pre-serialised elements (see format_element) to the end of a section."""
+        if text:
+            self.spools[section].write(text)
+            self.counts[section] += 1
+
+    def close(self):
+        with open(self.file_path, 'w') as xml_doc:
+            xml_doc.write(f'<?xml version="1.0" ?>\n<{self.root_tag}>\n')
+            for section, attrib in self.sections.items():
+                spool = self.spools[section]
+                if not self.counts[section]:
+                    xml_doc.write(format_element(section, attrib))
+                else:
+                    xml_doc.write(f'<{section}{format_attributes(attrib)}>\n')
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, xml_doc)
+                    xml_doc.write(f'</{section}>\n')
+                spool.close()
+            xml_doc.write(f'</{self.root_tag}>\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for spool in self.spools.values():
+                spool.close()